@@ -0,0 +1,559 @@
+import argparse
+import json
+import logging
+import platform
+import re
+import resource
+import sqlite3
+import subprocess
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = Path("output") / "benchmark"
+
+# Synthetic event tables, with the columns the local extraction code reads
+TABLES = {
+    "patients": ["patient_id", "date_of_birth", "sex", "stp", "imd", "registration_start", "registration_end"],
+    "clinical_events": ["patient_id", "code", "date", "numeric_value"],
+    "clinical_events_snomed": ["patient_id", "code", "date", "numeric_value"],
+    "medications": ["patient_id", "code", "date"],
+    "high_cost_drugs": ["patient_id", "code", "date"],
+    "sgss_positive": ["patient_id", "date"],
+    "apcs": ["patient_id", "admission_date", "diagnosis"],
+    "icu": ["patient_id", "date"],
+    "ons_deaths": ["patient_id", "code", "date", "underlying"],
+    "appointments": ["patient_id", "date"],
+}
+
+# Mean rows per patient in each event table
+DEFAULT_ROWS_PER_PATIENT = {
+    "clinical_events": 20,
+    "clinical_events_snomed": 2,
+    "medications": 10,
+    "high_cost_drugs": 0.2,
+    "sgss_positive": 0.05,
+    "apcs": 0.3,
+    "icu": 0.01,
+    "ons_deaths": 0.02,
+    "appointments": 5,
+}
+
+# Share of event rows given a code from one of the study's codelists (the rest
+# get codes which match nothing, as most real events do)
+MATCHING_SHARE = 0.3
+
+EVENT_DATES = ("2015-01-01", "2021-01-01")
+
+# The CTV3 code cohortextractor reads recorded BMI values from
+BMI_CODE = "22K.."
+
+FAMILIES = ["demographics", "diagnoses", "medications", "outcomes"]
+
+# Patients extracted at a time, which bounds the memory the extraction uses
+DEFAULT_CHUNKSIZE = 500_000
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def codes_by_table(covariate_definitions):
+    """
+    The codes the study looks for in each synthetic table, taken from the
+    codelists in the study definition
+    """
+    codes = {table: set() for table in TABLES}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        if funcname == "with_these_clinical_events":
+            codelist = kwargs["codelist"]
+            table = "clinical_events_snomed" if codelist.system == "snomed" else "clinical_events"
+        elif funcname == "with_these_medications":
+            codelist, table = kwargs["codelist"], "medications"
+        elif funcname == "with_high_cost_drugs":
+            codelist, table = kwargs["drug_name_matches"], "high_cost_drugs"
+        elif funcname == "with_these_codes_on_death_certificate":
+            codelist, table = kwargs["codelist"], "ons_deaths"
+        elif funcname == "admitted_to_hospital":
+            codelist, table = kwargs["with_these_diagnoses"] or [], "apcs"
+        elif funcname == "most_recent_bmi":
+            codelist, table = [BMI_CODE], "clinical_events"
+        else:
+            continue
+        # Codelists with categories are lists of (code, category) pairs
+        codes[table].update(item[0] if isinstance(item, tuple) else item for item in codelist)
+    return {table: sorted(table_codes) for table, table_codes in codes.items()}
+
+
+def random_dates(rng, size, start=EVENT_DATES[0], end=EVENT_DATES[1]):
+    start, end = np.datetime64(start), np.datetime64(end)
+    days = rng.integers(0, (end - start).astype(int), size)
+    return np.datetime_as_string(start + days.astype("timedelta64[D]"))
+
+
+def random_codes(rng, size, codes, table):
+    matching = rng.random(size) < MATCHING_SHARE if codes else np.zeros(size, dtype=bool)
+    result = np.array([f"{table[:2].upper()}{i:05d}" for i in rng.integers(0, 50_000, size)], dtype=object)
+    if codes:
+        result[matching] = np.array(codes, dtype=object)[rng.integers(0, len(codes), matching.sum())]
+    return result
+
+
+def patients_chunk(rng, start, size):
+    patient_id = np.arange(start, start + size, dtype="int64")
+    birth = np.datetime64("1920-01") + rng.integers(0, 100 * 12, size).astype("timedelta64[M]")
+    registration_start = np.datetime64("2018-01-01") - rng.integers(0, 20 * 365, size).astype("timedelta64[D]")
+    registration_end = np.datetime64("2019-06-01") + rng.integers(0, 600, size).astype("timedelta64[D]")
+    left = rng.random(size) < 0.05
+    return pd.DataFrame({
+        "patient_id": patient_id,
+        "date_of_birth": np.datetime_as_string(birth.astype("datetime64[D]")),
+        "sex": rng.choice(np.array(["M", "F", "U"], dtype=object), size, p=[0.49, 0.49, 0.02]),
+        "stp": np.array([f"E5400{i:04d}" for i in rng.integers(0, 42, size)], dtype=object),
+        "imd": rng.integers(0, 32_800, size),
+        "registration_start": np.datetime_as_string(registration_start),
+        "registration_end": np.where(left, np.datetime_as_string(registration_end), None),
+    })
+
+
+def events_chunk(rng, table, start, size, rows_per_patient, codes):
+    rows = rng.poisson(rows_per_patient * size)
+    patient_id = rng.integers(start, start + size, rows)
+    data = {"patient_id": patient_id}
+    if table == "apcs":
+        data["admission_date"] = random_dates(rng, rows)
+        data["diagnosis"] = random_codes(rng, rows, codes[table], table)
+        return pd.DataFrame(data)
+    if "code" in TABLES[table]:
+        data["code"] = random_codes(rng, rows, codes[table], table)
+    data["date"] = random_dates(rng, rows)
+    if "numeric_value" in TABLES[table]:
+        data["numeric_value"] = np.round(rng.normal(50, 15, rows), 1)
+    if table == "ons_deaths":
+        data["underlying"] = rng.integers(0, 2, rows)
+    return pd.DataFrame(data)
+
+
+def build_database(path, covariate_definitions, patients, seed=0, rows_per_patient=None, chunksize=100_000):
+    """
+    Creates an SQLite database of synthetic patients and event tables, standing
+    in for the backend
+
+    Codes are drawn from the study's own codelists (and from codes matching
+    nothing), a chunk of patients at a time. Patient ids run from 1 to
+    `patients`, and every table is indexed on them so the extraction can read
+    a range of patients at a time. The database is rebuilt only if the scale
+    or seed has changed.
+    """
+    rows_per_patient = dict(DEFAULT_ROWS_PER_PATIENT, **(rows_per_patient or {}))
+    metadata = {"patients": patients, "seed": seed, "rows_per_patient": rows_per_patient}
+    if path.exists():
+        with sqlite3.connect(path) as connection:
+            try:
+                (existing,) = connection.execute("SELECT value FROM benchmark_metadata").fetchone()
+            except sqlite3.Error:
+                existing = None
+        if existing == json.dumps(metadata, sort_keys=True):
+            logger.info(f"Reusing {path}")
+            return
+        path.unlink()
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    codes = codes_by_table(covariate_definitions)
+    with sqlite3.connect(path) as connection:
+        for chunk_index, start in enumerate(range(1, patients + 1, chunksize)):
+            size = min(chunksize, patients + 1 - start)
+            rng = np.random.default_rng([seed, chunk_index])
+            patients_chunk(rng, start, size).to_sql("patients", connection, if_exists="append", index=False)
+            for table, rate in rows_per_patient.items():
+                events = events_chunk(rng, table, start, size, rate, codes)
+                events.to_sql(table, connection, if_exists="append", index=False)
+            logger.info(f"Built {start + size - 1:,} of {patients:,} patients")
+        for table in TABLES:
+            connection.execute(f"CREATE INDEX {table}_patient_id ON {table} (patient_id)")
+        connection.execute("CREATE TABLE benchmark_metadata (value TEXT)")
+        connection.execute("INSERT INTO benchmark_metadata VALUES (?)", [json.dumps(metadata, sort_keys=True)])
+
+
+def read_table(connection, table, id_range, columns=None):
+    """
+    Reads the rows of a table for the patients with ids in `id_range` (first,
+    last)
+    """
+    df = pd.read_sql(
+        f"SELECT {', '.join(columns or TABLES[table])} FROM {table} WHERE patient_id BETWEEN ? AND ?",
+        connection,
+        params=id_range,
+    )
+    if "code" in df:
+        df["code"] = df["code"].astype("category")
+    return df
+
+
+def sql_expression(expression):
+    """
+    Translates a cohortextractor expression into one for `DataFrame.eval`
+    """
+    expression = re.sub(r"(?<![<>!=])=(?!=)", "==", expression)
+    expression = re.sub(r"\bAND\b", "&", expression)
+    expression = re.sub(r"\bOR\b", "|", expression)
+    return re.sub(r"\bNOT\b", "~", expression)
+
+
+def evaluate_categorised_as(kwargs, inputs):
+    """
+    Evaluates a `categorised_as` variable from a dataframe of the variables
+    it uses
+    """
+    categories = kwargs["category_definitions"]
+    default = next((category for category, expression in categories.items() if expression == "DEFAULT"), None)
+    conditions = {
+        category: inputs.eval(sql_expression(" ".join(expression.split()))).astype(bool).values
+        for category, expression in categories.items()
+        if expression != "DEFAULT"
+    }
+    return pd.Series(np.select(list(conditions.values()), list(conditions), default), index=inputs.index)
+
+
+def extract_demographics(connection, covariate_definitions, id_range, patient_ids=None):
+    """
+    Age, sex, STP, IMD, follow-up and the population, with dates and
+    thresholds taken from the study definition
+    """
+    wanted = {funcname: (name, kwargs) for name, (funcname, kwargs) in covariate_definitions.items()}
+    age, age_args = wanted["age_as_of"]
+    follow_up, follow_up_args = wanted["registered_with_one_practice_between"]
+    imd, imd_args = wanted["address_as_of"]
+    query = f"""
+        SELECT
+          patient_id,
+          CAST(strftime('%Y', :reference_date) AS INTEGER) - CAST(strftime('%Y', date_of_birth) AS INTEGER)
+            - (strftime('%m-%d', :reference_date) < strftime('%m-%d', date_of_birth)) AS {age},
+          sex AS {wanted["sex"][0]},
+          stp AS {wanted["registered_practice_as_of"][0]},
+          CAST(ROUND(imd / CAST(:round_to AS REAL)) * :round_to AS INTEGER) AS {imd},
+          registration_start <= :start_date AND (registration_end IS NULL OR registration_end >= :end_date)
+            AS {follow_up}
+        FROM patients
+        WHERE patient_id BETWEEN :first AND :last
+    """
+    df = pd.read_sql(
+        query,
+        connection,
+        params={
+            "reference_date": age_args["reference_date"],
+            "round_to": imd_args["round_to_nearest"],
+            "start_date": follow_up_args["start_date"],
+            "end_date": follow_up_args["end_date"],
+            "first": id_range[0],
+            "last": id_range[1],
+        },
+    ).set_index("patient_id")
+    population = covariate_definitions["population"][1]["category_definitions"][1]
+    df["population"] = df.eval(sql_expression(" ".join(population.split()))).astype(bool)
+    return df
+
+
+def first_date_after(connection, table, date_column, start, name, id_range, where=""):
+    query = f"""
+        SELECT patient_id, MIN({date_column}) AS {name}
+        FROM {table}
+        WHERE patient_id BETWEEN :first AND :last AND {date_column} >= :start {where}
+        GROUP BY patient_id
+    """
+    params = {"start": start or "1900-01-01", "first": id_range[0], "last": id_range[1]}
+    return pd.read_sql(query, connection, params=params).set_index("patient_id")[name]
+
+
+def count_between(connection, table, between, name, id_range):
+    query = f"""
+        SELECT patient_id, COUNT(*) AS {name}
+        FROM {table}
+        WHERE patient_id BETWEEN :first AND :last AND date BETWEEN :start AND :end
+        GROUP BY patient_id
+    """
+    params = {"start": between[0] or "1900-01-01", "end": between[1] or "9999-12-31", "first": id_range[0], "last": id_range[1]}
+    return pd.read_sql(query, connection, params=params).set_index("patient_id")[name]
+
+
+def most_recent_bmi(connection, name, kwargs, id_range):
+    """
+    The most recent recorded BMI in the period, measured at or after the
+    minimum age, with its date
+
+    cohortextractor prefers a BMI computed from weight and height where they
+    are recorded. The synthetic tables have no weights or heights, so this
+    stands in with its fallback, the recorded BMI values.
+    """
+    start, end = kwargs["between"]
+    query = f"""
+        SELECT patient_id, {name}, date
+        FROM (
+          SELECT clinical_events.patient_id, numeric_value AS {name}, date,
+            ROW_NUMBER() OVER (PARTITION BY clinical_events.patient_id ORDER BY date DESC) AS rownum
+          FROM clinical_events
+          JOIN patients ON patients.patient_id = clinical_events.patient_id
+          WHERE clinical_events.patient_id BETWEEN :first AND :last
+            AND code = :code AND date BETWEEN :start AND :end
+            AND date >= date(date_of_birth, '+' || :minimum_age || ' years')
+        )
+        WHERE rownum = 1
+    """
+    params = {
+        "code": BMI_CODE,
+        "start": start or "1900-01-01",
+        "end": end or "9999-12-31",
+        "minimum_age": kwargs["minimum_age_at_measurement"],
+        "first": id_range[0],
+        "last": id_range[1],
+    }
+    df = pd.read_sql(query, connection, params=params).set_index("patient_id")
+    if kwargs.get("include_date_of_match"):
+        df[f"{name}_date_measured"] = df.pop("date").str[:7 if kwargs.get("date_format") == "YYYY-MM" else 10]
+    else:
+        del df["date"]
+    return df
+
+
+def extract_outcomes(connection, covariate_definitions, id_range, patient_ids=None):
+    """
+    Death, hospital admission, ICU and positive test dates, plus the ONS death
+    certificate flags via the shared scans
+    """
+    from shared_scans import evaluate_shared_scans
+
+    columns = {}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        start = (kwargs.get("between") or (None, None))[0]
+        if funcname == "died_from_any_cause":
+            columns[name] = first_date_after(connection, "ons_deaths", "date", start, name, id_range)
+        elif funcname == "admitted_to_icu":
+            columns[name] = first_date_after(connection, "icu", "date", start, name, id_range)
+        elif funcname == "with_test_result_in_sgss":
+            columns[name] = first_date_after(connection, "sgss_positive", "date", start, name, id_range)
+        elif funcname == "admitted_to_hospital":
+            diagnoses = ", ".join(f"'{code}'" for code in kwargs["with_these_diagnoses"] or [])
+            where = f"AND diagnosis IN ({diagnoses})" if diagnoses else ""
+            columns[name] = first_date_after(connection, "apcs", "admission_date", start, name, id_range, where)
+    definitions = {
+        name: definition
+        for name, definition in covariate_definitions.items()
+        if definition[0] == "with_these_codes_on_death_certificate"
+    }
+    deaths = evaluate_shared_scans(definitions, {"ons_deaths": read_table(connection, "ons_deaths", id_range)}, patient_ids)
+    return pd.concat([pd.DataFrame(columns).reindex(deaths.index), deaths], axis=1)
+
+
+def extract_diagnoses(connection, covariate_definitions, id_range, patient_ids=None):
+    """
+    The clinical event variables via the shared scans, the categories
+    computed from them (such as smoking status), BMI and GP consultations
+    """
+    from shared_scans import evaluate_shared_scans
+    from variables import dependencies
+
+    tables = {table: read_table(connection, table, id_range) for table in ["clinical_events", "clinical_events_snomed"]}
+    definitions = {
+        name: definition
+        for name, definition in covariate_definitions.items()
+        if definition[0] in ("with_these_clinical_events", "value_from")
+    }
+    df = evaluate_shared_scans(definitions, tables, patient_ids)
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        if funcname == "categorised_as" and name != "population":
+            used = sorted(dependencies(covariate_definitions)[name])
+            inputs = df[used].copy()
+            for used_name in used:
+                if covariate_definitions[used_name][1]["column_type"] == "bool":
+                    inputs[used_name] = inputs[used_name].astype(bool)
+            df[name] = evaluate_categorised_as(kwargs, inputs)
+        elif funcname == "most_recent_bmi":
+            bmi = most_recent_bmi(connection, name, kwargs, id_range).reindex(df.index)
+            df[name] = bmi[name].fillna(0.0)
+            for column in bmi.columns.drop(name):
+                df[column] = bmi[column].fillna("")
+        elif funcname == "with_gp_consultations":
+            counts = count_between(connection, "appointments", kwargs["between"], name, id_range)
+            df[name] = counts.reindex(df.index).fillna(0).astype("int64")
+    return df
+
+
+def extract_medications(connection, covariate_definitions, id_range, patient_ids=None):
+    from medications import extract_all_medications
+
+    tables = {table: read_table(connection, table, id_range) for table in ["medications", "high_cost_drugs"]}
+    return extract_all_medications(covariate_definitions, tables, patient_ids)
+
+
+FAMILY_EXTRACTORS = {
+    "demographics": extract_demographics,
+    "diagnoses": extract_diagnoses,
+    "medications": extract_medications,
+    "outcomes": extract_outcomes,
+}
+
+
+class Timer:
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def time(self, name):
+        """
+        Times a step, adding to its total if it has run before (as the
+        extraction steps do, once per chunk of patients)
+        """
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        self.timings[name] = round(self.timings.get(name, 0) + elapsed, 3)
+        logger.info(f"{name}: {elapsed:.2f}s")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(study, directory, patients, seed=0, rows_per_patient=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Builds (or reuses) the synthetic database, then times each variable
+    family, assembling them into the extract, and loading the result
+
+    The extraction reads `chunksize` patients at a time and appends each
+    chunk to the CSV, so its memory use doesn't grow with `patients`; the
+    timings are totals over the chunks. `full_extraction` is the families
+    plus assembling and writing the CSV, so the per-family timings add up to
+    it.
+
+    Returns a JSON-serialisable report.
+    """
+    import pyarrow.parquet as pq
+
+    from columnar import cohort_schema, csv_to_parquet
+    from variables import output_columns
+
+    definitions = study.covariate_definitions
+    directory = Path(directory)
+    database = directory / f"benchmark-{patients}-{seed}.sqlite"
+    output = directory / "input.csv"
+    timer = Timer()
+
+    with timer.time("build_database"):
+        build_database(database, definitions, patients, seed, rows_per_patient)
+
+    with sqlite3.connect(database) as connection:
+        rows = {
+            table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in TABLES
+        }
+        extract_rows = 0
+        for first in range(1, patients + 1, chunksize):
+            id_range = (first, min(first + chunksize - 1, patients))
+            results = {}
+            patient_ids = None
+            for family in FAMILIES:
+                with timer.time(family):
+                    results[family] = FAMILY_EXTRACTORS[family](connection, definitions, id_range, patient_ids)
+                if family == "demographics":
+                    # Everything else is extracted for the population only
+                    demographics = results[family]
+                    patient_ids = demographics.index[demographics.pop("population")]
+
+            with timer.time("assemble_and_write_csv"):
+                extract = pd.concat(
+                    [demographics.reindex(patient_ids)] + [results[family] for family in FAMILIES[1:]], axis=1
+                )
+                columns = [name for name in cohort_schema(definitions) if name in extract.columns]
+                extract[columns].to_csv(
+                    output, index_label="patient_id", mode="w" if first == 1 else "a", header=first == 1
+                )
+            extract_rows += len(extract)
+            logger.info(f"Extracted {id_range[1]:,} of {patients:,} patients")
+    timer.timings["full_extraction"] = round(
+        sum(timer.timings[step] for step in FAMILIES + ["assemble_and_write_csv"]), 3
+    )
+
+    schema = {name: details for name, details in cohort_schema(definitions).items() if name in ["patient_id"] + columns}
+    parquet = output.with_suffix(".parquet")
+    # The loads read a chunk at a time too, so memory stays bounded at any scale
+    with timer.time("load_csv"):
+        for _ in pd.read_csv(output, low_memory=False, chunksize=chunksize):
+            pass
+    with timer.time("convert_to_parquet"):
+        csv_to_parquet(output, parquet, schema)
+    with timer.time("load_parquet"):
+        for batch in pq.ParquetFile(parquet).iter_batches(batch_size=chunksize):
+            batch.to_pandas()
+
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "patients": patients,
+        "seed": seed,
+        "chunksize": chunksize,
+        "rows": rows,
+        "extract_rows": extract_rows,
+        "extract_columns": len(columns),
+        "not_benchmarked": [name for name in output_columns(definitions) if name not in columns],
+        "timings": timer.timings,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def format_comparison(report, previous=None):
+    lines = [f"{'step':<24} {'seconds':>9}" + (f" {'previous':>9} {'ratio':>7}" if previous else "")]
+    for step, seconds in report["timings"].items():
+        line = f"{step:<24} {seconds:>9.2f}"
+        old = (previous or {}).get("timings", {}).get(step)
+        if previous and old:
+            line += f" {old:>9.2f} {seconds / old:>6.2f}x"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the extraction against synthetic event tables at a given scale"
+    )
+    parser.add_argument("--patients", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--chunksize", type=int, default=DEFAULT_CHUNKSIZE, help="patients to extract at a time"
+    )
+    parser.add_argument("--dir", default=str(DEFAULT_DIR), help="where to keep the database and outputs")
+    parser.add_argument("--report", help="defaults to benchmark-<patients>-<timestamp>.json in --dir")
+    parser.add_argument("--compare", help="previous report to compare against")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    from study_definition import study
+
+    report = run_benchmark(study, args.dir, args.patients, args.seed, chunksize=args.chunksize)
+    report_path = args.report or Path(args.dir) / f"benchmark-{args.patients}-{time.strftime('%Y%m%dT%H%M%S')}.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print(format_comparison(report, previous))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+
+
+# Systems whose codes are integer ids, which can be matched as int64
+NUMERIC_SYSTEMS = ["snomed", "snomedct", "dmd"]
+
+
+def is_numeric_code(code):
+    # Leading zeros would be lost in the conversion to an integer
+    return code.isdigit() and not code.startswith("0") and len(code) <= 18
+
+
+class CodeArray:
+    """
+    Compact, sorted array form of a codelist for vectorised matching
+
+    Codes are held as a sorted fixed-width string array, and numeric ids
+    (SNOMED CT, dm+d) also as a sorted int64 array, so membership of millions
+    of event codes is one `searchsorted` call rather than a hash lookup per
+    row. A codelist with categories keeps them as an array aligned with the
+    codes, stored as small integer indices into the distinct category labels.
+    """
+
+    def __init__(self, codes, categories=None, system=None):
+        codes = [str(code) for code in codes]
+        self.system = system
+        self.width = max((len(code) for code in codes), default=1)
+        self.codes, first = np.unique(np.array(codes, dtype=f"U{self.width}"), return_index=True)
+        # Integer ids are also held as int64, for event tables which store them
+        # that way. The ids are 18 digits at most, so they fit exactly.
+        self.numeric = system in NUMERIC_SYSTEMS and all(is_numeric_code(code) for code in self.codes)
+        self.ids = self.id_order = None
+        if self.numeric:
+            ids = self.codes.astype("int64")
+            self.id_order = np.argsort(ids, kind="stable")
+            self.ids = ids[self.id_order]
+
+        self.labels = None
+        self.category_indices = None
+        if categories is not None:
+            categorical = pd.Categorical([categories[i] for i in first])
+            self.labels = np.asarray(categorical.categories, dtype=object)
+            self.category_indices = categorical.codes.astype("int16")
+
+    @classmethod
+    def from_codelist(cls, codelist):
+        """
+        Builds a CodeArray from a cohortextractor codelist, keeping its
+        categories if it has any
+        """
+        if codelist.has_categories:
+            codes, categories = zip(*codelist) if len(codelist) else ((), ())
+            return cls(codes, categories, system=codelist.system)
+        return cls(codelist, system=codelist.system)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def positions(self, values):
+        """
+        Index into `codes` of each value, or -1 for values not in the codelist
+
+        Integer values are looked up in the int64 ids, and anything else as
+        strings. For categorical values (see `intern_codes`) only the distinct
+        codes are looked up. Strings are cast one character wider than the longest code,
+        so a longer value can't be truncated into a match.
+        """
+        if isinstance(values, pd.Series):
+            values = values.values
+        if isinstance(values, pd.Categorical):
+            # Look up each distinct code once
+            found = np.append(self.positions(np.asarray(values.categories)), -1)
+            return found[values.codes]
+        values = np.asarray(values)
+        if not len(self.codes):
+            return np.full(len(values), -1)
+        if self.numeric and values.dtype.kind in "iu":
+            index = np.searchsorted(self.ids, values)
+            index[index == len(self.ids)] = 0
+            return np.where(self.ids[index] == values, self.id_order[index], -1)
+        values = values.astype(f"U{self.width + 1}")
+        index = np.searchsorted(self.codes, values)
+        index[index == len(self.codes)] = 0
+        return np.where(self.codes[index] == values, index, -1)
+
+    def contains(self, values):
+        """
+        Boolean mask of the values which are in the codelist
+        """
+        return self.positions(values) >= 0
+
+    def categories_for(self, values, missing=None):
+        """
+        Category of each value, or `missing` for values not in the codelist
+        """
+        if self.labels is None:
+            raise ValueError("Codelist has no categories")
+        index = self.positions(values)
+        result = np.full(len(index), missing, dtype=object)
+        found = index >= 0
+        result[found] = self.labels[self.category_indices[index[found]]]
+        return result
+
+
+def intern_codes(events):
+    """
+    Converts the `code` column of an event table to a categorical, so each
+    distinct code is stored (and matched against a CodeArray) only once
+    """
+    if isinstance(events["code"].dtype, pd.CategoricalDtype):
+        return events
+    return events.assign(code=events["code"].astype("category"))
+
+
+def common_system(codelists):
+    """
+    The coding system shared by all of `codelists`, or None if they differ (in
+    which case codes are matched as strings)
+    """
+    systems = {getattr(codelist, "system", None) for codelist in codelists}
+    return systems.pop() if len(systems) == 1 else None
@@ -1,132 +1,242 @@
+import hashlib
+import json
+import os
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+
 from cohortextractor import (
     codelist_from_csv,
     codelist,
 )
 
 
-# OUTCOME CODELISTS
-covid_identification = codelist_from_csv(
-    "codelists/opensafely-covid-identification.csv",
-    system="icd10",
-    column="icd10_code",
-)
-
-# DEMOGRAPHIC CODELIST
-ethnicity_codes = codelist_from_csv(
-    "codelists/opensafely-ethnicity.csv",
-    system="ctv3",
-    column="Code",
-    category_column="Grouping_6",
-)
-
-# SMOKING CODELIST
-clear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-clear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
-
-unclear_smoking_codes = codelist_from_csv(
-    "codelists/opensafely-smoking-unclear.csv",
-    system="ctv3",
-    column="CTV3Code",
-    category_column="Category",
-)
-
-# CLINICAL CONDITIONS CODELISTS
-#atopic_dermatitis_codes = codelist_from_csv(
-    #"crossimid-codelists/crossimid-atopic-dermatitis.csv", system="ctv3", column="CTV3ID"
-#)
-crohns_disease_codes = codelist_from_csv(
-    "codelists/opensafely-crohns-disease.csv", system="ctv3", column="code",
-)
-
-ulcerative_colitis_codes = codelist_from_csv(
-    "codelists/opensafely-ulcerative-colitis.csv", system="ctv3", column="code",
-)
-
-inflammatory_bowel_disease_unclassified_codes = codelist_from_csv(
-    "codelists/opensafely-inflammatory-bowel-disease-unclassified.csv", system="ctv3", column="code",
-)
-
-ankylosing_spondylitis_codes = codelist_from_csv(
-    "codelists/user-mark-yates-axial-spondyloarthritis.csv", system="snomed", column="code",
-)
-
-psoriasis_codes = codelist_from_csv(
-    "codelists/opensafely-psoriasis.csv", system="ctv3", column="code",
-)
-
-hidradenitis_suppurativa_codes = codelist_from_csv(
-    "codelists/opensafely-hidradenitis-suppurativa.csv", system="ctv3", column="CTV3ID",
-)
-
-psoriatic_arthritis_codes = codelist_from_csv(
-    "codelists/opensafely-psoriatic-arthritis.csv", system="snomed", column="id",
-)
-
-rheumatoid_arthritis_codes = codelist_from_csv(
-    "codelists/opensafely-rheumatoid-arthritis.csv", system="ctv3", column="CTV3ID",
-)
-
-chronic_cardiac_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-cardiac-disease.csv", system="ctv3", column="CTV3ID",
-)
-
-diabetes_codes = codelist_from_csv(
-    "codelists/opensafely-diabetes.csv", system="ctv3", column="CTV3ID",
-)
+# Compiled codelists live alongside the CSVs they are built from, one JSON file
+# per codelist. Each is keyed on the CSV's content hash and its version id in
+# codelists/codelists.json, so a CSV is only parsed again when it changes.
+COMPILED_CODELIST_DIR = Path("codelists") / ".compiled"
+CODELIST_VERSIONS_FILE = Path("codelists") / "codelists.json"
+
+
+@lru_cache(maxsize=None)
+def codelist_versions():
+    """
+    Returns a dictionary of codelist CSV filename to OpenCodelists version id
+    """
+    try:
+        with open(CODELIST_VERSIONS_FILE) as f:
+            files = json.load(f)["files"]
+    except FileNotFoundError:
+        return {}
+    return {filename: details["id"] for filename, details in files.items()}
+
+
+def codelist_content_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def compiled_codelist_path(path):
+    path = Path(path)
+    return COMPILED_CODELIST_DIR / f"{path.parent.name}--{path.stem}.json"
+
+
+def read_compiled_codelist(compiled_path):
+    try:
+        with open(compiled_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_compiled_codelist(compiled_path, compiled):
+    # The store is only an optimisation, so a read-only checkout just means
+    # we parse the CSV every time
+    try:
+        compiled_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=compiled_path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(compiled, f)
+        os.replace(tmp_path, compiled_path)
+    except OSError:
+        pass
+
+
+def load_codelist(path, system, column="code", category_column=None):
+    """
+    Drop-in replacement for `codelist_from_csv` which goes through the compiled
+    codelist store
+
+    The CSV is only hashed when its size or modification time differ from those
+    recorded at compile time, and only parsed when the hash or version id differ
+    """
+    path = Path(path)
+    stat = path.stat()
+    file_stat = [stat.st_mtime_ns, stat.st_size]
+    version = None
+    if path.parent.name == "codelists":
+        version = codelist_versions().get(path.name)
+    params = [system, column, category_column]
+
+    compiled_path = compiled_codelist_path(path)
+    compiled = read_compiled_codelist(compiled_path)
+    content_hash = None
+    if compiled and compiled["params"] == params and compiled["version"] == version:
+        if compiled["stat"] != file_stat:
+            content_hash = codelist_content_hash(path)
+        if compiled["stat"] == file_stat or compiled["sha256"] == content_hash:
+            if compiled["stat"] != file_stat:
+                compiled["stat"] = file_stat
+                write_compiled_codelist(compiled_path, compiled)
+            codes = compiled["codes"]
+            if category_column:
+                codes = [tuple(code) for code in codes]
+            return codelist(codes, system)
+
+    codes = codelist_from_csv(
+        str(path), system=system, column=column, category_column=category_column
+    )
+    write_compiled_codelist(
+        compiled_path,
+        {
+            "path": str(path),
+            "version": version,
+            "sha256": content_hash or codelist_content_hash(path),
+            "stat": file_stat,
+            "params": params,
+            "codes": list(codes),
+        },
+    )
+    return codes
+
+
+# Codelists read from CSV are declared here rather than loaded at import time.
+# Each is loaded (via the compiled store) the first time it is accessed as an
+# attribute of this module, so importing it costs nothing for codelists that
+# are never used.
+CSV_CODELISTS = {
+    # OUTCOME CODELISTS
+    "covid_identification": dict(
+        path="codelists/opensafely-covid-identification.csv",
+        system="icd10",
+        column="icd10_code",
+    ),
+
+    # DEMOGRAPHIC CODELIST
+    "ethnicity_codes": dict(
+        path="codelists/opensafely-ethnicity.csv",
+        system="ctv3",
+        column="Code",
+        category_column="Grouping_6",
+    ),
+
+    # SMOKING CODELIST
+    "clear_smoking_codes": dict(
+        path="codelists/opensafely-smoking-clear.csv",
+        system="ctv3",
+        column="CTV3Code",
+        category_column="Category",
+    ),
+    "unclear_smoking_codes": dict(
+        path="codelists/opensafely-smoking-unclear.csv",
+        system="ctv3",
+        column="CTV3Code",
+        category_column="Category",
+    ),
+
+    # CLINICAL CONDITIONS CODELISTS
+    #"atopic_dermatitis_codes": dict(
+        #path="crossimid-codelists/crossimid-atopic-dermatitis.csv", system="ctv3", column="CTV3ID",
+    #),
+    "crohns_disease_codes": dict(
+        path="codelists/opensafely-crohns-disease.csv", system="ctv3", column="code",
+    ),
+    "ulcerative_colitis_codes": dict(
+        path="codelists/opensafely-ulcerative-colitis.csv", system="ctv3", column="code",
+    ),
+    "inflammatory_bowel_disease_unclassified_codes": dict(
+        path="codelists/opensafely-inflammatory-bowel-disease-unclassified.csv", system="ctv3", column="code",
+    ),
+    "ankylosing_spondylitis_codes": dict(
+        path="codelists/user-mark-yates-axial-spondyloarthritis.csv", system="snomed", column="code",
+    ),
+    "psoriasis_codes": dict(
+        path="codelists/opensafely-psoriasis.csv", system="ctv3", column="code",
+    ),
+    "hidradenitis_suppurativa_codes": dict(
+        path="codelists/opensafely-hidradenitis-suppurativa.csv", system="ctv3", column="CTV3ID",
+    ),
+    "psoriatic_arthritis_codes": dict(
+        path="codelists/opensafely-psoriatic-arthritis.csv", system="snomed", column="id",
+    ),
+    "rheumatoid_arthritis_codes": dict(
+        path="codelists/opensafely-rheumatoid-arthritis.csv", system="ctv3", column="CTV3ID",
+    ),
+    "chronic_cardiac_disease_codes": dict(
+        path="codelists/opensafely-chronic-cardiac-disease.csv", system="ctv3", column="CTV3ID",
+    ),
+    "diabetes_codes": dict(
+        path="codelists/opensafely-diabetes.csv", system="ctv3", column="CTV3ID",
+    ),
+    "hypertension_codes": dict(
+        path="codelists/opensafely-hypertension.csv", system="ctv3", column="CTV3ID",
+    ),
+    "chronic_respiratory_disease_codes": dict(
+        path="codelists/opensafely-chronic-respiratory-disease.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "copd_codes": dict(
+        path="codelists/opensafely-current-copd.csv", system="ctv3", column="CTV3ID",
+    ),
+    "chronic_liver_disease_codes": dict(
+        path="codelists/opensafely-chronic-liver-disease.csv", system="ctv3", column="CTV3ID",
+    ),
+    "stroke_codes": dict(
+        path="codelists/opensafely-stroke-updated.csv", system="ctv3", column="CTV3ID",
+    ),
+    "lung_cancer_codes": dict(
+        path="codelists/opensafely-lung-cancer.csv", system="ctv3", column="CTV3ID",
+    ),
+    "haem_cancer_codes": dict(
+        path="codelists/opensafely-haematological-cancer.csv", system="ctv3", column="CTV3ID",
+    ),
+    "other_cancer_codes": dict(
+        path="codelists/opensafely-cancer-excluding-lung-and-haematological.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+    "ckd_codes": dict(
+        path="codelists/opensafely-chronic-kidney-disease.csv", system="ctv3", column="CTV3ID",
+    ),
+    "organ_transplant_codes": dict(
+        path="codelists/opensafely-solid-organ-transplantation.csv",
+        system="ctv3",
+        column="CTV3ID",
+    ),
+}
 
 hba1c_new_codes = codelist(["XaPbt", "Xaeze", "Xaezd"], system="ctv3")
 hba1c_old_codes = codelist(["X772q", "XaERo", "XaERp"], system="ctv3")
 
-hypertension_codes = codelist_from_csv(
-    "codelists/opensafely-hypertension.csv", system="ctv3", column="CTV3ID",
-)
-
-chronic_respiratory_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-respiratory-disease.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-copd_codes = codelist_from_csv(
-    "codelists/opensafely-current-copd.csv", system="ctv3", column="CTV3ID",
-)
-
-chronic_liver_disease_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-liver-disease.csv", system="ctv3", column="CTV3ID",
-)
-
-stroke_codes = codelist_from_csv(
-    "codelists/opensafely-stroke-updated.csv", system="ctv3", column="CTV3ID",
-)
-
-lung_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-lung-cancer.csv", system="ctv3", column="CTV3ID",
-)
-
-haem_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-haematological-cancer.csv", system="ctv3", column="CTV3ID",
-)
-
-other_cancer_codes = codelist_from_csv(
-    "codelists/opensafely-cancer-excluding-lung-and-haematological.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
 creatinine_codes = codelist(["XE2q5"], system="ctv3")
 
-ckd_codes = codelist_from_csv(
-    "codelists/opensafely-chronic-kidney-disease.csv", system="ctv3", column="CTV3ID",
-)
-
-organ_transplant_codes = codelist_from_csv(
-    "codelists/opensafely-solid-organ-transplantation.csv",
-    system="ctv3",
-    column="CTV3ID",
-)
-
-# Medications now handled through function in study_defintion.py
\ No newline at end of file
+# Medications now handled through function in study_defintion.py
+
+# The codelists read from CSV are left out, since `from codelists import *`
+# would load every one of them. Import those by name.
+__all__ = [
+    "hba1c_new_codes",
+    "hba1c_old_codes",
+    "creatinine_codes",
+]
+
+
+def __getattr__(name):
+    try:
+        spec = CSV_CODELISTS[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    codes = load_codelist(**spec)
+    globals()[name] = codes
+    return codes
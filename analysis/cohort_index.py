@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from pandas.io.stata import StataMissingValue
+
+
+DEFAULT_INPUT = Path("output") / "data" / "file_imid_all.dta"
+DEFAULT_INDEX_DIR = Path("output") / "data" / "cohorts"
+
+DATASET_FILE = "analysis_dataset.arrow"
+INDEX_FILE = "cohorts.json"
+
+# Cohorts made of at most this many runs of consecutive rows are returned as
+# slices of the memory-mapped dataset, which copies nothing. Others are
+# gathered with `take`, which copies the rows.
+MAX_SLICES = 64
+
+# The cohorts which 000_define_covariates.do saves as separate files. Each is
+# the patients for whom the exposure/comparator variable isn't missing.
+COHORTS = [
+    "imid",
+    "joint",
+    "skin",
+    "bowel",
+    "imiddrugcategory",
+    "standtnf",
+    "standtnf3m",
+    "tnfmono",
+    "standil6",
+    "standil17",
+    "standil23",
+    "standjaki",
+    "standritux",
+    "standinflix",
+    "standvedolizumab",
+    "standabatacept",
+]
+
+
+def cohort_row_ids(df, cohorts=COHORTS):
+    """
+    Returns a dictionary of cohort name -> sorted array of the row numbers in
+    `df` which belong to that cohort
+    """
+    return {
+        name: np.flatnonzero(df[name].notna().values).astype("int64")
+        for name in cohorts
+    }
+
+
+def build_index(df, index_dir=DEFAULT_INDEX_DIR, cohorts=COHORTS):
+    """
+    Writes the analysis dataset once, as an uncompressed Arrow file which can
+    be memory-mapped, plus one row-id array per cohort
+
+    Row ids are stored as .npy files so they can be memory-mapped too, and
+    `cohorts.json` records the number of rows in the dataset and each cohort.
+    The rows of each column's `.u` values (see
+    `derived_covariates.UNKNOWN_MISSING`) are stored the same way.
+    """
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    feather.write_feather(table, index_dir / DATASET_FILE, compression="uncompressed")
+
+    summary = {"rows": len(df), "cohorts": {}, "unknown": []}
+    for name, row_ids in cohort_row_ids(df, cohorts).items():
+        np.save(index_dir / f"{name}.npy", row_ids)
+        summary["cohorts"][name] = len(row_ids)
+    for name, mask in df.attrs.get("unknown", {}).items():
+        np.save(index_dir / f"unknown_{name}.npy", np.flatnonzero(mask.reindex(df.index, fill_value=False).values))
+        summary["unknown"].append(name)
+    with open(index_dir / INDEX_FILE, "w") as f:
+        json.dump(summary, f, indent=2)
+        f.write("\n")
+    return summary
+
+
+def row_runs(row_ids):
+    """
+    Splits sorted row ids into runs of consecutive rows, returning arrays of
+    each run's start and (exclusive) stop
+    """
+    breaks = np.flatnonzero(np.diff(row_ids) != 1) + 1
+    starts = np.concatenate([row_ids[:1], row_ids[breaks]])
+    stops = np.concatenate([row_ids[breaks - 1] + 1, row_ids[-1:] + 1])
+    return starts, stops
+
+
+class CohortIndex:
+    """
+    Read access to a dataset written by `build_index`
+
+    The dataset and the row ids are memory-mapped, so opening the index reads
+    almost nothing; only the columns and rows which are used are paged in from
+    disk.
+    """
+
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR):
+        self.index_dir = Path(index_dir)
+        with open(self.index_dir / INDEX_FILE) as f:
+            self.summary = json.load(f)
+        self.table = feather.read_table(self.index_dir / DATASET_FILE, memory_map=True)
+
+    @property
+    def cohorts(self):
+        return list(self.summary["cohorts"])
+
+    def row_ids(self, name):
+        if name not in self.summary["cohorts"]:
+            raise ValueError(f"Unknown cohort {name}; expected one of {', '.join(self.cohorts)}")
+        return np.load(self.index_dir / f"{name}.npy", mmap_mode="r")
+
+    def membership(self, name):
+        """
+        Boolean mask over the whole dataset, True for members of the cohort
+        """
+        mask = np.zeros(self.summary["rows"], dtype=bool)
+        mask[self.row_ids(name)] = True
+        return mask
+
+    def cohort_table(self, name, columns=None):
+        """
+        The rows of the dataset in cohort `name` as an Arrow table, reading only
+        `columns` (all columns by default)
+
+        A cohort which is a few runs of consecutive rows (such as `imid`, which
+        is every row) is a zero-copy view of the dataset; any other cohort's
+        rows are copied.
+        """
+        table = self.table if columns is None else self.table.select(columns)
+        starts, stops = row_runs(self.row_ids(name))
+        if len(starts) > MAX_SLICES:
+            return table.take(pa.array(self.row_ids(name)))
+        if not len(starts):
+            return table.slice(0, 0)
+        return pa.concat_tables([table.slice(start, stop - start) for start, stop in zip(starts, stops)])
+
+    def cohort(self, name, columns=None):
+        """
+        The rows of the dataset in cohort `name` as a dataframe, in the same
+        order as the corresponding `file_<name>.dta`
+
+        Columns have the types `read_analysis_dataset` gives them, so dates
+        are Stata dates (days since 1960-01-01, with the half days added to
+        events on the index date) and missing values, including `.u`, are
+        NaN or NA. The rows of the `.u` values are in `attrs["unknown"]`, as
+        `derived_covariates.derive_covariates` gives them.
+        """
+        df = self.cohort_table(name, columns).to_pandas()
+        row_ids = self.row_ids(name)
+        df.attrs["unknown"] = {
+            column: pd.Series(np.isin(row_ids, np.load(self.index_dir / f"unknown_{column}.npy")), index=df.index)
+            for column in self.summary.get("unknown", [])
+            if column in df
+        }
+        return df
+
+
+def read_analysis_dataset(filename):
+    """
+    Reads the analysis dataset as `derived_covariates.derive_covariates`
+    returns it
+
+    Dates are kept as Stata dates, since converting them would lose the half
+    days, and value labels as their codes, as Stata does. Missing values are
+    read as NaN, and the rows of the `.u` values in the `UNKNOWN_MISSING`
+    columns are kept in `attrs["unknown"]` so that `export` writes them back.
+    Columns are given the same compact types as when they were derived.
+    """
+    # derived_covariates imports COHORTS from here
+    from derived_covariates import UNKNOWN_MISSING, compact_column
+
+    df = pd.read_stata(filename, convert_dates=False, convert_categoricals=False)
+    result = pd.DataFrame({name: compact_column(name, df[name].values) for name in df.columns})
+    columns = [name for name in UNKNOWN_MISSING if name in df]
+    missing = pd.read_stata(filename, columns=columns, convert_missing=True, convert_categoricals=False)
+    result.attrs["unknown"] = {
+        name: pd.Series([isinstance(value, StataMissingValue) and value.string == ".u" for value in missing[name]])
+        for name in columns
+    }
+    return result
+
+
+def export_cohort(index, name, filename):
+    """
+    Writes cohort `name` as a Stata file, in the same form as
+    `create_cohorts`'s `file_<name>.dta`
+    """
+    from derived_covariates import write_analysis_dataset
+
+    write_analysis_dataset(index.cohort(name), filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Index the analysis dataset by cohort, for reading cohorts without the per-cohort files"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    build = subparsers.add_parser("build", help="write the dataset and cohort row ids")
+    build.add_argument("--input", default=str(DEFAULT_INPUT))
+    build.add_argument("--output-dir", default=str(DEFAULT_INDEX_DIR))
+    export = subparsers.add_parser("export", help="write one cohort as a Stata file")
+    export.add_argument("cohort", choices=COHORTS)
+    export.add_argument("--index-dir", default=str(DEFAULT_INDEX_DIR))
+    export.add_argument("--output", help="defaults to output/data/file_<cohort>.dta")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        summary = build_index(read_analysis_dataset(args.input), args.output_dir)
+        for name, rows in summary["cohorts"].items():
+            print(f"{name}: {rows} of {summary['rows']} rows")
+    elif args.command == "export":
+        output = args.output or os.path.join("output", "data", f"file_{args.cohort}.dta")
+        export_cohort(CohortIndex(args.index_dir), args.cohort, output)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+
+# Column types for the cohort extract, derived from the study definition. The
+# python image used by project.yaml actions doesn't include cohortextractor, so
+# a copy is committed alongside the study definition and refreshed with
+# `python analysis/columnar.py schema` whenever a variable is added or changed.
+SCHEMA_FILE = Path("analysis") / "cohort_schema.json"
+
+ARROW_TYPES = {
+    "date": pa.date32(),
+    "flag": pa.int8(),
+    "count": pa.int16(),
+    "int": pa.int16(),
+    "float": pa.float64(),
+    "category": pa.dictionary(pa.int16(), pa.string()),
+}
+
+# Returning values which are integers in the extract but behave as categories
+CATEGORICAL_INTS = ["index_of_multiple_deprivation", "rural_urban_classification"]
+
+# Padding which turns a date at the given precision into a full ISO date, as
+# cohortextractor does when it produces typed output
+DATE_PADDING = {"YYYY": "-01-01", "YYYY-MM": "-01", "YYYY-MM-DD": ""}
+
+# In memory, `read_cohort` holds dates as days since this date, in an int32,
+# which is how Arrow's date32 stores them. Any date in the extract fits,
+# including far past or future placeholders such as 9999-12-31.
+DATE_EPOCH = np.datetime64("1970-01-01", "D")
+
+# In-memory dtypes for each column type, and the nullable dtype used instead
+# when a chunk has missing values
+PANDAS_DTYPES = {
+    "patient_id": ("int64", "Int64"),
+    "date": ("int32", "Int32"),
+    "flag": ("int8", "Int8"),
+    "count": ("int16", "Int16"),
+    "int": ("int16", "Int16"),
+    "float": ("Float32", "Float32"),
+}
+
+
+def cohort_schema(covariate_definitions):
+    """
+    Returns a dictionary of column name -> {"type": ..., "date_format": ...} for
+    every column in the cohort extract
+
+    Category columns also list the categories in their `return_expectations`,
+    in the order they are declared.
+    """
+    schema = {"patient_id": {"type": "patient_id"}}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        if name == "population" or kwargs.get("hidden"):
+            continue
+        column_type = kwargs["column_type"]
+        returning = kwargs.get("returning")
+        if column_type == "date" and funcname != "categorised_as":
+            schema[name] = {"type": "date", "date_format": kwargs.get("date_format") or "YYYY"}
+        elif column_type == "bool":
+            schema[name] = {"type": "flag"}
+        elif column_type == "int" and returning in CATEGORICAL_INTS:
+            schema[name] = {"type": "category"}
+        elif column_type == "int" and returning and returning.startswith("number_of"):
+            schema[name] = {"type": "count"}
+        elif column_type == "int":
+            schema[name] = {"type": "int"}
+        elif column_type == "float":
+            schema[name] = {"type": "float"}
+        elif column_type in ("str", "date"):
+            schema[name] = {"type": "category"}
+        else:
+            raise ValueError(f"Unable to choose a column type for {name} ({column_type})")
+        if schema[name]["type"] == "category":
+            ratios = ((kwargs.get("return_expectations") or {}).get("category") or {}).get("ratios", {})
+            schema[name]["categories"] = [str(category) for category in ratios]
+    return schema
+
+
+def load_schema(path=SCHEMA_FILE):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_schema(schema, path=SCHEMA_FILE):
+    with open(path, "w") as f:
+        json.dump(schema, f, indent=2)
+        f.write("\n")
+
+
+def arrow_schema(schema):
+    fields = []
+    for name, details in schema.items():
+        if details["type"] == "patient_id":
+            fields.append(pa.field(name, pa.int64(), nullable=False))
+            continue
+        metadata = {"date_format": details["date_format"]} if details["type"] == "date" else None
+        fields.append(pa.field(name, ARROW_TYPES[details["type"]], metadata=metadata))
+    return pa.schema(fields)
+
+
+def convert_column(values, details):
+    """
+    Converts one column of the extract to its typed Arrow representation
+
+    `values` is an Arrow array, either of strings as read from CSV (with missing
+    values as nulls) or already numeric, as in a dummy data chunk
+    """
+    column_type = details["type"]
+    if column_type == "patient_id":
+        return pc.cast(values, pa.int64())
+    if pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+        values = pc.if_else(pc.equal(values, ""), pa.scalar(None, values.type), values)
+        if column_type == "date":
+            padded = pc.binary_join_element_wise(values, DATE_PADDING[details["date_format"]], "")
+            timestamps = pc.strptime(padded, format="%Y-%m-%d", unit="s")
+            return pc.cast(timestamps, pa.date32())
+    if column_type == "category":
+        return pc.cast(values, pa.string()).dictionary_encode().cast(ARROW_TYPES["category"])
+    # A safe cast raises if a value doesn't fit in the smaller integer types
+    return pc.cast(values, ARROW_TYPES[column_type])
+
+
+def convert_table(table, schema, target_schema):
+    arrays = [convert_column(table.column(name).combine_chunks(), details) for name, details in schema.items()]
+    return pa.Table.from_arrays(arrays, schema=target_schema)
+
+
+def write_parquet_chunks(chunks, filename, schema):
+    """
+    Writes an iterable of dataframes in the extract's CSV representation to a
+    typed Parquet file, one row group per chunk, so only one chunk is held in
+    memory at a time
+    """
+    target_schema = arrow_schema(schema)
+    with pq.ParquetWriter(filename, target_schema, compression="zstd") as writer:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            writer.write_table(convert_table(table, schema, target_schema))
+
+
+def iter_typed_csv(csv_filename, schema, rows_per_table=500_000):
+    """
+    Reads a cohortextractor CSV in blocks, yielding typed Arrow tables of about
+    `rows_per_table` rows
+    """
+    target_schema = arrow_schema(schema)
+    reader = pacsv.open_csv(
+        csv_filename,
+        convert_options=pacsv.ConvertOptions(
+            column_types={name: pa.string() for name in schema},
+            include_columns=list(schema),
+            null_values=[""],
+            strings_can_be_null=True,
+        ),
+    )
+    batches = []
+    rows = 0
+    for batch in reader:
+        batches.append(batch)
+        rows += batch.num_rows
+        if rows >= rows_per_table:
+            yield convert_table(pa.Table.from_batches(batches), schema, target_schema)
+            batches = []
+            rows = 0
+    if batches:
+        yield convert_table(pa.Table.from_batches(batches), schema, target_schema)
+
+
+def csv_to_parquet(csv_filename, parquet_filename, schema, row_group_size=500_000):
+    """
+    Streams a cohortextractor CSV into a typed Parquet file
+
+    Dates become real dates (month and year precision dates are stored as the
+    first of the period, as in cohortextractor's own typed outputs, with the
+    precision kept in the field metadata), flags and counts become small
+    integers and category columns are dictionary-encoded. The CSV is read in
+    blocks and written out a row group at a time, so memory use is bounded by
+    the row group size.
+    """
+    with pq.ParquetWriter(parquet_filename, arrow_schema(schema), compression="zstd") as writer:
+        for table in iter_typed_csv(csv_filename, schema, row_group_size):
+            writer.write_table(table)
+
+
+def dates_as_days(table):
+    """
+    Replaces each date column of a typed Arrow table with its days since
+    `DATE_EPOCH`
+
+    Left as dates, `to_pandas` would turn them into nanosecond timestamps,
+    which only reach from 1677 to 2262 and silently wrap around outside that.
+    """
+    for i, field in enumerate(table.schema):
+        if pa.types.is_date32(field.type):
+            table = table.set_column(i, field.name, pc.cast(table.column(i), pa.int32()))
+    return table
+
+
+def typed_column(values, details):
+    """
+    Converts one column of a typed Arrow table, as converted to pandas by way
+    of `dates_as_days`, to its compact in-memory dtype
+    """
+    column_type = details["type"]
+    if column_type == "category":
+        declared = details.get("categories", [])
+        known = set(declared)
+        categories = declared + [value for value in values.cat.categories if value not in known]
+        return values.cat.set_categories(categories)
+    plain, nullable = PANDAS_DTYPES[column_type]
+    # Casting to a nullable dtype raises if a value doesn't fit, where a NumPy
+    # cast would wrap around
+    values = values.astype(nullable)
+    if values.isna().any():
+        return values
+    return values.astype(plain)
+
+
+def days_to_dates(days):
+    """
+    Converts a date column from `read_cohort` back to datetime64
+
+    The result is day precision; a pandas Series of it can only hold dates
+    from 1677 to 2262.
+    """
+    values = days.to_numpy(dtype="float64", na_value=np.nan)
+    dates = np.full(len(values), np.datetime64("NaT"), dtype="datetime64[D]")
+    present = ~np.isnan(values)
+    dates[present] = DATE_EPOCH + values[present].astype("int64").astype("timedelta64[D]")
+    return pd.Series(dates, index=days.index)
+
+
+def iter_typed_tables(filename, schema, rows_per_table):
+    if str(filename).endswith(".parquet"):
+        parquet = pq.ParquetFile(filename)
+        for batch in parquet.iter_batches(batch_size=rows_per_table, columns=list(schema)):
+            yield pa.Table.from_batches([batch])
+    else:
+        yield from iter_typed_csv(filename, schema, rows_per_table)
+
+
+def read_cohort(filename, schema=None, columns=None, chunksize=500_000):
+    """
+    Reads the cohort extract (CSV or Parquet) a chunk at a time into a
+    dataframe of compact dtypes
+
+    Flags are int8, counts and ages int16, dates int32 days since
+    `DATE_EPOCH` (see `days_to_dates`), floats Float32 and categories
+    categoricals, with the categories from `return_expectations` first.
+    Columns with missing values use the nullable version of their dtype.
+    Each chunk goes through the same typed Arrow conversion as
+    `csv_to_parquet` and is made compact before the next is read, so the
+    full-width values are never all in memory at once.
+    """
+    schema = schema or load_schema()
+    if columns is not None:
+        schema = {name: schema[name] for name in ["patient_id"] + [c for c in columns if c != "patient_id"]}
+    frames = []
+    for table in iter_typed_tables(filename, schema, chunksize):
+        chunk = dates_as_days(table).to_pandas()
+        frames.append(pd.DataFrame({name: typed_column(chunk[name], details) for name, details in schema.items()}))
+    if not frames:
+        return pd.DataFrame({name: pd.Series([], dtype="object") for name in schema})
+
+    # Give every chunk the same categories, so they stay categorical when
+    # concatenated: the declared ones, then any others in the order seen
+    for name, details in schema.items():
+        if details["type"] == "category":
+            categories = {}
+            for frame in frames:
+                categories.update(dict.fromkeys(frame[name].cat.categories))
+            categories = list(categories)
+            for frame in frames:
+                frame[name] = frame[name].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert the cohort extract to typed, compressed Parquet"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("schema", help=f"rebuild {SCHEMA_FILE} from the study definition")
+    convert = subparsers.add_parser("convert", help="convert a CSV extract to Parquet")
+    convert.add_argument("--input", default="output/input.csv")
+    convert.add_argument("--output", default="output/input.parquet")
+    convert.add_argument("--row-group-size", type=int, default=500_000)
+    args = parser.parse_args()
+
+    if args.command == "schema":
+        from study_definition import study
+
+        write_schema(cohort_schema(study.covariate_definitions))
+    elif args.command == "convert":
+        csv_to_parquet(args.input, args.output, load_schema(), args.row_group_size)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,571 @@
+import argparse
+import hashlib
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from benchmark_extract import DEFAULT_DIR, build_database, sql_expression
+from profile_extract import JOIN_FUNCTIONS, variable_for_query
+from variables import dependencies, output_columns
+
+
+logger = logging.getLogger(__name__)
+
+# Tables a variable's queries create: its own `#<name>` and any codelists it
+# uploads
+CREATED_TABLE = re.compile(r"(?:INTO|CREATE TABLE)\s+\[?#(\w+)")
+TABLE_REFERENCE = re.compile(r"(?<![#\w])#(\w+)")
+
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# Characters of an ISO date kept by each `date_format`; cohortextractor
+# formats dates as years if no format is given
+DATE_FORMAT_LENGTHS = {None: 4, "YYYY": 4, "YYYY-MM": 7, "YYYY-MM-DD": 10}
+
+
+def split_queries(queries):
+    """
+    Divides a backend's queries into each variable's own queries (codelist
+    uploads, its table and the index on it) and the rest, which is the final
+    join
+    """
+    groups = {}
+    pending = []
+    for query in queries:
+        name = variable_for_query(query)
+        if name is None:
+            pending.append(query)
+            continue
+        groups.setdefault(name, []).extend(pending + [query])
+        pending = []
+    return groups, pending
+
+
+def task_dependencies(covariate_definitions, tasks):
+    """
+    Returns a dictionary of task name -> set of the tasks which must finish
+    before it can start
+
+    Edges come from `variables.dependencies`, so include the sub-variables of
+    `categorised_as` and `satisfying` expressions. A variable which isn't a
+    task itself (one evaluated in the final join) stands for everything it is
+    computed from.
+    """
+    graph = dependencies(covariate_definitions)
+    needs = {}
+    for task in tasks:
+        found = set()
+        seen = set()
+        pending = list(graph.get(task, ()))
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            if name in tasks:
+                found.add(name)
+            else:
+                pending.extend(graph.get(name, ()))
+        needs[task] = found - {task}
+    return needs
+
+
+def table_references(groups):
+    """
+    Returns a dictionary of variable name -> set of the other variables whose
+    temporary tables its queries read
+    """
+    return {
+        name: (set(TABLE_REFERENCE.findall("\n".join(queries))) & set(groups)) - {name}
+        for name, queries in groups.items()
+    }
+
+
+def created_tables(groups):
+    """
+    The temporary tables the variables' queries create, without their `#`
+    """
+    return sorted({table for group in groups.values() for query in group for table in CREATED_TABLE.findall(query)})
+
+
+def promote_temporary_tables(queries, groups, prefix):
+    """
+    Renames the temporary tables the variables' queries create to global
+    temporary tables, `##<prefix>_<table>`, everywhere they appear
+
+    A `#table` is only visible to the connection which created it, so tables
+    built over the pool have to be `##tables` for the final join to see them.
+    Global tables are visible to every session on the server, so `prefix`
+    should be unique to the extract (see `table_prefix`).
+    """
+    created = sorted(created_tables(groups), key=len, reverse=True)
+    if not created:
+        return list(queries)
+    pattern = re.compile(r"(?<![#\w])#(" + "|".join(map(re.escape, created)) + r")\b")
+    return [pattern.sub(rf"##{prefix}_\1", query) for query in queries]
+
+
+def table_prefix(queries, database_url):
+    """
+    The prefix for an extract's global tables: a hash of its queries and
+    database, as the backend keys its temporary database cache
+
+    The prefix ends up in the queries, so it has to be the same every time
+    the same extract is run. Otherwise a retried extract never finds the
+    results the backend saved from the last attempt.
+    """
+    from cohortextractor.mssql_utils import mssql_connection_params_from_url
+
+    database = mssql_connection_params_from_url(database_url)["database"]
+    return "ce" + hashlib.sha1("\n".join(queries + [database]).encode("utf8")).hexdigest()[:12]
+
+
+def drop_table_query(table):
+    return f"IF OBJECT_ID('tempdb..{table}') IS NOT NULL DROP TABLE {table}"
+
+
+class ConnectionPool:
+    """
+    Up to `size` database connections, each used by one task at a time
+
+    Connections are opened when first needed and kept until the pool is
+    closed, since tables they've created may disappear with them.
+    """
+
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        self.connections = []
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        try:
+            connection = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                connection = None
+                if len(self.connections) < self.size:
+                    connection = self.connect()
+                    self.connections.append(connection)
+            if connection is None:
+                connection = self.idle.get()
+        try:
+            yield connection
+        finally:
+            self.idle.put(connection)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.idle = queue.LifoQueue()
+
+
+def dispatch(tasks, needs, run, workers):
+    """
+    Calls `run(name)` for each of `tasks` across `workers` threads, starting
+    each task as soon as everything in its `needs` has finished
+
+    Tasks are started in the order given when more than one is ready. If a
+    task fails, no more are started and its exception is raised once the
+    running tasks have finished. Returns a dictionary of name -> (start, end)
+    in seconds since dispatch began.
+    """
+    remaining = {name: set(needs.get(name, ())) for name in tasks}
+    unknown = set().union(*remaining.values()) - set(remaining)
+    if unknown:
+        raise ValueError(f"Tasks depend on unknown tasks: {', '.join(sorted(unknown))}")
+    timings = {}
+    started = time.perf_counter()
+
+    def timed(name):
+        start = time.perf_counter() - started
+        run(name)
+        timings[name] = (round(start, 3), round(time.perf_counter() - started, 3))
+
+    with ThreadPoolExecutor(workers) as executor:
+        running = {}
+        while remaining or running:
+            for name in [name for name, waiting in remaining.items() if not waiting]:
+                del remaining[name]
+                running[executor.submit(timed, name)] = name
+            if not running:
+                raise ValueError(f"Circular dependency between {', '.join(sorted(remaining))}")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                future.result()
+                for waiting in remaining.values():
+                    waiting.discard(name)
+    return timings
+
+
+class ConcurrentDispatcher:
+    """
+    Runs a StudyDefinition's extract with independent variables' queries in
+    flight at the same time
+
+    Each variable's queries run in order on one of a pool of `workers`
+    connections, once the variables whose tables they read have been built.
+    The final join then runs on the backend's own connection, as usual.
+    Replaces the backend's `execute_queries` (and its queries, to promote
+    their temporary tables) for the duration of `run`.
+
+    The global tables' prefix comes from the queries and the database (see
+    `table_prefix`), so different extracts on the same server can't collide
+    and a retried extract finds the results the backend saved in its temporary
+    database. Tables left by an earlier attempt are dropped before the
+    variables are dispatched, and the run's tables are dropped when it ends.
+    """
+
+    def __init__(self, study, workers=4):
+        self.study = study
+        self.backend = study.backend
+        self.workers = workers
+        self.timings = {}
+
+    def connect(self):
+        from cohortextractor.mssql_utils import mssql_dbapi_connection_from_url
+
+        return mssql_dbapi_connection_from_url(self.backend.database_url)
+
+    def run_task(self, name):
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            for query in self.groups[name]:
+                cursor.execute(query)
+        logger.info(f"Built {name}")
+
+    def execute_queries(self, queries):
+        if not self.timings and any(query in self.dispatched for query in queries):
+            self.drop_tables()
+            self.timings = dispatch(list(self.groups), self.needs, self.run_task, self.workers)
+        rest = [query for query in queries if query not in self.dispatched]
+        return type(self.backend).execute_queries(self.backend, rest)
+
+    def run(self, output):
+        """
+        Runs the extract to `output`, returning each variable's (start, end)
+        time
+        """
+        original = self.backend.queries
+        groups, _ = split_queries(original)
+        references = table_references(groups)
+        self.needs = {
+            name: waiting | references[name]
+            for name, waiting in task_dependencies(self.study.covariate_definitions, groups).items()
+        }
+        prefix = table_prefix(original, self.backend.database_url)
+        self.tables = [f"##{prefix}_{table}" for table in created_tables(groups)]
+        promoted = promote_temporary_tables(original, groups, prefix)
+        renamed = dict(zip(original, promoted))
+        self.groups = {name: [renamed[query] for query in group] for name, group in groups.items()}
+        self.dispatched = {query for group in self.groups.values() for query in group}
+        self.timings = {}
+        self.pool = ConnectionPool(self.connect, self.workers)
+        self.backend.queries = promoted
+        self.backend.execute_queries = self.execute_queries
+        try:
+            self.backend.to_file(output)
+        finally:
+            del self.backend.execute_queries
+            self.backend.queries = original
+            if self.pool.connections:
+                try:
+                    self.drop_tables()
+                except Exception:
+                    logger.warning("Failed to drop the extract's global temporary tables", exc_info=True)
+            self.pool.close()
+        return self.timings
+
+    def drop_tables(self):
+        """
+        Drops the extract's global tables, which would otherwise last as long
+        as the sessions that created them (longer, if the driver pools them)
+        """
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            for table in self.tables:
+                cursor.execute(drop_table_query(table))
+
+
+def quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def codelist_values(codelist):
+    codes = {}
+    for item in codelist:
+        code, category = item if isinstance(item, tuple) else (item, None)
+        codes.setdefault(code, category)
+    return ", ".join(f"({quote(code)}, {'NULL' if category is None else quote(category)})" for code, category in codes.items())
+
+
+def event_query(table, date_column, returning, between, first, codelist=None, code_column="code", conditions=()):
+    """
+    SQLite for one variable over an event table, returning `patient_id`,
+    `value` and the `date` of the match
+    """
+    start, end = between or (None, None)
+    where = list(conditions)
+    if start:
+        where.append(f"{date_column} >= {quote(start)}")
+    if end:
+        where.append(f"{date_column} <= {quote(end)}")
+    where = f"WHERE {' AND '.join(where)}" if where else ""
+    source = table
+    codelist_cte = ""
+    if codelist is not None:
+        codelist_cte = f"WITH codelist(code, category) AS (VALUES {codelist_values(codelist)})\n"
+        source = f"{table} JOIN codelist ON {table}.{code_column} = codelist.code"
+    if returning in ("category", "numeric_value"):
+        column = "codelist.category" if returning == "category" else f"{table}.numeric_value"
+        order = "ASC" if first else "DESC"
+        return f"""{codelist_cte}SELECT patient_id, value, date FROM (
+          SELECT
+            {table}.patient_id,
+            {column} AS value,
+            {date_column} AS date,
+            ROW_NUMBER() OVER (PARTITION BY {table}.patient_id ORDER BY {date_column} {order}, {table}.rowid {order}) AS n
+          FROM {source}
+          {where}
+        ) WHERE n = 1"""
+    date = f"{'MIN' if first else 'MAX'}({date_column})"
+    value = {"binary_flag": "1", "number_of_matches_in_period": "COUNT(*)"}.get(returning, date)
+    return f"""{codelist_cte}SELECT {table}.patient_id, {value} AS value, {date} AS date
+        FROM {source}
+        {where}
+        GROUP BY {table}.patient_id"""
+
+
+def standin_query(funcname, kwargs):
+    """
+    SQLite for a variable against the synthetic tables in
+    `benchmark_extract.py`, or None if the stand-in can't compute it
+    """
+    if any(date and not ISO_DATE.match(date) for date in kwargs.get("between") or ()):
+        return None
+    first = bool(kwargs.get("find_first_match_in_period"))
+    between = kwargs.get("between")
+    if funcname == "age_as_of":
+        reference_date = quote(kwargs["reference_date"])
+        return f"""SELECT patient_id,
+          CAST(strftime('%Y', {reference_date}) AS INTEGER) - CAST(strftime('%Y', date_of_birth) AS INTEGER)
+            - (strftime('%m-%d', {reference_date}) < strftime('%m-%d', date_of_birth)) AS value
+        FROM patients"""
+    if funcname == "sex":
+        return "SELECT patient_id, sex AS value FROM patients"
+    if funcname == "registered_practice_as_of" and kwargs["returning"] == "stp_code":
+        return "SELECT patient_id, stp AS value FROM patients"
+    if funcname == "address_as_of" and kwargs["returning"] == "index_of_multiple_deprivation":
+        round_to = kwargs["round_to_nearest"] or 1
+        return f"SELECT patient_id, CAST(ROUND(imd / {float(round_to)}) * {round_to} AS INTEGER) AS value FROM patients"
+    if funcname == "registered_with_one_practice_between":
+        return f"""SELECT patient_id, 1 AS value FROM patients
+        WHERE registration_start <= {quote(kwargs["start_date"])}
+          AND (registration_end IS NULL OR registration_end >= {quote(kwargs["end_date"])})"""
+    if funcname == "died_from_any_cause":
+        return event_query("ons_deaths", "date", kwargs["returning"], between, True)
+    if funcname == "admitted_to_icu":
+        return event_query("icu", "date", kwargs["returning"], between, first)
+    if funcname == "with_test_result_in_sgss" and kwargs["test_result"] == "positive":
+        return event_query("sgss_positive", "date", kwargs["returning"], between, first)
+    if funcname == "admitted_to_hospital":
+        return event_query(
+            "apcs", "admission_date", kwargs["returning"], between, first, kwargs["with_these_diagnoses"], "diagnosis"
+        )
+    if funcname == "with_these_codes_on_death_certificate":
+        conditions = ["underlying = 1"] if kwargs["match_only_underlying_cause"] else []
+        return event_query("ons_deaths", "date", kwargs["returning"], between, True, kwargs["codelist"], conditions=conditions)
+    if funcname == "with_these_clinical_events":
+        if kwargs["ignore_days_where_these_codes_occur"] or kwargs["episode_defined_as"]:
+            return None
+        table = "clinical_events_snomed" if kwargs["codelist"].system == "snomed" else "clinical_events"
+        return event_query(table, "date", kwargs["returning"], between, first, kwargs["codelist"])
+    if funcname == "with_these_medications":
+        if kwargs["ignore_days_where_these_codes_occur"] or kwargs["episode_defined_as"]:
+            return None
+        return event_query("medications", "date", kwargs["returning"], between, first, kwargs["codelist"])
+    if funcname == "with_high_cost_drugs":
+        return event_query("high_cost_drugs", "date", kwargs["returning"], between, first, kwargs["drug_name_matches"])
+    return None
+
+
+def standin_plan(covariate_definitions):
+    """
+    Returns the stand-in query for each variable with its own query (None for
+    one evaluated at the join), and the variables it can't compute, including
+    those which depend on one it can't
+    """
+    graph = dependencies(covariate_definitions)
+    queries = {}
+    unsupported = []
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        query = None if funcname in JOIN_FUNCTIONS else standin_query(funcname, kwargs)
+        if funcname in ("categorised_as", "value_from") or query is not None:
+            queries[name] = query
+        else:
+            unsupported.append(name)
+    changed = True
+    while changed:
+        changed = False
+        for name in list(queries):
+            if graph[name] - set(queries):
+                del queries[name]
+                unsupported.append(name)
+                changed = True
+    return queries, [name for name in covariate_definitions if name in unsupported]
+
+
+def standin_column(covariate_definitions, results, name, patient_ids):
+    """
+    A variable's values for every patient, with the defaults and date
+    formatting cohortextractor's final join applies
+    """
+    funcname, kwargs = covariate_definitions[name]
+    values = results[name]["value"].reindex(patient_ids)
+    column_type = kwargs["column_type"]
+    if column_type == "date":
+        return values.str[:DATE_FORMAT_LENGTHS[kwargs.get("date_format")]].fillna("")
+    if column_type == "str":
+        return values.fillna("")
+    values = values.fillna(0)
+    return values.astype("float64" if column_type == "float" else "int64")
+
+
+def evaluate_at_join(covariate_definitions, results, name, patient_ids):
+    funcname, kwargs = covariate_definitions[name]
+    if funcname == "value_from":
+        return results[kwargs["source"]][[kwargs["returning"]]].rename(columns={kwargs["returning"]: "value"})
+    used = sorted(dependencies(covariate_definitions)[name])
+    inputs = pd.DataFrame(
+        {used_name: standin_column(covariate_definitions, results, used_name, patient_ids) for used_name in used},
+        index=patient_ids,
+    )
+    for used_name in used:
+        if covariate_definitions[used_name][1]["column_type"] == "bool":
+            inputs[used_name] = inputs[used_name].astype(bool)
+    categories = kwargs["category_definitions"]
+    default = next((category for category, expression in categories.items() if expression == "DEFAULT"), None)
+    conditions = {
+        category: inputs.eval(sql_expression(" ".join(expression.split()))).astype(bool).values
+        for category, expression in categories.items()
+        if expression != "DEFAULT"
+    }
+    values = np.select(list(conditions.values()), list(conditions), default)
+    return pd.DataFrame({"value": values}, index=patient_ids)
+
+
+def standin_extract(database, covariate_definitions, workers=4, latency=0.0):
+    """
+    Extracts the variables the stand-in supports from the synthetic database,
+    dispatching them as `ConcurrentDispatcher` does against the backend
+
+    Each query gets its own pooled SQLite connection, and first sleeps for
+    `latency` seconds to model the round trip and queueing on a remote server.
+    Variables evaluated in the final join are tasks too, once the variables
+    they use are done. Returns the extract as a dataframe and each task's
+    (start, end) times.
+    """
+    queries, unsupported = standin_plan(covariate_definitions)
+    with sqlite3.connect(database) as connection:
+        patient_ids = pd.Index(
+            pd.read_sql("SELECT patient_id FROM patients ORDER BY patient_id", connection)["patient_id"],
+            name="patient_id",
+        )
+    pool = ConnectionPool(lambda: sqlite3.connect(database, check_same_thread=False), workers)
+    results = {}
+
+    def run(name):
+        if queries[name] is None:
+            results[name] = evaluate_at_join(covariate_definitions, results, name, patient_ids)
+            return
+        with pool.connection() as connection:
+            time.sleep(latency)
+            results[name] = pd.read_sql(queries[name], connection).set_index("patient_id")
+
+    try:
+        timings = dispatch(list(queries), task_dependencies(covariate_definitions, queries), run, workers)
+    finally:
+        pool.close()
+
+    columns = [name for name in output_columns(covariate_definitions) if name in queries]
+    extract = pd.DataFrame(
+        {name: standin_column(covariate_definitions, results, name, patient_ids) for name in columns},
+        index=patient_ids,
+    )
+    if "population" in queries:
+        extract = extract[standin_column(covariate_definitions, results, "population", patient_ids).astype(bool)]
+    if unsupported:
+        logger.info(f"Not supported by the stand-in: {', '.join(unsupported)}")
+    return extract, timings
+
+
+def compare_standin(study, directory, patients, workers, seed=0, latency=0.0):
+    """
+    Runs the stand-in extract one task at a time and then concurrently,
+    checking the outputs are identical
+    """
+    definitions = study.covariate_definitions
+    directory = Path(directory)
+    database = directory / f"benchmark-{patients}-{seed}.sqlite"
+    build_database(database, definitions, patients, seed)
+
+    elapsed = {}
+    extracts = {}
+    for label, worker_count in [("serial", 1), ("concurrent", workers)]:
+        start = time.perf_counter()
+        extracts[label], timings = standin_extract(database, definitions, worker_count, latency)
+        elapsed[label] = time.perf_counter() - start
+        logger.info(f"{label}: {len(timings)} tasks over {worker_count} connections in {elapsed[label]:.2f}s")
+    if not extracts["serial"].equals(extracts["concurrent"]):
+        raise RuntimeError("Concurrent stand-in extract differs from the serial one")
+    extracts["concurrent"].to_csv(directory / "concurrent_extract.csv")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract the cohort with independent variables' queries running concurrently"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    extract = subparsers.add_parser("extract", help="run the extract against the database")
+    extract.add_argument("--output", default="output/input.csv")
+    extract.add_argument("--workers", type=int, default=4, help="connections to the database")
+    standin = subparsers.add_parser("standin", help="check serial and concurrent dispatch agree on a local database")
+    standin.add_argument("--patients", type=int, default=10_000)
+    standin.add_argument("--seed", type=int, default=0)
+    standin.add_argument("--workers", type=int, default=4)
+    standin.add_argument("--latency", type=float, default=0.0, help="seconds each query waits before it runs")
+    standin.add_argument("--dir", default=str(DEFAULT_DIR), help="where to keep the database and output")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    from study_definition import study
+
+    if args.command == "extract":
+        study.assert_backend_is_configured()
+        ConcurrentDispatcher(study, args.workers).run(args.output)
+    elif args.command == "standin":
+        elapsed = compare_standin(study, args.dir, args.patients, args.workers, args.seed, args.latency)
+        print(
+            f"serial {elapsed['serial']:.2f}s, concurrent {elapsed['concurrent']:.2f}s "
+            f"({elapsed['serial'] / elapsed['concurrent']:.2f}x), outputs identical"
+        )
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
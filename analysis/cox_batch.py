@@ -0,0 +1,469 @@
+import argparse
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from cohort_index import COHORTS, DEFAULT_INDEX_DIR, CohortIndex
+from derived_covariates import STATA_EPOCH
+
+
+logger = logging.getLogger(__name__)
+
+# As Stata dates, which is how the cohort index holds dates
+ENTER_DATE = float((np.datetime64("2020-03-01", "D") - STATA_EPOCH).astype("int64"))
+CENSOR_DATE = float((np.datetime64("2020-09-01", "D") - STATA_EPOCH).astype("int64"))
+DAYS_PER_YEAR = 365.25
+
+# Outcome name -> (stop date, failure flag), as set up before `stset`
+OUTCOMES = {
+    "died": ("died_ons_date", "died_ons_covid_flag_any"),
+    "hospital": ("hosp_admit_date_covid", "hosp_admit_covid"),
+    "icuordeath": ("icu_or_death_covid_date", "icu_or_death_covid"),
+    "icu_sens": ("icu_admit_date_covid_sens", "icu_covid_sens"),
+}
+
+# Covariate sets, written as in the do-files: `i.` marks a categorical
+# variable, which is expanded into indicators with the lowest level as the
+# base. The spline models' `age(age1 age2 age3)` are the `mkspline` terms.
+MODELS = {
+    "crude": "",
+    "agesex": "i.agegroup male",
+    "adjusted_imid_conf": "i.agegroup male i.imd i.smoke_nomiss",
+    "adjusted_imid_med": "i.agegroup male i.imd i.smoke_nomiss i.obese4cat chronic_cardiac_disease i.diabcat steroidcat",
+    "adjusted_imid_sens_one": "i.agegroup male i.imd i.smoke_nomiss ethnicity",
+    "adjusted_imid_sens_two": "i.agegroup male i.imd i.smoke_nomiss i.ckd chronic_liver_disease chronic_respiratory_disease",
+    "adjusted_imid_sens_three": "i.agegroup male i.imd i.smoke",
+    "adjusted_drugs_conf": "i.agegroup male i.imd i.smoke_nomiss i.obese4cat chronic_cardiac_disease i.diabcat cancer stroke i.ckd chronic_liver_disease chronic_respiratory_disease bowel skin joint",
+    "adjusted_drugs_med": "i.agegroup male i.imd i.smoke_nomiss i.obese4cat chronic_cardiac_disease i.diabcat cancer stroke i.ckd chronic_liver_disease chronic_respiratory_disease bowel skin joint steroidcat",
+    "adjusted_drugs_sens_one": "i.agegroup male i.imd i.smoke_nomiss i.obese4cat chronic_cardiac_disease i.diabcat cancer stroke i.ckd chronic_liver_disease chronic_respiratory_disease bowel skin joint ethnicity",
+    "adjusted_drugs_sens_three": "i.agegroup male i.imd i.smoke i.bmicat chronic_cardiac_disease i.diabcat cancer stroke i.ckd chronic_liver_disease chronic_respiratory_disease bowel skin joint",
+    "agesex_spline": "age1 age2 age3 male",
+    "adjusted_sensitivity_four": "age1 age2 age3 male i.imd i.obese4cat i.smoke_nomiss bowel skin joint chronic_cardiac_disease cancer stroke i.diabcat steroidcat",
+    "adjusted_imid_conf_spline": "age1 age2 age3 male i.imd i.smoke_nomiss",
+    "adjusted_drugs_conf_spline": "age1 age2 age3 male i.imd i.smoke_nomiss i.obese4cat chronic_cardiac_disease i.diabcat cancer stroke i.ckd chronic_liver_disease chronic_respiratory_disease bowel skin joint",
+}
+
+# One summary file per cohort for each analysis. `base_cohort` is the dataset
+# the do-file loads (None for the exposure's own cohort file) and `exclude`
+# drops patients with any of the given flags before `stset`. Models which fail
+# to fit are left out of the summary when the do-file wraps them in `capture`
+# (`skip_failed`), and are otherwise written with a missing hazard ratio.
+# `cohorts` lists the cohorts the study runs the analysis for (None for all).
+Analysis = namedtuple(
+    "Analysis", ["output", "models", "outcomes", "base_cohort", "exclude", "by_ethnicity", "skip_failed", "cohorts"]
+)
+
+ALL_OUTCOMES = ["died", "hospital", "icuordeath", "icu_sens"]
+HAEMONC_OUTCOMES = ["died", "hospital", "icuordeath"]
+HAEMONC_EXCLUDE = ["haem_cancer", "organ_transplant"]
+SPLINE_MODELS = ["agesex_spline", "adjusted_sensitivity_four", "adjusted_imid_conf_spline", "adjusted_drugs_conf_spline"]
+# project.yaml only runs 500_cox_models_ethnic.do for the disease cohorts
+ETHNIC_COHORTS = ["imid", "joint", "skin", "bowel"]
+
+ANALYSES = {
+    # 202_cox_models.do
+    "cox_models": Analysis(
+        "cox_model_summary_{cohort}",
+        [
+            "crude", "agesex", "adjusted_imid_conf", "adjusted_imid_med", "adjusted_drugs_conf",
+            "adjusted_drugs_med", "adjusted_imid_sens_one", "adjusted_imid_sens_two",
+            "adjusted_imid_sens_three", "adjusted_drugs_sens_one", "adjusted_drugs_sens_three",
+        ],
+        ALL_OUTCOMES, "imid", [], False, False, None,
+    ),
+    "cox_models_haemonc": Analysis(
+        "cox_model_summary_haemonc_{cohort}",
+        ["adjusted_imid_conf", "adjusted_drugs_conf"],
+        HAEMONC_OUTCOMES, "imid", HAEMONC_EXCLUDE, False, False, None,
+    ),
+    # 402_cox_models_agespline.do
+    "cox_spline": Analysis(
+        "cox_spline_summary_{cohort}", SPLINE_MODELS, ALL_OUTCOMES, None, [], False, False, None,
+    ),
+    "cox_spline_haemonc": Analysis(
+        "cox_spline_summary_haemonc_{cohort}", SPLINE_MODELS, HAEMONC_OUTCOMES, None, HAEMONC_EXCLUDE, False, True, None,
+    ),
+    # 500_cox_models_ethnic.do
+    "cox_models_ethnic": Analysis(
+        "cox_model_summary_{cohort}_ethnicity_{ethnicity}",
+        [
+            "crude", "agesex", "adjusted_imid_conf", "adjusted_imid_med", "adjusted_drugs_conf",
+            "adjusted_drugs_med", "adjusted_imid_sens_two", "adjusted_imid_sens_three",
+            "adjusted_drugs_sens_three",
+        ],
+        ALL_OUTCOMES, None, [], True, False, ETHNIC_COHORTS,
+    ),
+    "cox_models_ethnic_haemonc": Analysis(
+        "cox_model_summary_haemonc_{cohort}_ethnicity_{ethnicity}",
+        ["adjusted_imid_conf", "adjusted_drugs_conf"],
+        HAEMONC_OUTCOMES, None, HAEMONC_EXCLUDE, True, False, ETHNIC_COHORTS,
+    ),
+}
+
+ETHNICITIES = ["1", "2", "3", "4", "5", "u"]
+
+SUMMARY_COLUMNS = [
+    "cohort", "model", "failure",
+    "ptime_exposed", "events_exposed", "rate_exposed",
+    "ptime_comparator", "events_comparator", "rate_comparator",
+    "hr", "lc", "uc",
+]
+
+
+def parse_terms(model):
+    """
+    Splits a covariate set into (variable, is_categorical) pairs
+    """
+    return [
+        (term[2:], True) if term.startswith("i.") else (term, False)
+        for term in MODELS[model].split()
+    ]
+
+
+def model_variables(models):
+    return sorted({name for model in models for name, _ in parse_terms(model)})
+
+
+def survival_times(df, outcome):
+    """
+    Years from cohort entry to the end of follow-up for `outcome`, and whether
+    it ended in a failure, as `stset ... origin(time enter_date) scale(365.25)`
+
+    Stop dates are Stata dates, so events on the entry date keep the half day
+    000_define_covariates.do adds to them.
+    """
+    stop_column, failure_column = OUTCOMES[outcome]
+    stop = df[stop_column].values.astype("float64")
+    stop = np.where(np.isnan(stop) | (stop > CENSOR_DATE), CENSOR_DATE, stop)
+    days = stop - ENTER_DATE
+    # As in the do-files, a failure flag counts even when the event is after
+    # the censoring date
+    failed = df[failure_column].values == 1
+    return days / DAYS_PER_YEAR, failed
+
+
+def design_matrix(df, exposure, terms, sample):
+    """
+    Builds the design matrix for `exposure` plus `terms` over the rows in
+    `sample` which have no missing values
+
+    As in Stata, categorical terms get an indicator per level apart from the
+    lowest, and columns which are constant or collinear with earlier columns are
+    omitted. Returns the matrix and the mask of rows used.
+    """
+    used = sample & df[exposure].notna().values
+    for name, _ in terms:
+        used &= df[name].notna().values
+    if not used.any():
+        raise ValueError("no observations")
+    columns = [df[exposure].values[used].astype("float64")]
+    for name, categorical in terms:
+        values = df[name].values[used].astype("float64")
+        if categorical:
+            levels = np.unique(values)
+            columns.extend((values == level).astype("float64") for level in levels[1:])
+        else:
+            columns.append(values)
+    X = np.column_stack(columns)
+
+    # Keep the exposure (first column) and each later column which adds to
+    # the rank of those already kept
+    centred = X - X.mean(axis=0)
+    if len(centred) < centred.shape[1]:
+        # Pad with zero rows so R has a diagonal entry for every column
+        centred = np.vstack([centred, np.zeros((centred.shape[1] - len(centred), centred.shape[1]))])
+    r = np.abs(np.diag(np.linalg.qr(centred, mode="r")))
+    keep = r > 1e-8 * max(r.max(), 1.0)
+    if not keep[0]:
+        raise ValueError(f"{exposure} is constant in the estimation sample")
+    return X[:, keep], used
+
+
+class BreslowCox:
+    """
+    Cox proportional hazards likelihood with Breslow ties
+
+    Risk set sums are accumulated once per distinct time with cumulative sums,
+    so each Newton step, and the score residuals, cost a few passes over the
+    data, as opposed to `statsmodels.PHReg`'s loop over risk sets.
+    """
+
+    def __init__(self, time, failed, X):
+        self.X = X
+        self.failed = failed.astype("float64")
+        self.times, self.inverse = np.unique(time, return_inverse=True)
+        self.events = np.bincount(self.inverse, weights=self.failed, minlength=len(self.times))
+
+    def _reverse_cumsum(self, weights):
+        return np.bincount(self.inverse, weights=weights, minlength=len(self.times))[::-1].cumsum()[::-1]
+
+    def risk_sets(self, params):
+        """
+        Returns each patient's relative risk, and the risk set total (S0) and
+        mean covariates (xbar) at each distinct time
+        """
+        risk = np.exp(self.X @ params)
+        s0 = self._reverse_cumsum(risk)
+        s1 = np.column_stack([self._reverse_cumsum(risk * column) for column in self.X.T])
+        return risk, s0, s1 / s0[:, None]
+
+    def loglike(self, params):
+        risk, s0, _ = self.risk_sets(params)
+        return self.failed @ (self.X @ params) - self.events @ np.log(s0)
+
+    def score_and_information(self, params):
+        risk, s0, xbar = self.risk_sets(params)
+        score = self.failed @ self.X - self.events @ xbar
+        # Sum over event times of d * (S2/S0 - xbar xbar'), with the S2 terms
+        # collected per patient as one weighted cross product
+        cumulative = np.cumsum(self.events / s0)[self.inverse]
+        information = (self.X * (risk * cumulative)[:, None]).T @ self.X - (xbar * self.events[:, None]).T @ xbar
+        return score, information
+
+    def fit(self, max_iterations=50, tolerance=1e-9):
+        """
+        Maximises the likelihood by Newton's method
+
+        Stops once the likelihood changes by less than `tolerance` (relative)
+        and the exposure's (first) coefficient has settled. Other coefficients
+        may still be heading off to infinity, say for a covariate level with no
+        failures, which leaves the exposure's estimate unaffected, as in
+        Stata. Raises ValueError if the fit doesn't converge within
+        `max_iterations`, as when the exposure's own estimate runs off to
+        infinity, or the estimates stop being finite.
+        """
+        params = np.zeros(self.X.shape[1])
+        loglike = self.loglike(params)
+        for _ in range(max_iterations):
+            score, information = self.score_and_information(params)
+            step = np.linalg.solve(information, score)
+            # Halve the step until the likelihood improves, allowing for
+            # rounding near the maximum
+            for _ in range(20):
+                candidate = params + step
+                candidate_loglike = self.loglike(candidate)
+                if candidate_loglike >= loglike - tolerance * (abs(loglike) + 1):
+                    break
+                step /= 2
+            else:
+                raise ValueError("the likelihood could not be improved")
+            if not np.all(np.isfinite(candidate)) or not np.isfinite(candidate_loglike):
+                raise ValueError("estimates are not finite")
+            converged = (
+                abs(candidate_loglike - loglike) < tolerance * (abs(loglike) + 1)
+                and abs(step[0]) < 1e-6 * (abs(params[0]) + 1)
+            )
+            params, loglike = candidate, candidate_loglike
+            if converged:
+                return params
+        raise ValueError(f"did not converge in {max_iterations} iterations")
+
+    def score_residuals(self, params):
+        """
+        Per-patient contributions to the score, for the robust variance
+        """
+        risk, s0, xbar = self.risk_sets(params)
+        a = np.cumsum(self.events / s0)
+        b = np.cumsum(self.events[:, None] * xbar / s0[:, None], axis=0)
+        return (
+            self.failed[:, None] * (self.X - xbar[self.inverse])
+            - risk[:, None] * (self.X * a[self.inverse][:, None] - b[self.inverse])
+        )
+
+
+def fit_cox(time, failed, X):
+    """
+    Fits a Cox model with Breslow ties and returns (hr, lc, uc) for the first
+    column, using the robust (sandwich) variance as `stcox ..., vce(robust)`
+    does for one record per patient
+
+    Raises ValueError if there are no failures, the fit doesn't converge or
+    the confidence interval isn't finite and of positive width.
+    """
+    if not failed.any():
+        raise ValueError("no failures")
+    # Overflow and the like show up as non-finite results, which are checked
+    with np.errstate(all="ignore"):
+        model = BreslowCox(time, failed, X)
+        params = model.fit()
+        _, information = model.score_and_information(params)
+        information_inv = np.linalg.inv(information)
+        scores = model.score_residuals(params)
+        n = len(time)
+        cov = information_inv @ (scores.T @ scores) @ information_inv * n / (n - 1)
+        se = np.sqrt(cov[0, 0])
+        z = stats.norm.ppf(0.975)
+        result = np.exp(params[0]), np.exp(params[0] - z * se), np.exp(params[0] + z * se)
+    if not np.all(np.isfinite(result)) or not se > 0:
+        raise ValueError("confidence interval is not finite or has zero width")
+    return result
+
+
+def person_time(time, failed, mask):
+    """
+    (person-years, events, rate) for the rows in `mask`, as `stptime`, with
+    event counts from 1 to 5 redacted
+    """
+    ptime = time[mask].sum()
+    events = int(failed[mask].sum())
+    rate = events / ptime if ptime else np.nan
+    return ptime, events if events == 0 or events > 5 else np.nan, rate
+
+
+def load_data(index, cohort, base_cohort, columns):
+    # The models work on floats, with missing values as NaN
+    return index.cohort(base_cohort or cohort, columns=columns).astype("float64")
+
+
+def run_analysis(df, analysis, cohort, ethnicity=None):
+    """
+    Fits every outcome and model of `analysis` for one cohort, returning the
+    summary rows
+    """
+    sample = np.ones(len(df), dtype=bool)
+    for name in analysis.exclude:
+        sample &= df[name].values != 1
+    if analysis.by_ethnicity:
+        if ethnicity == "u":
+            sample &= df["ethnicity"].isna().values
+        else:
+            sample &= df["ethnicity"].values == int(ethnicity)
+
+    exposure = df[cohort].values
+    # Design matrices only depend on the sample, so are built once and shared
+    # between outcomes
+    designs = {}
+    for model in analysis.models:
+        try:
+            designs[model] = design_matrix(df, cohort, parse_terms(model), sample)
+        except ValueError as e:
+            designs[model] = e
+
+    rows = []
+    for outcome in analysis.outcomes:
+        time, failed = survival_times(df, outcome)
+        in_followup = sample & (time > 0)
+        exposed = person_time(time, failed, in_followup & (exposure == 1))
+        comparator = person_time(time, failed, in_followup & (exposure == 0))
+        for model, design in designs.items():
+            try:
+                if isinstance(design, ValueError):
+                    raise design
+                X, used = design
+                rows_used = used & in_followup
+                hr, lc, uc = fit_cox(time[rows_used], failed[rows_used], X[in_followup[used]])
+            except (ValueError, np.linalg.LinAlgError) as e:
+                logger.warning(f"{cohort} {model} {outcome}: {e}")
+                if analysis.skip_failed:
+                    continue
+                hr = lc = uc = np.nan
+            rows.append([cohort, model, outcome, *exposed, *comparator, hr, lc, uc])
+    return pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+
+
+def write_summary(summary, filename):
+    summary = summary.copy()
+    for column in SUMMARY_COLUMNS[3:]:
+        # postfile stores results as floats, and Stata has no infinity, so
+        # anything too large for a float is written as missing
+        with np.errstate(over="ignore"):
+            values = summary[column].astype("float32")
+        summary[column] = values.where(np.isfinite(values))
+    summary.to_stata(filename, write_index=False)
+
+
+_index = None
+
+
+def _init_worker(index_dir):
+    global _index
+    _index = CohortIndex(index_dir)
+
+
+def run_cohort(task):
+    """
+    Runs every requested analysis for one cohort (and ethnicity), loading each
+    dataset the analyses need once and sharing it between them
+    """
+    cohort, ethnicity, analysis_names, output_dir = task
+    analyses = [ANALYSES[name] for name in analysis_names]
+    columns = sorted(
+        set(model_variables(model for analysis in analyses for model in analysis.models))
+        | {column for outcome in OUTCOMES.values() for column in outcome}
+        | set(HAEMONC_EXCLUDE)
+        | {cohort, "ethnicity"}
+    )
+    datasets = {}
+    written = []
+    for name, analysis in zip(analysis_names, analyses):
+        if analysis.base_cohort not in datasets:
+            datasets[analysis.base_cohort] = load_data(_index, cohort, analysis.base_cohort, columns)
+        summary = run_analysis(datasets[analysis.base_cohort], analysis, cohort, ethnicity)
+        filename = Path(output_dir) / (analysis.output.format(cohort=cohort, ethnicity=ethnicity) + ".dta")
+        write_summary(summary, filename)
+        written.append(str(filename))
+    return written
+
+
+def build_tasks(analysis_names, cohorts, ethnicities, output_dir):
+    """
+    One task per cohort (and ethnicity), each running the analyses the study
+    runs for that cohort
+    """
+    tasks = []
+    for cohort in cohorts:
+        names = [
+            name for name in analysis_names
+            if ANALYSES[name].cohorts is None or cohort in ANALYSES[name].cohorts
+        ]
+        plain = [name for name in names if not ANALYSES[name].by_ethnicity]
+        by_ethnicity = [name for name in names if ANALYSES[name].by_ethnicity]
+        if plain:
+            tasks.append((cohort, None, plain, output_dir))
+        if by_ethnicity:
+            tasks.extend((cohort, ethnicity, by_ethnicity, output_dir) for ethnicity in ethnicities)
+    return tasks
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fit the Cox models for many cohorts at once, in parallel"
+    )
+    parser.add_argument("--analyses", nargs="+", choices=list(ANALYSES), default=["cox_models", "cox_models_haemonc"])
+    parser.add_argument("--cohorts", nargs="+", choices=COHORTS, default=COHORTS)
+    parser.add_argument("--ethnicities", nargs="+", choices=ETHNICITIES, default=ETHNICITIES)
+    parser.add_argument("--index-dir", default=str(DEFAULT_INDEX_DIR))
+    parser.add_argument("--output-dir", default=os.path.join("output", "cox_batch"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    tasks = build_tasks(args.analyses, args.cohorts, args.ethnicities, args.output_dir)
+    failed = []
+    with ProcessPoolExecutor(args.workers, initializer=_init_worker, initargs=(args.index_dir,)) as pool:
+        # One cohort's error shouldn't stop the others' summaries being written
+        futures = {pool.submit(run_cohort, task): task for task in tasks}
+        for future in as_completed(futures):
+            cohort, ethnicity = futures[future][:2]
+            name = cohort if ethnicity is None else f"{cohort} (ethnicity {ethnicity})"
+            try:
+                written = future.result()
+            except Exception:
+                logger.exception(f"Failed to fit the models for {name}")
+                failed.append(name)
+                continue
+            for filename in written:
+                logger.info(f"Wrote {filename}")
+    if failed:
+        raise SystemExit(f"Failed to fit the models for {', '.join(sorted(failed))}")
+
+
+if __name__ == "__main__":
+    main()
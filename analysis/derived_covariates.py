@@ -0,0 +1,837 @@
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pandas.io.stata import StataWriterUTF8
+
+from cohort_index import COHORTS
+from columnar import DATE_EPOCH, read_cohort
+
+
+DEFAULT_INPUT = Path("output") / "input.parquet"
+
+INDEX_DATE = np.datetime64("2020-03-01", "D")
+
+# Stata dates are days since 1960-01-01. Dates are held in this form throughout,
+# so that the half day added to events on the index date is kept.
+STATA_EPOCH = np.datetime64("1960-01-01", "D")
+STATA_DATE_OFFSET = float((DATE_EPOCH - STATA_EPOCH).astype("int64"))
+
+RENAMES = {"inflammatory_bowel_disease_unclassified": "ibd_uncla"}
+
+DROPPED = ["ckd", "ethnicity_date", "mepolizumab_3m_0m", "mepolizumab_6m_3m"]
+
+# Dates extracted to the month, which are placed on the 15th
+MONTH_DATES = [
+    "crohns_disease",
+    "ulcerative_colitis",
+    "ibd_uncla",
+    "psoriasis",
+    "hidradenitis_suppurativa",
+    "psoriatic_arthritis",
+    "rheumatoid_arthritis",
+    "ankylosing_spondylitis",
+    "chronic_cardiac_disease",
+    "hba1c_new",
+    "hba1c_old",
+    "hba1c_mmol_per_mol_date",
+    "hba1c_percentage_date",
+    "diabetes",
+    "hypertension",
+    "chronic_respiratory_disease",
+    "esrf",
+    "copd",
+    "chronic_liver_disease",
+    "stroke",
+    "lung_cancer",
+    "haem_cancer",
+    "other_cancer",
+    "creatinine_date",
+    "organ_transplant",
+    "bmi_date_measured",
+]
+
+# Dates extracted to the day. The do-file adds 15 days to these too.
+DAY_DATES = ["icu_date_admitted", "died_date_ons", "first_pos_test_sgss", "hospital_admission_date"]
+
+# Converted dates which aren't named <variable>_date
+DATE_NAMES = {
+    "icu_date_admitted": "icu_admitted_date",
+    "bmi_date_measured": "bmi_measured_date",
+    "died_date_ons": "died_ons_date",
+    "creatinine_date": "creatinine_measured_date",
+    "hba1c_mmol_per_mol_date": "hba1c_mmol_per_mol_date",
+    "hba1c_percentage_date": "hba1c_percentage_date",
+    "hospital_admission_date": "hospital_admission_date",
+}
+
+# Dates which get a 0/1 indicator of the same name without `_date`
+INDICATOR_DATES = [
+    "crohns_disease_date",
+    "ulcerative_colitis_date",
+    "ibd_uncla_date",
+    "psoriasis_date",
+    "hidradenitis_suppurativa_date",
+    "psoriatic_arthritis_date",
+    "rheumatoid_arthritis_date",
+    "ankylosing_spondylitis_date",
+    "chronic_cardiac_disease_date",
+    "hypertension_date",
+    "chronic_respiratory_disease_date",
+    "copd_date",
+    "chronic_liver_disease_date",
+    "stroke_date",
+    "lung_cancer_date",
+    "haem_cancer_date",
+    "other_cancer_date",
+    "diabetes_date",
+    "esrf_date",
+    "creatinine_measured_date",
+    "organ_transplant_date",
+    "bmi_measured_date",
+    "icu_admitted_date",
+    "died_ons_date",
+    "hospital_admission_date",
+    "first_pos_test_sgss_date",
+]
+
+# The diagnoses in each specialty, of which only the most recent is kept
+SPECIALTIES = {
+    "bowel": ["ibd_uncla", "ulcerative_colitis", "crohns_disease"],
+    "skin": ["psoriasis", "hidradenitis_suppurativa"],
+    "joint": ["rheumatoid_arthritis", "psoriatic_arthritis", "ankylosing_spondylitis"],
+}
+
+WINDOWS = ["3m_0m", "6m_3m"]
+
+# Drug counts and flags where a missing value means no issues
+DRUG_VARIABLES = [
+    f"{drug}_{window}"
+    for drug in [
+        "oral_prednisolone",
+        "adalimumab",
+        "abatacept",
+        "certolizumab",
+        "etanercept",
+        "golimumab",
+        "infliximab",
+        "sarilumab",
+        "tocilizumab",
+        "ustekinumab",
+        "guselkumab",
+        "tildrakizumab",
+        "risankizumab",
+        "secukinumab",
+        "ixekizumab",
+        "brodalumab",
+        "baricitinib",
+        "tofacitinib",
+        "rituximab",
+        "azathioprine",
+        "ciclosporin",
+        "gold",
+        "leflunomide",
+        "mercaptopurine",
+        "methotrexate",
+        "methotrexate_inj",
+        "methotrexate_hcd",
+        "mycophenolate",
+        "penicillamine",
+        "sulfasalazine",
+        "mesalazine",
+        "vedolizumab",
+    ]
+    for window in WINDOWS
+] + ["rituximab_12m_6m"]
+
+STANDARD_SYSTEMIC = [
+    "azathioprine",
+    "ciclosporin",
+    "leflunomide",
+    "mercaptopurine",
+    "methotrexate",
+    "methotrexate_inj",
+    "methotrexate_hcd",
+    "mycophenolate",
+    "sulfasalazine",
+    "mesalazine",
+]
+
+# High cost drug groups: name -> (drugs, windows, diagnoses which make a
+# patient eligible for the group)
+HIGH_COST_GROUPS = {
+    "tnf": (["adalimumab", "certolizumab", "etanercept", "golimumab", "infliximab"], WINDOWS, ["imid"]),
+    "il23": (["ustekinumab", "guselkumab", "tildrakizumab", "risankizumab"], WINDOWS, ["imid"]),
+    "jaki": (["baricitinib", "tofacitinib"], WINDOWS, ["imid"]),
+    "ritux": (["rituximab"], WINDOWS + ["12m_6m"], ["rheumatoid_arthritis"]),
+    "il6": (["sarilumab", "tocilizumab"], WINDOWS, ["rheumatoid_arthritis"]),
+    "il17": (["secukinumab", "ixekizumab", "brodalumab"], WINDOWS, ["psoriatic_arthritis", "ankylosing_spondylitis", "psoriasis"]),
+}
+
+# Cohorts whose comparator group is dropped for patients on another high cost
+# drug
+EXCLUSIVE_COHORTS = [
+    "standtnf",
+    "standtnf3m",
+    "standil6",
+    "standil17",
+    "standil23",
+    "standjaki",
+    "standritux",
+    "standinflix",
+    "standvedolizumab",
+    "standabatacept",
+]
+
+# Columns which are continuous, and saved as floats. Everything else apart
+# from dates and `sex` holds whole numbers and is saved as the smallest
+# integer type which fits.
+FLOAT_COLUMNS = [
+    "creatinine",
+    "bmi",
+    "age1",
+    "age2",
+    "age3",
+    "bmi_time",
+    "bmi_age",
+    "SCr_adj",
+    "min",
+    "max",
+    "egfr",
+    "hosp_admit_diff",
+]
+
+# Columns whose missing values are Stata's `.u` ("Unknown") rather than `.`.
+# Where only some of them are (the do-file only makes an IMD of -1 `.u`), the
+# dataset's `attrs["unknown"]` holds a mask of the `.u` rows, indexed like the
+# dataset.
+UNKNOWN_MISSING = ["ethnicity", "imd", "bmicat", "smoke", "egfr_cat"]
+
+VALUE_LABELS = {
+    "ethnicity": {1: "White", 2: "South Asian", 3: "Black", 4: "Mixed", 5: "Other"},
+    "imd": {1: "1 least deprived", 2: "2", 3: "3", 4: "4", 5: "5 most deprived"},
+    "agegroup": {1: "18-<40", 2: "40-<50", 3: "50-<60", 4: "60-<70", 5: "70-<80", 6: "80+"},
+    "bmicat": {
+        1: "Underweight (<18.5)",
+        2: "Normal (18.5-24.9)",
+        3: "Overweight (25-29.9)",
+        4: "Obese I (30-34.9)",
+        5: "Obese II (35-39.9)",
+        6: "Obese III (40+)",
+    },
+    "obese4cat": {1: "No record of obesity", 2: "Obese I (30-34.9)", 3: "Obese II (35-39.9)", 4: "Obese III (40+)"},
+    "smoke": {1: "Never", 2: "Former", 3: "Current"},
+    "smoke_nomiss": {1: "Never", 2: "Former", 3: "Current"},
+    "egfr_cat": {1: ">=60", 2: "30-59", 3: "<30"},
+    "egfr_cat_nomiss": {1: ">=60/missing", 2: "30-59", 3: "<30"},
+    "ckd": {0: "No CKD", 1: "CKD"},
+    "hba1ccat": {0: "<6.5%", 1: ">=6.5-7.4", 2: ">=7.5-7.9", 3: ">=8-8.9", 4: ">=9"},
+    "diabcat": {1: "No diabetes", 2: "Controlled diabetes", 3: "Uncontrolled diabetes", 4: "Diabetes, no hba1c measure"},
+    "imid": {0: "Gen Pop", 1: "IMID"},
+    "bowel": {0: "Gen Pop", 1: "Bowel"},
+    "skin": {0: "Gen Pop", 1: "Skin"},
+    "joint": {0: "Gen Pop", 1: "Joint"},
+    "tnfmono": {0: "TNF combination", 1: "TNF monotherapy"},
+}
+
+VARIABLE_LABELS = {
+    "egfr": "egfr calculated using CKD-EPI formula with no eth",
+    "ckd": "CKD stage calc without eth",
+    "tnfmono": "TNF strategy",
+}
+
+
+def stata_gt(values, threshold):
+    # Stata's missing values are greater than any number
+    return np.isnan(values) | (values > threshold)
+
+
+def stata_ge(values, threshold):
+    return np.isnan(values) | (values >= threshold)
+
+
+def stata_float(values):
+    """
+    Rounds to single precision, which is how Stata stores a variable created
+    with `gen`
+    """
+    return values.astype("float32").astype("float64")
+
+
+def any_of(data, names, test):
+    return np.logical_or.reduce([test(data[name]) for name in names])
+
+
+def all_of(data, names, test):
+    return np.logical_and.reduce([test(data[name]) for name in names])
+
+
+def flag(condition):
+    """
+    1 where `condition` is true, otherwise missing
+    """
+    return np.where(condition, 1.0, np.nan)
+
+
+def equal_frequency_groups(values, groups):
+    """
+    Codes from 0 for `groups` groups of (nearly) equal size, keeping tied values
+    in the same group, as `egen cut(), group()`
+    """
+    present = values[~np.isnan(values)]
+    if not len(present):
+        return np.full(len(values), np.nan)
+    ordered = np.sort(present)
+    cuts = np.unique(ordered[np.arange(1, groups) * len(ordered) // groups])
+    codes = np.searchsorted(cuts, values, side="right").astype("float64")
+    return np.where(np.isnan(values), np.nan, codes)
+
+
+def stata_percentiles(values, percentiles):
+    """
+    Percentiles by Stata's default (`_pctile`) definition, which averages
+    the two nearest values when the rank is a whole number
+    """
+    ordered = np.sort(values)
+    result = []
+    for percentile in percentiles:
+        rank = len(ordered) * percentile / 100
+        whole = int(np.floor(rank))
+        if rank == whole:
+            result.append((ordered[max(whole - 1, 0)] + ordered[min(whole, len(ordered) - 1)]) / 2)
+        else:
+            result.append(ordered[whole])
+    return result
+
+
+def restricted_cubic_spline(values, knots):
+    """
+    The `mkspline ..., cubic` terms for `knots`: the values themselves, then
+    one term for each knot apart from the last two
+    """
+    def cube(x):
+        return np.maximum(x, 0) ** 3
+
+    first, penultimate, last = knots[0], knots[-2], knots[-1]
+    terms = [values]
+    for knot in knots[:-2]:
+        term = cube(values - knot) - (
+            cube(values - penultimate) * (last - knot) - cube(values - last) * (penultimate - knot)
+        ) / (last - penultimate)
+        terms.append(term / (last - first) ** 2)
+    return terms
+
+
+def working_columns(cohort):
+    """
+    The extract as a dictionary of column name -> array, with numbers as
+    float64 (missing values as NaN), dates as Stata dates and `sex` and
+    `smoking_status` as strings
+    """
+    data = {"patient_id": cohort["patient_id"].to_numpy("int64")}
+    for name in cohort.columns[1:]:
+        values = cohort[name]
+        if name in ("sex", "smoking_status", "stp"):
+            data[name] = values.astype("object").fillna("").to_numpy()
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            data[name] = pd.to_numeric(values.astype("object")).to_numpy("float64", na_value=np.nan)
+        else:
+            data[name] = values.to_numpy("float64", na_value=np.nan)
+    return data
+
+
+def convert_dates(data):
+    """
+    Places month-only dates on the 15th and adds 15 days to full dates, as
+    the do-file does, then adds an indicator for each condition
+    """
+    converted = {}
+    for name, values in data.items():
+        if name in MONTH_DATES or name in DAY_DATES:
+            days = 14 if name in MONTH_DATES else 15
+            name = DATE_NAMES.get(name, f"{name}_date")
+            values = values + STATA_DATE_OFFSET + days
+        converted[name] = values
+        if name in INDICATOR_DATES:
+            converted[name[: -len("_date")]] = (~np.isnan(values)).astype("float64")
+    return converted
+
+
+def derive_demographics(data):
+    sex = data["sex"]
+    data["male"] = np.select([sex == "M", sex == "F"], [1.0, 0.0], np.nan)
+
+    # Reordered by prevalence
+    data["ethnicity"] = pd.Series(data["ethnicity"]).map({1: 1, 2: 4, 3: 2, 4: 3, 5: 5, 6: 4}).to_numpy("float64")
+
+    _, stp = np.unique(data["stp"].astype(str), return_inverse=True)
+    data["stp"] = stp + 1.0
+
+    # IMD quintiles, reversed so that 5 is the most deprived. -1 is unknown,
+    # `.u`; an IMD missing from the extract stays `.`.
+    imd = data["imd"]
+    quintile = equal_frequency_groups(imd, 5) + 1
+    data["imd"] = np.where(imd == -1, np.nan, 6 - quintile)
+    data["imd_unknown"] = imd == -1
+
+
+def sort_by(data, name):
+    """
+    Sorts the rows by a column, as `bysort` does
+
+    Stata leaves the order of tied rows unspecified; they keep their order in
+    the extract here.
+    """
+    order = np.argsort(data[name], kind="stable")
+    return {column: values[order] for column, values in data.items()}
+
+
+def drop_out_of_range_ages(data):
+    age = data["age"]
+    keep = ~((age < 18) | (age > 109))
+    data = {name: values[keep] for name, values in data.items()}
+    if np.isnan(data["age"]).any():
+        raise ValueError("Some patients have no age")
+    return data
+
+
+def derive_age(data):
+    age = data["age"]
+    data["agegroup"] = np.select([age < 40, age < 50, age < 60, age < 70, age < 80], [1.0, 2.0, 3.0, 4.0, 5.0], 6.0)
+    data["age70"] = (age >= 70).astype("float64")
+    knots = stata_percentiles(age, [5, 35, 65, 95])
+    for i, term in enumerate(restricted_cubic_spline(age, knots), start=1):
+        data[f"age{i}"] = stata_float(term)
+
+
+def derive_bmi(data, index_date):
+    bmi = data["bmi"].copy()
+    bmi[(bmi == 0) | ~((bmi >= 10) & (bmi <= 60))] = np.nan
+
+    # Only measurements within 10 years of the index date, at age 16 or over
+    bmi_time = stata_float((index_date - data["bmi_measured_date"]) / 365.25)
+    bmi_age = stata_float(data["age"] - bmi_time)
+    bmi[(bmi_age < 16) | (bmi_time > 10)] = np.nan
+    bmi[np.isnan(data["bmi_measured_date"])] = np.nan
+    data["bmi_measured_date"] = np.where(np.isnan(bmi), np.nan, data["bmi_measured_date"])
+    data["bmi"] = bmi
+    data["bmi_time"] = bmi_time
+    data["bmi_age"] = bmi_age
+
+    bmicat = np.select(
+        [bmi < 18.5, bmi < 25, bmi < 30, bmi < 35, bmi < 40, ~np.isnan(bmi)],
+        [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+        np.nan,
+    )
+    data["bmicat"] = bmicat
+    data["obese4cat"] = np.select([bmicat == 4, bmicat == 5, bmicat == 6], [2.0, 3.0, 4.0], 1.0)
+
+
+def derive_smoking(data):
+    status = data.pop("smoking_status")
+    smoke = np.select([status == "N", status == "E", status == "S"], [1.0, 2.0, 3.0], np.nan)
+    data["smoke"] = smoke
+    # Missing smoking status is assumed to be never smoking
+    data["smoke_nomiss"] = np.where(np.isnan(smoke), 1.0, smoke)
+
+
+def derive_gp_consultations(data):
+    count = data["gp_consult_count"]
+    data["gp_consult_count"] = np.where(np.isnan(count) | (count < 1), 0.0, count)
+    data["gp_consult"] = (data["gp_consult_count"] >= 1).astype("float64")
+
+
+def derive_kidney_function(data):
+    """
+    eGFR from creatinine by the CKD-EPI formula (without ethnicity), and CKD
+    from eGFR or end stage renal failure
+    """
+    creatinine = data["creatinine"].copy()
+    creatinine[~((creatinine >= 20) & (creatinine <= 3000))] = np.nan
+    creatinine[np.isnan(data["creatinine_measured_date"])] = np.nan
+    data["creatinine_measured_date"] = np.where(np.isnan(creatinine), np.nan, data["creatinine_measured_date"])
+    data["creatinine"] = creatinine
+
+    male = data["male"]
+    scr_adj = stata_float(creatinine / 88.4)
+    ratio = stata_float(np.select([male == 0, male == 1], [scr_adj / 0.7, scr_adj / 0.9], np.nan))
+    low = stata_float(np.select([male == 0, male == 1], [ratio ** -0.329, ratio ** -0.411], ratio))
+    low = np.where(low < 1, 1.0, low)
+    high = stata_float(ratio ** -1.209)
+    high = np.where(stata_gt(high, 1), 1.0, high)
+    egfr = stata_float(low * high * 141)
+    egfr = stata_float(egfr * 0.993 ** data["age"])
+    egfr = np.where(male == 0, stata_float(egfr * 1.018), egfr)
+    data["SCr_adj"] = scr_adj
+    data["min"] = low
+    data["max"] = high
+    data["egfr"] = egfr
+
+    breaks = np.array([0, 15, 30, 45, 60, 5000], dtype="float64")
+    in_range = (egfr >= 0) & (egfr < 5000)
+    band = np.clip(np.searchsorted(breaks, egfr, side="right") - 1, 0, 4)
+    data["egfr_cat_all"] = np.where(in_range, breaks[band], np.nan)
+    data["ckd_egfr"] = np.where(in_range, np.array([5.0, 4.0, 3.0, 2.0, 0.0])[band], np.nan)
+
+    egfr_cat = np.select([egfr < 30, egfr < 60, ~np.isnan(egfr)], [3.0, 2.0, 1.0], np.nan)
+    data["egfr_cat"] = egfr_cat
+    # Missing eGFR is assumed to be normal
+    data["egfr_cat_nomiss"] = np.where(np.isnan(egfr_cat), 1.0, egfr_cat)
+    data["egfr_date"] = data["creatinine_measured_date"]
+
+    ckd_egfr = data["ckd_egfr"]
+    data["ckd"] = ((ckd_egfr >= 1) | (data["esrf"] == 1)).astype("float64")
+    data["temp1_ckd_date"] = np.where(stata_ge(ckd_egfr, 1), data["creatinine_measured_date"], np.nan)
+    data["temp2_ckd_date"] = np.where(data["esrf"] == 1, data["esrf_date"], np.nan)
+    data["ckd_date"] = np.fmax(data["temp1_ckd_date"], data["temp2_ckd_date"])
+
+
+def derive_diabetes(data, index_date):
+    """
+    Diabetes split by HbA1c control, from a measurement in the 15 months
+    before the index date
+    """
+    values = {}
+    for name in ["hba1c_percentage", "hba1c_mmol_per_mol"]:
+        value = data.pop(name).copy()
+        date = data[f"{name}_date"]
+        value[value <= 0] = np.nan
+        value[(index_date - date) > 15 * 30] = np.nan
+        data[f"{name}_date"] = np.where(np.isnan(value), np.nan, date)
+        values[name] = value
+
+    mmol = values["hba1c_mmol_per_mol"]
+    pct = stata_float(np.where(np.isnan(mmol), values["hba1c_percentage"], mmol / 10.929 + 2.15))
+    pct[~((pct >= 0) & (pct <= 20))] = np.nan
+    pct = stata_float(np.floor(pct / 0.1 + 0.5) * 0.1)
+
+    hba1ccat = np.select(
+        [pct < 6.5, pct < 7.5, pct < 8, pct < 9, ~np.isnan(pct)],
+        [0.0, 1.0, 2.0, 3.0, 4.0],
+        np.nan,
+    )
+    data["hba1ccat"] = hba1ccat
+    diabetes = data["diabetes"]
+    data["diabcat"] = np.select(
+        [diabetes == 0, (diabetes == 1) & (hba1ccat <= 1), (diabetes == 1) & (hba1ccat >= 2), diabetes == 1],
+        [1.0, 2.0, 3.0, 4.0],
+        np.nan,
+    )
+
+
+def derive_comorbidities(data):
+    data["cancer"] = any_of(data, ["lung_cancer", "haem_cancer", "other_cancer"], lambda x: x == 1).astype("float64")
+    data["combined_cv_comorbid"] = flag(any_of(data, ["chronic_cardiac_disease", "stroke"], lambda x: x == 1))
+
+
+def derive_populations(data):
+    """
+    Keeps only the most recent diagnosis within each specialty, then groups
+    patients into IMID, bowel, skin and joint populations
+    """
+    for names in SPECIALTIES.values():
+        for name in names:
+            date = data[f"{name}_date"]
+            others = [f"{other}_date" for other in names if other != name]
+            data[name] = np.where(any_of(data, others, lambda x: x > date), 0.0, data[name])
+
+    diagnoses = [name for names in SPECIALTIES.values() for name in names]
+    data["imid"] = any_of(data, diagnoses, lambda x: x == 1).astype("float64")
+    for specialty, names in SPECIALTIES.items():
+        data[specialty] = any_of(data, names, lambda x: x == 1).astype("float64")
+
+
+def derive_exposures(data):
+    """
+    Each high cost drug group (for patients with an eligible diagnosis)
+    against standard systemic treatment, over the last 6 months and the last 3
+    """
+    for name in DRUG_VARIABLES:
+        data[name] = np.where(np.isnan(data[name]), 0.0, data[name])
+    not_imid = data["imid"] != 1
+
+    standsys = flag(any_of(data, [f"{drug}_{window}" for drug in STANDARD_SYSTEMIC for window in WINDOWS], lambda x: stata_ge(x, 1)))
+    standsys[not_imid] = np.nan
+    standsys3m = flag(any_of(data, [f"{drug}_3m_0m" for drug in STANDARD_SYSTEMIC], lambda x: stata_ge(x, 1)))
+    standsys3m[not_imid] = np.nan
+    data["standsys"] = standsys
+    data["standsys3m"] = standsys3m
+
+    def against_standard(exposed, standard):
+        return np.select([exposed == 1, (standard == 1) & (exposed != 1)], [1.0, 0.0], np.nan)
+
+    inflix = flag(any_of(data, [f"infliximab_{window}" for window in WINDOWS], lambda x: x != 0))
+    inflix[not_imid] = np.nan
+    data["inflix"] = inflix
+    data["standinflix"] = against_standard(inflix, standsys)
+
+    for group, (drugs, windows, eligible) in HIGH_COST_GROUPS.items():
+        exposed = flag(any_of(data, [f"{drug}_{window}" for drug in drugs for window in windows], lambda x: x != 0))
+        exposed[all_of(data, eligible, lambda x: x != 1)] = np.nan
+        data[group] = exposed
+        if group == "tnf":
+            data["tnfmono"] = np.select([(exposed == 1) & (standsys != 1), (exposed == 1) & (standsys == 1)], [1.0, 0.0], np.nan)
+        data[f"stand{group}"] = against_standard(exposed, standsys)
+        recent = [f"{drug}_3m_0m" for drug in drugs]
+        data[f"stand{group}3m"] = np.select(
+            [any_of(data, recent, lambda x: x == 1), all_of(data, recent, lambda x: x != 1) & (standsys3m == 1)],
+            [1.0, 0.0],
+            np.nan,
+        )
+
+    mesalazine = flag(any_of(data, [f"mesalazine_{window}" for window in WINDOWS], lambda x: x >= 1))
+    mesalazine[not_imid] = np.nan
+    data["mesalazine"] = mesalazine
+    # As in the do-file, `mesalazine >= 1` is also true where mesalazine is
+    # missing
+    data["standmesalazine"] = np.select([stata_ge(mesalazine, 1), (standsys == 1) & (mesalazine == 0)], [1.0, 0.0], np.nan)
+    recent = data["mesalazine_3m_0m"]
+    data["standmesalazine3m"] = np.select([recent >= 1, (recent == 0) & (standsys3m == 1)], [1.0, 0.0], np.nan)
+
+    for drug, population, standard in [("vedolizumab", "bowel", standsys3m), ("abatacept", "rheumatoid_arthritis", standsys)]:
+        exposed = flag(any_of(data, [f"{drug}_{window}" for window in WINDOWS], lambda x: x == 1))
+        ineligible = data[population] != 1
+        exposed[ineligible] = np.nan
+        data[drug] = exposed
+        data[f"stand{drug}"] = np.where(ineligible, np.nan, against_standard(exposed, standard))
+
+    prednisolone = data["oral_prednisolone_3m_0m"]
+    data["steroidcat"] = ((prednisolone >= 1) & ~np.isnan(prednisolone)).astype("float64")
+
+    high_cost = any_of(data, [f"stand{group}" for group in HIGH_COST_GROUPS], lambda x: x == 1)
+    data["imiddrugcategory"] = np.select([high_cost, standsys == 1], [1.0, 0.0], np.nan)
+
+    # Patients on another high cost drug aren't comparators
+    other_high_cost = (data["imiddrugcategory"] == 1) | (data["standvedolizumab"] == 1) | (data["standabatacept"] == 1)
+    for name in EXCLUSIVE_COHORTS:
+        data[name] = np.where(other_high_cost & (data[name] == 0), np.nan, data[name])
+
+
+def derive_outcomes(data, index_date):
+    data["enter_date"] = np.full(len(data["patient_id"]), index_date)
+
+    # Events on the index date are moved half a day later
+    for name in ["died_ons_date", "icu_admitted_date", "hospital_admission_date"]:
+        data[name] = np.where(data[name] == index_date, data[name] + 0.5, data[name])
+
+    died = data["died_ons_date"]
+    covid_death = data["died_ons_covid_flag_any"] == 1
+    data["died_ons_date_covid"] = np.where(covid_death, died, np.nan)
+    data["died_ons_date_noncovid"] = np.where(covid_death, np.nan, died)
+
+    # An admission counts as COVID from 5 days before to 28 days after a
+    # positive test
+    hospital = data["hospital_admission_date"]
+    icu = data["icu_admitted_date"]
+    diff = hospital - data["first_pos_test_sgss_date"]
+    diff[diff < -5] = np.nan
+    data["hosp_admit_diff"] = diff
+    data["hosp_admit_date_covid"] = np.where(diff < 28, hospital, np.nan)
+    hosp_admit_covid = flag(~np.isnan(data["hosp_admit_date_covid"]))
+    data["hosp_admit_covid"] = hosp_admit_covid
+    data["icu_admit_date_covid"] = np.where(hosp_admit_covid == 1, icu, np.nan)
+    data["icu_or_death_covid_date"] = np.where(
+        np.isnan(data["icu_admit_date_covid"]), data["died_ons_date_covid"], data["icu_admit_date_covid"]
+    )
+    data["icu_or_death_covid"] = flag(~np.isnan(data["icu_or_death_covid_date"]))
+
+    # Sensitivity analyses without the 28 day limit
+    data["hosp_admit_date_covid_sens"] = np.where(np.isnan(diff), np.nan, hospital)
+    data["hosp_admit_covid_sens"] = flag(~np.isnan(data["hosp_admit_date_covid_sens"]))
+    data["icu_admit_date_covid_sens"] = np.where(hosp_admit_covid == 1, icu, np.nan)
+    data["icu_covid_sens"] = flag(~np.isnan(data["icu_admit_date_covid_sens"]))
+
+
+def is_date(name):
+    return name.endswith("_date") or "_date_" in name
+
+
+def compact_column(name, values):
+    if name == "sex":
+        return values
+    if name == "patient_id":
+        return values.astype("int32") if values.max(initial=0) < 2 ** 31 else values
+    if is_date(name) or name in FLOAT_COLUMNS:
+        return values.astype("float32")
+    present = values[~np.isnan(values)]
+    low, high = present.min(initial=0), present.max(initial=0)
+    # Stata reserves the top of each integer type's range for missing values
+    for dtype, (minimum, maximum) in [("Int8", (-127, 100)), ("Int16", (-32767, 32740))]:
+        if minimum <= low and high <= maximum:
+            missing = np.isnan(values)
+            return pd.arrays.IntegerArray(np.where(missing, 0, values).astype(dtype.lower()), missing)
+    return values
+
+
+def derive_covariates(cohort, index_date=INDEX_DATE):
+    """
+    Computes every derived variable in `000_define_covariates.do` from the
+    extract, as loaded by `columnar.read_cohort`, returning the analysis
+    dataset the do-file saves as `file_imid_all.dta`
+
+    Each variable is computed once for all patients with array operations,
+    following the do-file's recodes, including how Stata compares missing
+    values and its single precision storage, so the result is the same.
+    Dates are Stata dates (days since 1960-01-01) and missing values are NaN.
+    """
+    index_date = float((index_date - STATA_EPOCH).astype("int64"))
+    cohort = cohort.rename(columns=RENAMES).drop(columns=DROPPED)
+    data = convert_dates(working_columns(cohort))
+
+    derive_demographics(data)
+    # `bysort stp` leaves the dataset in STP order
+    data = sort_by(data, "stp")
+    data = drop_out_of_range_ages(data)
+    derive_age(data)
+    derive_bmi(data, index_date)
+    derive_smoking(data)
+    derive_gp_consultations(data)
+    derive_kidney_function(data)
+    derive_diabetes(data, index_date)
+    derive_comorbidities(data)
+    derive_populations(data)
+    derive_exposures(data)
+    derive_outcomes(data, index_date)
+    imd_unknown = data.pop("imd_unknown")
+    df = pd.DataFrame({name: compact_column(name, values) for name, values in data.items()})
+    df.attrs["unknown"] = {"imd": pd.Series(imd_unknown, index=df.index)}
+    return df
+
+
+class AnalysisDatasetWriter(StataWriterUTF8):
+    """
+    Writes the analysis dataset as a Stata file, with %td dates and `.u` for
+    the `UNKNOWN_MISSING` columns
+
+    pandas only writes dates from datetime columns (losing the half day added
+    to events on the index date) and writes every missing value as `.`, so the
+    formats and missing values are set after pandas has prepared the data.
+    `unknown` maps a column to a boolean array of its `.u` rows, for columns
+    where the rest of the missing values stay `.`.
+    """
+
+    # Stata's `.` for each integer type; `.a` to `.z` follow it
+    MISSING = {"int8": 101, "int16": 32741, "int32": 2147483621}
+    UNKNOWN_OFFSET = ord("u") - ord("a") + 1
+
+    def __init__(self, *args, unknown=None, **kwargs):
+        self.unknown = unknown or {}
+        super().__init__(*args, **kwargs)
+
+    def _prepare_pandas(self, data):
+        super()._prepare_pandas(data)
+        for i, name in enumerate(self.varlist):
+            if is_date(name):
+                self.fmtlist[i] = "%td"
+
+    def _prepare_data(self):
+        records = super()._prepare_data()
+        for name in UNKNOWN_MISSING:
+            if name in self.varlist:
+                values = records[name]
+                missing = self.MISSING[values.dtype.name]
+                unknown = values == missing
+                if name in self.unknown:
+                    unknown &= self.unknown[name]
+                values[unknown] = missing + self.UNKNOWN_OFFSET
+        return records
+
+
+def write_analysis_dataset(df, filename):
+    value_labels = {name: labels for name, labels in VALUE_LABELS.items() if name in df}
+    unknown = {
+        name: mask.reindex(df.index, fill_value=False).to_numpy(bool)
+        for name, mask in df.attrs.get("unknown", {}).items()
+    }
+    writer = AnalysisDatasetWriter(
+        filename,
+        df.reset_index(drop=True),
+        write_index=False,
+        variable_labels=VARIABLE_LABELS,
+        value_labels=value_labels,
+        unknown=unknown,
+    )
+    writer.write_file()
+
+
+def write_cohort_files(df, output_dir, cohorts=COHORTS):
+    """
+    Writes `file_<cohort>.dta` for each cohort: the patients for whom the
+    cohort variable isn't missing
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for name in cohorts:
+        write_analysis_dataset(df[df[name].notna()], output_dir / f"file_{name}.dta")
+
+
+def compare_datasets(expected, actual):
+    """
+    Compares a derived dataset with the one the do-file saved, both as
+    `cohort_index.read_analysis_dataset` reads them
+
+    Returns which columns are missing from either, whether the rows (by
+    patient id, in order) match, and which columns' values or `.u` rows
+    differ. Only names are reported, so the result can be released.
+    """
+    common = [name for name in expected.columns if name in actual.columns]
+    same_rows = len(expected) == len(actual) and (expected["patient_id"].values == actual["patient_id"].values).all()
+    differing = []
+    for name in common if same_rows else []:
+        left, right = expected[name], actual[name]
+        if left.dtype == object or right.dtype == object:
+            same_values = left.tolist() == right.tolist()
+        else:
+            same_values = np.array_equal(
+                left.to_numpy("float64", na_value=np.nan), right.to_numpy("float64", na_value=np.nan), equal_nan=True
+            )
+        unknown = [
+            dataset.attrs.get("unknown", {}).get(name, pd.Series(False, index=dataset.index)).to_numpy(bool)
+            for dataset in (expected, actual)
+        ]
+        if not (same_values and np.array_equal(*unknown)):
+            differing.append(name)
+    return {
+        "only_in_stata": [name for name in expected.columns if name not in actual.columns],
+        "only_in_python": [name for name in actual.columns if name not in expected.columns],
+        "same_rows": bool(same_rows),
+        "differing_columns": differing,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Derive the analysis dataset from the cohort extract"
+    )
+    parser.add_argument("--input", default=str(DEFAULT_INPUT), help="the extract, as CSV or Parquet")
+    parser.add_argument("--output", help="write the whole dataset to this .dta file")
+    parser.add_argument("--cohort-dir", help="write file_<cohort>.dta for each cohort to this directory")
+    parser.add_argument("--compare-with", help="the do-file's file_imid_all.dta, to compare the output with")
+    parser.add_argument("--report", help="where to write the comparison, as JSON")
+    args = parser.parse_args()
+    if not (args.output or args.cohort_dir):
+        parser.error("Give --output, --cohort-dir or both")
+    if args.compare_with and not (args.output and args.report):
+        parser.error("--compare-with needs --output and --report")
+
+    df = derive_covariates(read_cohort(args.input))
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        write_analysis_dataset(df, args.output)
+    if args.cohort_dir:
+        write_cohort_files(df, args.cohort_dir)
+    if args.compare_with:
+        # Compare what was written, as Stata will read it
+        from cohort_index import read_analysis_dataset
+
+        comparison = compare_datasets(read_analysis_dataset(args.compare_with), read_analysis_dataset(args.output))
+        Path(args.report).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.report, "w") as f:
+            json.dump(comparison, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from codearrays import CodeArray, common_system, intern_codes
+
+DATE_FORMATS = {
+    "YYYY": "%Y",
+    "YYYY-MM": "%Y-%m",
+    "YYYY-MM-DD": "%Y-%m-%d",
+}
+
+# Clinical events coded in SNOMED CT are held in a separate table from those
+# coded in CTV3, so codelists are matched against the table for their system
+EVENT_TABLES = {"ctv3": "clinical_events", "snomed": "clinical_events_snomed"}
+
+
+def format_dates(dates, date_format):
+    """
+    Formats a datetime series the way cohortextractor writes dates to CSV, with
+    missing dates left as None
+
+    As in cohortextractor, dates with no `date_format` are truncated to the year.
+    """
+    formatted = dates.dt.strftime(DATE_FORMATS[date_format or "YYYY"])
+    return formatted.astype(object).where(dates.notna(), None)
+
+
+def first_diagnosis_codelists(covariate_definitions):
+    """
+    Finds the `first_diagnosis_in_period` variables in a study definition
+
+    Returns a dictionary of variable name -> codelist, plus the period and date
+    format they share. Variables with a different period or format are left for
+    cohortextractor (or a separate batch).
+    """
+    codelists = {}
+    between = date_format = None
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        if funcname != "with_these_clinical_events":
+            continue
+        if kwargs["returning"] != "date" or not kwargs["find_first_match_in_period"]:
+            continue
+        if kwargs.get("ignore_days_where_these_codes_occur") or kwargs.get("episode_defined_as"):
+            continue
+        if not codelists:
+            between, date_format = kwargs["between"], kwargs["date_format"]
+        elif (kwargs["between"], kwargs["date_format"]) != (between, date_format):
+            continue
+        codelists[name] = kwargs["codelist"]
+    return codelists, between, date_format
+
+
+def build_code_to_covariate(codelists_by_name):
+    """
+    Builds one code -> covariate multimap from a dictionary of codelists, so a
+    code which appears in several codelists matches all of them
+    """
+    pairs = {
+        (code, name)
+        for name, codes in codelists_by_name.items()
+        for code in codes
+    }
+    return pd.DataFrame(sorted(pairs), columns=["code", "covariate"])
+
+
+def first_diagnosis_dates(events, codelists_by_name, between=(None, None), date_format="YYYY-MM", patient_ids=None):
+    """
+    Batched equivalent of calling `first_diagnosis_in_period` once per codelist
+
+    `events` is a clinical events dataframe (`patient_id`, `code`, `date`) or an
+    iterable of such chunks, e.g. from `pd.read_csv(..., chunksize=...)`. Each
+    chunk is filtered to codes in any of the codelists with one sorted-array
+    lookup, then joined once against the code -> covariate multimap and reduced to
+    the earliest date per patient per covariate, so the events are streamed a
+    single time whatever the number of codelists.
+    """
+    if isinstance(events, pd.DataFrame):
+        events = [events]
+    code_to_covariate = build_code_to_covariate(codelists_by_name)
+    codes = CodeArray(code_to_covariate["code"].unique(), system=common_system(codelists_by_name.values()))
+    start, end = between
+
+    running_min = None
+    for chunk in events:
+        chunk = intern_codes(chunk)
+        chunk = chunk[codes.contains(chunk["code"])]
+        chunk = chunk.assign(code=chunk["code"].astype(object))
+        matched = chunk[["patient_id", "code", "date"]].merge(
+            code_to_covariate, on="code", how="inner"
+        )
+        matched["date"] = pd.to_datetime(matched["date"])
+        if start is not None:
+            matched = matched[matched["date"] >= np.datetime64(start)]
+        if end is not None:
+            matched = matched[matched["date"] <= np.datetime64(end)]
+        chunk_min = matched.groupby(["patient_id", "covariate"])["date"].min()
+        if running_min is None:
+            running_min = chunk_min
+        else:
+            running_min = pd.concat([running_min, chunk_min]).groupby(level=[0, 1]).min()
+
+    if running_min is None:
+        running_min = pd.Series(
+            [],
+            dtype="datetime64[ns]",
+            index=pd.MultiIndex.from_arrays([[], []], names=["patient_id", "covariate"]),
+        )
+    result = running_min.unstack("covariate").reindex(columns=list(codelists_by_name))
+    result.columns.name = None
+    if patient_ids is not None:
+        result = result.reindex(pd.Index(patient_ids, name="patient_id"))
+    for name in result.columns:
+        result[name] = format_dates(pd.to_datetime(result[name]), date_format)
+    return result
+
+
+def codelists_by_table(codelists_by_name):
+    """
+    Groups a dictionary of codelists by the events table (see `EVENT_TABLES`)
+    their codes are found in
+    """
+    tables = {}
+    for name, codelist in codelists_by_name.items():
+        system = getattr(codelist, "system", None)
+        if system not in EVENT_TABLES:
+            raise ValueError(f"No clinical events table for {name}'s {system} codes")
+        tables.setdefault(EVENT_TABLES[system], {})[name] = codelist
+    return tables
+
+
+def first_diagnosis_dates_by_table(tables, codelists_by_name, between=(None, None), date_format="YYYY-MM", patient_ids=None):
+    """
+    `first_diagnosis_dates` for codelists from more than one coding system
+
+    `tables` maps each events table name needed (see `codelists_by_table`) to
+    its events, which are streamed once each. Returns the columns in the order
+    of `codelists_by_name`, with a row for every patient found in any table.
+    """
+    by_table = codelists_by_table(codelists_by_name)
+    missing = sorted(set(by_table) - set(tables))
+    if missing:
+        names = [name for table in missing for name in by_table[table]]
+        raise ValueError(f"Events from {', '.join(missing)} are needed for {', '.join(names)}")
+    results = [
+        first_diagnosis_dates(tables[table], codelists, between, date_format, patient_ids)
+        for table, codelists in by_table.items()
+    ]
+    result = pd.concat(results, axis=1).reindex(columns=list(codelists_by_name))
+    result.index.name = "patient_id"
+    return result.astype(object).where(result.notna(), None)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract all first diagnosis dates from the clinical events tables in one pass each"
+    )
+    parser.add_argument("--clinical-events", help="CTV3 coded clinical events CSV")
+    parser.add_argument("--clinical-events-snomed", help="SNOMED CT coded clinical events CSV")
+    parser.add_argument("--chunksize", type=int, default=1_000_000)
+    parser.add_argument("--output", default="output/first_diagnoses.csv")
+    args = parser.parse_args()
+
+    from study_definition import study
+
+    codelists, between, date_format = first_diagnosis_codelists(study.covariate_definitions)
+    paths = {"clinical_events": args.clinical_events, "clinical_events_snomed": args.clinical_events_snomed}
+    for table, table_codelists in codelists_by_table(codelists).items():
+        if not paths[table]:
+            parser.error(f"--{table.replace('_', '-')} is needed for {', '.join(table_codelists)}")
+    tables = {
+        table: pd.read_csv(path, dtype={"code": "category"}, chunksize=args.chunksize)
+        for table, path in paths.items()
+        if path
+    }
+    result = first_diagnosis_dates_by_table(tables, codelists, between, date_format)
+    result.to_csv(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import argparse
+import logging
+import re
+from collections import deque, namedtuple
+from pathlib import Path
+
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAPPING = Path("make_druglists") / "druglist_mapping.csv"
+DEFAULT_EXCLUSIONS = Path("make_druglists") / "druglist_exclusions.csv"
+DEFAULT_CODELIST_DIR = Path("crossimid-codelists")
+DEFAULT_LOOKUP = DEFAULT_CODELIST_DIR / "high-cost-drug-lookup.csv"
+
+# An alternative in a drug or exclusion pattern which is plain text, with an
+# optional word boundary at either end. Anything else is left to `re`.
+LITERAL = re.compile(r"^(\\b)?([^\\^$.|?*+()\[\]{}]+)(\\b)?$")
+
+Term = namedtuple("Term", ["text", "drug", "exclude", "start_boundary", "end_boundary"])
+
+
+def normalise(name):
+    """
+    The form drug names are matched (and written to codelists) in, as in
+    `make_new_druglists_and_metadata.R`
+    """
+    return name.lower()
+
+
+def split_pattern(pattern):
+    """
+    Splits a regex into the plain text alternatives the automaton can match,
+    as (text, start_boundary, end_boundary), and a regex of whatever is left
+    (or None)
+    """
+    pattern = normalise(pattern)
+    if re.search(r"[()\[\]]", pattern):
+        return [], pattern
+    literals = []
+    rest = []
+    for alternative in pattern.split("|"):
+        match = LITERAL.match(alternative)
+        if match:
+            literals.append((match.group(2), bool(match.group(1)), bool(match.group(3))))
+        else:
+            rest.append(alternative)
+    return literals, "|".join(rest) or None
+
+
+class TermAutomaton:
+    """
+    Aho-Corasick automaton over a list of terms, finding every occurrence of
+    every term in a string in one pass over its characters
+    """
+
+    def __init__(self, terms):
+        self.terms = list(terms)
+        self.transitions = [{}]
+        self.matches = [[]]
+        for index, term in enumerate(self.terms):
+            state = 0
+            for character in term.text:
+                if character not in self.transitions[state]:
+                    self.transitions.append({})
+                    self.matches.append([])
+                    self.transitions[state][character] = len(self.transitions) - 1
+                state = self.transitions[state][character]
+            self.matches[state].append(index)
+
+        # Failure links, breadth first so a state's link is always resolved
+        # before its children's
+        self.failures = [0] * len(self.transitions)
+        pending = deque(self.transitions[0].values())
+        while pending:
+            state = pending.popleft()
+            for character, child in self.transitions[state].items():
+                failure = self.failures[state]
+                while failure and character not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                self.failures[child] = self.transitions[failure].get(character, 0)
+                self.matches[child] = self.matches[child] + self.matches[self.failures[child]]
+                pending.append(child)
+
+    def find(self, text):
+        """
+        Yields (start, end, term) for each occurrence of a term in `text`
+        """
+        state = 0
+        for position, character in enumerate(text):
+            while state and character not in self.transitions[state]:
+                state = self.failures[state]
+            state = self.transitions[state].get(character, 0)
+            for index in self.matches[state]:
+                term = self.terms[index]
+                yield position + 1 - len(term.text), position + 1, term
+
+
+def is_word_character(character):
+    return character.isalnum() or character == "_"
+
+
+def at_boundary(text, position):
+    before = position > 0 and is_word_character(text[position - 1])
+    after = position < len(text) and is_word_character(text[position])
+    return before != after
+
+
+class DrugNameMatcher:
+    """
+    Maps free-text high cost drug names to clean drug names
+
+    Every drug's name patterns (`druglist_mapping.csv`) and exclusions
+    (`druglist_exclusions.csv`) are compiled into one `TermAutomaton`, so each
+    name is scanned once whatever the number of drugs. A name belongs to a
+    drug if it contains one of the drug's patterns and none of its
+    exclusions, as in `make_new_druglists_and_metadata.R`. Exclusions which
+    aren't plain text are checked with `re`, only against names already found
+    for their drug; drug patterns which aren't are checked against every name.
+    """
+
+    def __init__(self, mapping, exclusions=None):
+        self.vtms = mapping.groupby("new_clean_drug")["vtm"].first().to_dict()
+        terms = []
+        self.include_regexes = {}
+        self.exclude_regexes = {}
+        patterns = [(drug, False, pattern) for drug, pattern in zip(mapping["new_clean_drug"], mapping["old_drug_name"])]
+        if exclusions is not None:
+            patterns += [
+                (drug, True, pattern)
+                for drug, pattern in zip(exclusions["new_clean_drug"], exclusions["exclude_regex"])
+                if isinstance(pattern, str)
+            ]
+        for drug, exclude, pattern in patterns:
+            literals, rest = split_pattern(pattern)
+            terms.extend(Term(text, drug, exclude, start, end) for text, start, end in literals)
+            if rest:
+                regexes = self.exclude_regexes if exclude else self.include_regexes
+                regexes.setdefault(drug, []).append(re.compile(rest))
+        if self.include_regexes:
+            logger.warning(
+                f"Patterns for {', '.join(sorted(self.include_regexes))} aren't plain text, "
+                "so are matched against every name"
+            )
+        self.automaton = TermAutomaton(terms)
+
+    @classmethod
+    def from_files(cls, mapping_path=DEFAULT_MAPPING, exclusions_path=DEFAULT_EXCLUSIONS):
+        exclusions = pd.read_csv(exclusions_path) if Path(exclusions_path).exists() else None
+        return cls(pd.read_csv(mapping_path, dtype={"vtm": str}), exclusions)
+
+    def drugs_for(self, name):
+        """
+        The set of clean drugs a normalised name belongs to
+        """
+        included = set()
+        excluded = set()
+        for start, end, term in self.automaton.find(name):
+            if term.start_boundary and not at_boundary(name, start):
+                continue
+            if term.end_boundary and not at_boundary(name, end):
+                continue
+            (excluded if term.exclude else included).add(term.drug)
+        for drug, regexes in self.include_regexes.items():
+            if drug not in included and any(regex.search(name) for regex in regexes):
+                included.add(drug)
+        for drug in included - excluded:
+            if any(regex.search(name) for regex in self.exclude_regexes.get(drug, [])):
+                excluded.add(drug)
+        return included - excluded
+
+    def map_names(self, names):
+        """
+        Maps raw drug names to clean drugs in one pass
+
+        Names are normalised and deduplicated first (keeping the order they
+        first appear in). Returns a dataframe of `olddrugname`, `drug` and
+        `vtm`, with a row per drug for a name which matches more than one, and
+        names which match none left out.
+        """
+        rows = []
+        for name in dict.fromkeys(normalise(str(name)) for name in names):
+            for drug in sorted(self.drugs_for(name)):
+                rows.append((name, drug, self.vtms[drug]))
+        return pd.DataFrame(rows, columns=["olddrugname", "drug", "vtm"])
+
+
+def ambiguous_names(mapped):
+    """
+    The names in `map_names` output which map to more than one drug
+    """
+    counts = mapped["olddrugname"].value_counts()
+    return sorted(counts.index[counts > 1])
+
+
+def codelist_path(codelist_dir, drug):
+    return Path(codelist_dir) / f"crossimid-{drug.replace(' ', '-')}-drug-names.csv"
+
+
+def write_codelists(mapped, codelist_dir=DEFAULT_CODELIST_DIR):
+    """
+    Writes each drug's names to its `crossimid-<drug>-drug-names.csv`
+    codelist, in the order the names were given
+    """
+    for drug, names in mapped.groupby("drug", sort=True):
+        names[["olddrugname"]].to_csv(codelist_path(codelist_dir, drug), index=False)
+
+
+def write_lookup(mapped, path=DEFAULT_LOOKUP):
+    """
+    Writes the name -> drug lookup, one row per name, sorted by name
+
+    `medications.py --drug-lookup` joins high cost drug events to this on the
+    normalised name, rather than matching names against each codelist.
+    """
+    if ambiguous_names(mapped):
+        raise ValueError("The lookup can only hold names which map to one drug")
+    mapped.sort_values("olddrugname").to_csv(path, index=False)
+
+
+def read_lookup(path=DEFAULT_LOOKUP):
+    """
+    Reads a lookup written by `write_lookup` as a series of drug indexed by
+    normalised name
+    """
+    lookup = pd.read_csv(path, dtype=str, keep_default_na=False)
+    return pd.Series(lookup["drug"].values, index=pd.Index(lookup["olddrugname"].values, name="olddrugname"))
+
+
+def read_names(paths):
+    """
+    Every drug name in the given files: raw dumps with a `DrugName` column or
+    codelists with an `olddrugname` column
+    """
+    names = []
+    for path in paths:
+        df = pd.read_csv(path, dtype=str, keep_default_na=False)
+        names.extend(df["DrugName" if "DrugName" in df.columns else "olddrugname"])
+    return names
+
+
+def check_codelists(mapped, codelist_dir=DEFAULT_CODELIST_DIR):
+    """
+    Compares each drug's codelist on disk with the names the mapping gives it
+
+    Returns a dataframe of `drug`, `olddrugname` and `problem`, either
+    "missing from codelist" or "not matched by mapping".
+    """
+    problems = []
+    for drug, names in mapped.groupby("drug", sort=True):
+        path = codelist_path(codelist_dir, drug)
+        existing = set(read_names([path])) if path.exists() else set()
+        expected = set(names["olddrugname"])
+        problems += [(drug, name, "missing from codelist") for name in sorted(expected - existing)]
+        problems += [(drug, name, "not matched by mapping") for name in sorted(existing - expected)]
+    return pd.DataFrame(problems, columns=["drug", "olddrugname", "problem"])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build or check the high cost drug name codelists from the drug name mapping"
+    )
+    parser.add_argument("command", choices=["build", "check"])
+    parser.add_argument(
+        "--names",
+        nargs="+",
+        help="drug name dumps (DrugName column); defaults to the names already in --codelist-dir",
+    )
+    parser.add_argument("--mapping", default=str(DEFAULT_MAPPING))
+    parser.add_argument("--exclusions", default=str(DEFAULT_EXCLUSIONS))
+    parser.add_argument("--codelist-dir", default=str(DEFAULT_CODELIST_DIR))
+    parser.add_argument("--lookup", default=str(DEFAULT_LOOKUP))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    names = read_names(args.names or sorted(Path(args.codelist_dir).glob("crossimid-*-drug-names.csv")))
+    matcher = DrugNameMatcher.from_files(args.mapping, args.exclusions)
+    mapped = matcher.map_names(names)
+    ambiguous = ambiguous_names(mapped)
+    if ambiguous:
+        raise SystemExit(f"The following have more than one drug name match: {', '.join(ambiguous)}")
+    logger.info(f"Mapped {mapped['olddrugname'].nunique():,} of {len(set(map(normalise, names))):,} names")
+
+    if args.command == "build":
+        write_codelists(mapped, args.codelist_dir)
+        write_lookup(mapped, args.lookup)
+    else:
+        problems = check_codelists(mapped, args.codelist_dir)
+        if len(problems):
+            print(problems.to_string(index=False))
+            raise SystemExit(1)
+        print("Every codelist matches the mapping")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import argparse
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+
+# Functions whose dummy values come from somewhere other than
+# `return_expectations`; none of these are used by our study definition
+UNSUPPORTED_FUNCTIONS = ["aggregate_of", "with_value_from_file", "which_exist_in_file", "fixed_value"]
+
+DATE_UNITS = {"YYYY": "Y", "YYYY-MM": "M", "YYYY-MM-DD": "D", None: "Y"}
+
+
+def merge_expectations(defaults, overrides):
+    merged = dict(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = merge_expectations(merged[key], value)
+        merged[key] = value
+    return merged
+
+
+def resolve_date(value):
+    if value == "today":
+        return date.today().isoformat()
+    return value
+
+
+def population_age_probabilities(max_age=110):
+    """
+    Probability of each age from 0 to `max_age` - 1, following the UK population
+    bands that cohortextractor uses for the `population_ages` distribution
+    """
+    import cohortextractor
+
+    bands = pd.read_csv(
+        os.path.join(os.path.dirname(cohortextractor.__file__), "uk_population_bands_2018.csv")
+    )
+    ends = bands["band"].str.split("-").str[1].astype(int).values
+    counts = bands["range"].str.replace(",", "").astype(int).values
+    ages = np.arange(max_age)
+    band_for_age = np.searchsorted(ends, ages)
+    p = counts[band_for_age] / counts.sum() / 5
+    # As in cohortextractor, make the probabilities sum to 1 by trimming the
+    # largest one
+    p[np.argmax(p)] -= p.sum() - 1
+    return p
+
+
+def format_dates(dates, date_format):
+    """
+    Formats an array of datetime64[D] as strings at the precision of
+    `date_format`, with missing dates as empty strings
+
+    Every day in the range is formatted once and looked up by offset, which is
+    far quicker than formatting each value when there are millions of rows
+    """
+    formatted = np.full(len(dates), "", dtype=object)
+    present = ~np.isnat(dates)
+    if not present.any():
+        return formatted
+    days = dates[present].astype("int64")
+    first = days.min()
+    lookup = np.datetime_as_string(
+        np.arange(first, days.max() + 1).astype("datetime64[D]"),
+        unit=DATE_UNITS[date_format],
+    ).astype(object)
+    formatted[present] = lookup[days - first]
+    return formatted
+
+
+class DummyDataGenerator:
+    """
+    Vectorised dummy data generator driven by a study definition's
+    `return_expectations`
+
+    Follows the same rules as cohortextractor's `make_df_from_expectations`
+    (incidence, rates, date ranges and filters, int/float/category
+    distributions, matching the incidence of a value to its date) but builds
+    each column as a single NumPy array and works through the population a
+    chunk at a time, so memory use is bounded by the chunk size rather than the
+    population size. Each chunk is seeded from `seed` and its index, so a given
+    seed and chunk size always produce the same data.
+    """
+
+    def __init__(self, study, seed=0):
+        self.study = study
+        self.seed = seed
+        self.args = study.pandas_csv_args["args"]
+        self.dtypes = study.pandas_csv_args["dtype"]
+        self.parse_dates = study.pandas_csv_args["parse_dates"]
+        self.date_col_for = study.pandas_csv_args["date_col_for"]
+        self.columns = [
+            name
+            for name, (funcname, kwargs) in study.covariate_definitions.items()
+            if name in self.args
+        ]
+        for name in self.columns:
+            if self.args[name]["funcname"] in UNSUPPORTED_FUNCTIONS:
+                raise ValueError(f"Can't generate dummy data for {name} ({self.args[name]['funcname']})")
+        self._age_probabilities = None
+
+    def expectations_for(self, name):
+        definition_args = self.args[name]
+        if "source" in definition_args:
+            # The source may be hidden, in which case it has no entry in args
+            definition_args = self.study.covariate_definitions[definition_args["source"]][1]
+        return_expectations = definition_args["return_expectations"] or {}
+        if not self.study.default_expectations and not return_expectations:
+            raise ValueError(
+                f"No `return_expectations` defined for {name} "
+                "and no `default_expectations` defined for the study"
+            )
+        return merge_expectations(self.study.default_expectations, return_expectations)
+
+    def incidence_mask(self, rng, size, expectations):
+        rate = expectations.get("rate", "exponential_increase")
+        if rate == "universal":
+            return np.ones(size, dtype=bool)
+        incidence = expectations.get("incidence")
+        if not incidence:
+            raise ValueError("You must specify an incidence, or a `universal` rate")
+        return rng.random(size) < incidence
+
+    def generate_dates(self, rng, size, name):
+        expectations = self.expectations_for(name)
+        if "date" not in expectations:
+            raise ValueError(f"{name} must define a date expectation")
+        low = np.datetime64(resolve_date(expectations["date"]["earliest"]), "D")
+        high = np.datetime64(resolve_date(expectations["date"]["latest"]), "D")
+        elapsed = (high - low).astype("int64")
+
+        rate = expectations.get("rate", "exponential_increase")
+        if rate == "exponential_increase":
+            # Exponential with scale 0.1, truncated to the date range
+            fraction = -0.1 * np.log1p(-rng.random(size) * (1 - np.exp(-10)))
+        elif rate in ("uniform", "universal"):
+            fraction = rng.random(size)
+        else:
+            raise ValueError(
+                "Only exponential_increase and uniform distributions currently supported"
+            )
+        dates = high - (fraction * elapsed).astype("int64").astype("timedelta64[D]")
+
+        # Apply any date filters from the definition
+        start, end = self.study.filter_date_range(self.args[name].get("between"))
+        missing = ~self.incidence_mask(rng, size, expectations)
+        if start:
+            missing |= dates < np.datetime64(start)
+        if end:
+            missing |= dates > np.datetime64(end)
+        dates[missing] = np.datetime64("NaT")
+        return dates
+
+    def generate_values(self, rng, size, name, present):
+        dtype = self.dtypes[name]
+        expectations = self.expectations_for(name)
+        if dtype == "bool":
+            return present.astype("int8")
+        if dtype == "category":
+            ratios = expectations["category"]["ratios"]
+            labels = np.array([str(label) for label in ratios], dtype=object)
+            p = np.array(list(ratios.values()), dtype=float)
+            values = labels[rng.choice(len(labels), size=size, p=p / p.sum())]
+            values[~present] = ""
+            return values
+        if dtype == "Int64":
+            spec = expectations.get("int")
+            if spec is None:
+                raise ValueError(f"Column definition {name} does not return expected type int")
+            if spec["distribution"] == "normal":
+                values = rng.normal(spec["mean"], spec["stddev"], size).astype("int64")
+            elif spec["distribution"] == "poisson":
+                values = rng.poisson(spec["mean"], size)
+            elif spec["distribution"] == "population_ages":
+                if self._age_probabilities is None:
+                    self._age_probabilities = population_age_probabilities()
+                p = self._age_probabilities
+                values = rng.choice(len(p), size=size, p=p)
+            else:
+                raise ValueError(
+                    "Only `normal`, `poisson`, and `population_ages` distributions currently supported for ints"
+                )
+            return np.where(present, values, 0)
+        if dtype == "float":
+            spec = expectations.get("float")
+            if spec is None or spec["distribution"] != "normal":
+                raise ValueError("Only `normal` distributions currently supported for floats")
+            values = rng.normal(spec["mean"], spec["stddev"], size)
+            return np.where(present, values, 0.0)
+        raise ValueError(f"Unable to generate dummy data of type {dtype} for {name}")
+
+    def generate_chunk(self, start, size, chunk_index=0):
+        """
+        Generates `size` patients, with ids starting at `start`, as a dataframe
+        in the same column order as a real extract
+        """
+        rng = np.random.default_rng([self.seed, chunk_index])
+        data = {}
+        # Dates go first so that values can match the incidence of their date
+        for name in self.parse_dates:
+            data[name] = self.generate_dates(rng, size, name)
+        for name in self.dtypes:
+            date_name = self.date_col_for.get(name)
+            if date_name:
+                present = ~np.isnat(data[date_name])
+            else:
+                present = self.incidence_mask(rng, size, self.expectations_for(name))
+            data[name] = self.generate_values(rng, size, name, present)
+        for name in self.parse_dates:
+            data[name] = format_dates(data[name], self.args[name].get("date_format"))
+
+        df = pd.DataFrame({name: data[name] for name in self.columns})
+        df.insert(0, "patient_id", np.arange(start, start + size, dtype="int64"))
+        return df
+
+    def iter_chunks(self, population, chunksize):
+        for chunk_index, start in enumerate(range(0, population, chunksize)):
+            size = min(chunksize, population - start)
+            yield self.generate_chunk(start + 1, size, chunk_index)
+
+
+def write_chunks(chunks, filename, study):
+    """
+    Writes an iterable of dataframes to one file, a chunk at a time, as CSV or
+    (for a .parquet filename) as typed Parquet with one row group per chunk
+    """
+    if str(filename).endswith(".parquet"):
+        from columnar import cohort_schema, write_parquet_chunks
+
+        write_parquet_chunks(chunks, filename, cohort_schema(study.covariate_definitions))
+        return
+    with open(filename, "w", newline="") as f:
+        for index, chunk in enumerate(chunks):
+            chunk.to_csv(f, index=False, header=index == 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate dummy data for the study definition from its return_expectations"
+    )
+    parser.add_argument("--population", type=int, default=50_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunksize", type=int, default=500_000)
+    parser.add_argument("--output", default="output/dummy_input.csv")
+    args = parser.parse_args()
+
+    from study_definition import study
+
+    generator = DummyDataGenerator(study, seed=args.seed)
+    write_chunks(generator.iter_chunks(args.population, args.chunksize), args.output, study)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from medications import build_medication_plans, match_drugs, read_events
+
+
+DEFAULT_INDEX_DIR = Path("output") / "exposure_index"
+INDEX_FILE = "exposure_index.json"
+
+# Issue dates are stored as days since this date, in the low 32 bits of each
+# timeline entry
+EPOCH = np.datetime64("1900-01-01", "D")
+DAY_BITS = 32
+# The last day an issue can be on. One past it still fits in the day bits, so
+# it can be used as an exclusive upper bound.
+MAX_DAY = 2 ** DAY_BITS - 2
+
+RETURNING = ["number_of_matches_in_period", "binary_flag", "first_date", "last_date"]
+
+Window = namedtuple("Window", ["name", "drug", "start", "end", "returning"])
+
+
+def drug_events(covariate_definitions, tables):
+    """
+    Every prescription (or high cost drug issue) for a drug in the study
+    definition, as `drug`, `patient_id` and `day` columns
+
+    `drug` is categorical, with every drug in the study as a category even if
+    it was never issued.
+    """
+    plans = build_medication_plans(covariate_definitions)
+    drugs = sorted({variable.drug for plan in plans.values() for variable in plan.variables})
+    frames = []
+    for source, plan in plans.items():
+        matched = match_drugs(plan, tables[source])
+        dates = pd.to_datetime(matched["date"]).values.astype("datetime64[D]")
+        frames.append(pd.DataFrame({
+            "drug": matched["drug"].values,
+            "patient_id": matched["patient_id"].values.astype("int64"),
+            "day": (dates - EPOCH).astype("int64"),
+        }))
+    events = pd.concat(frames, ignore_index=True)
+    events["drug"] = pd.Categorical(events["drug"], categories=drugs)
+    return events
+
+
+def build_exposure_index(events, index_dir=DEFAULT_INDEX_DIR):
+    """
+    Writes a per-drug, per-patient timeline of issue dates
+
+    Issues are run-length compressed to one entry per patient, drug and day.
+    The entries are sorted by drug, then patient, then day, and stored as one
+    int64 array with the (drug, patient) key in the high bits and the day in
+    the low bits, so the entries for any key and date range can be found by
+    binary search. Alongside it are:
+
+    * the running total of issues, so the count between two entries is one
+      subtraction
+    * each key's patient id
+    * each drug's first key
+
+    All of these are .npy files which are memory-mapped when read.
+    """
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    if isinstance(events["drug"].dtype, pd.CategoricalDtype):
+        drugs = list(events["drug"].cat.categories)
+    else:
+        drugs = sorted(events["drug"].unique())
+    drug_codes = pd.Categorical(events["drug"], categories=drugs).codes.astype("int64")
+
+    order = np.lexsort((events["day"].values, events["patient_id"].values, drug_codes))
+    drug_codes = drug_codes[order]
+    patient_ids = events["patient_id"].values[order]
+    days = events["day"].values[order]
+
+    # Run-length compress repeated issues on the same day
+    new_entry = np.ones(len(days), dtype=bool)
+    new_entry[1:] = (drug_codes[1:] != drug_codes[:-1]) | (patient_ids[1:] != patient_ids[:-1]) | (days[1:] != days[:-1])
+    entry_starts = np.flatnonzero(new_entry)
+    counts = np.diff(np.append(entry_starts, len(days)))
+    drug_codes, patient_ids, days = drug_codes[entry_starts], patient_ids[entry_starts], days[entry_starts]
+
+    new_key = np.ones(len(days), dtype=bool)
+    new_key[1:] = (drug_codes[1:] != drug_codes[:-1]) | (patient_ids[1:] != patient_ids[:-1])
+    key_of_entry = np.cumsum(new_key) - 1
+    key_starts = np.flatnonzero(new_key)
+    out_of_range = (days < 0) | (days > MAX_DAY)
+    if out_of_range.any():
+        raise ValueError(
+            f"{out_of_range.sum():,} issue dates are before {EPOCH} or too late for the timeline encoding"
+        )
+    if len(key_starts) >= 2 ** (63 - DAY_BITS):
+        raise ValueError("Too many drug/patient pairs for the timeline encoding")
+
+    arrays = {
+        "timeline": (key_of_entry << DAY_BITS) | days,
+        "cumulative": np.concatenate([[0], np.cumsum(counts)]).astype("int64"),
+        "key_patients": patient_ids[key_starts],
+        "drug_keys": np.searchsorted(drug_codes[key_starts], np.arange(len(drugs) + 1)).astype("int64"),
+    }
+    for name, array in arrays.items():
+        np.save(index_dir / f"{name}.npy", array)
+    summary = {
+        "drugs": drugs,
+        "issues": int(counts.sum()),
+        "entries": len(days),
+        "keys": len(key_starts),
+    }
+    tmp_path = index_dir / f"{INDEX_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(summary, f, indent=2)
+        f.write("\n")
+    # The summary is written last, so a half-built index can't be opened
+    os.replace(tmp_path, index_dir / INDEX_FILE)
+    return summary
+
+
+def to_day(date, default, offset=0):
+    """
+    Days since `EPOCH` (plus `offset`) of a window bound, clamped to the
+    range the timeline encoding can hold, so a bound can never spill into the
+    key bits
+    """
+    if date is None:
+        return default
+    day = int((np.datetime64(date, "D") - EPOCH).astype("int64")) + offset
+    return min(max(day, 0), MAX_DAY + 1)
+
+
+class ExposureIndex:
+    """
+    Read access to an index written by `build_exposure_index`
+
+    Answers count, flag, first-date and last-date queries for any drug and
+    window with two binary searches per patient, vectorised over all the
+    patients prescribed the drug, without reading the event tables.
+    """
+
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR):
+        self.index_dir = Path(index_dir)
+        with open(self.index_dir / INDEX_FILE) as f:
+            self.summary = json.load(f)
+        self.arrays = {
+            name: np.load(self.index_dir / f"{name}.npy", mmap_mode="r")
+            for name in ["timeline", "cumulative", "key_patients", "drug_keys"]
+        }
+
+    @property
+    def drugs(self):
+        return list(self.summary["drugs"])
+
+    def query(self, drug, start=None, end=None, returning="number_of_matches_in_period"):
+        """
+        Returns a series indexed by `patient_id` with a value for each patient
+        with an issue of `drug` between `start` and `end` (inclusive, either
+        may be None)
+
+        `returning` is one of `RETURNING`. Dates are returned as datetime64.
+        """
+        if drug not in self.summary["drugs"]:
+            raise ValueError(f"Unknown drug {drug}")
+        if returning not in RETURNING:
+            raise ValueError(f"Unsupported returning {returning}; expected one of {', '.join(RETURNING)}")
+        index = self.summary["drugs"].index(drug)
+        first_key, last_key = self.arrays["drug_keys"][index:index + 2]
+        keys = np.arange(first_key, last_key, dtype="int64")
+        timeline = self.arrays["timeline"]
+        lo = np.searchsorted(timeline, (keys << DAY_BITS) | to_day(start, 0))
+        hi = np.searchsorted(timeline, (keys << DAY_BITS) | to_day(end, MAX_DAY + 1, offset=1))
+        found = hi > lo
+        patient_ids = pd.Index(self.arrays["key_patients"][first_key:last_key][found], name="patient_id")
+        lo, hi = lo[found], hi[found]
+
+        if returning == "number_of_matches_in_period":
+            cumulative = self.arrays["cumulative"]
+            return pd.Series(cumulative[hi] - cumulative[lo], index=patient_ids)
+        if returning == "binary_flag":
+            return pd.Series(1, index=patient_ids, dtype="int64")
+        entries = lo if returning == "first_date" else hi - 1
+        days = timeline[entries] & (2 ** DAY_BITS - 1)
+        return pd.Series(EPOCH + days.astype("timedelta64[D]"), index=patient_ids)
+
+    def windows(self, windows, patient_ids=None):
+        """
+        Answers a list of `Window`s as a dataframe with a column per window,
+        filling 0 for counts and flags (and leaving dates missing) for
+        patients with no issues in the window
+        """
+        columns = {window.name: self.query(window.drug, window.start, window.end, window.returning) for window in windows}
+        result = pd.DataFrame(columns, columns=[window.name for window in windows])
+        if patient_ids is not None:
+            result = result.reindex(pd.Index(patient_ids, name="patient_id"))
+        for window in windows:
+            if window.returning in ("number_of_matches_in_period", "binary_flag"):
+                result[window.name] = result[window.name].fillna(0).astype("int64")
+        result.index.name = "patient_id"
+        return result
+
+
+def study_windows(covariate_definitions):
+    """
+    The windows of the `medication_counts_and_dates` variables in a study
+    definition
+    """
+    return [
+        Window(variable.name, variable.drug, variable.start, variable.end, variable.returning)
+        for plan in build_medication_plans(covariate_definitions).values()
+        for variable in plan.variables
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build or query a per-patient index of drug issue dates"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    build = subparsers.add_parser("build", help="index the prescribing and high cost drug tables")
+    build.add_argument("--medications", required=True, help="prescribing events file")
+    build.add_argument("--high-cost-drugs", required=True, help="high cost drug events file")
+    build.add_argument("--index-dir", default=str(DEFAULT_INDEX_DIR))
+    query = subparsers.add_parser("query", help="one column per drug for a new window")
+    query.add_argument("--between", nargs=2, metavar=("START", "END"), required=True)
+    query.add_argument("--returning", choices=RETURNING, default="number_of_matches_in_period")
+    query.add_argument("--suffix", required=True, help="column suffix, e.g. 12m_6m")
+    query.add_argument("--drugs", nargs="*", help="defaults to every drug in the index")
+    query.add_argument("--index-dir", default=str(DEFAULT_INDEX_DIR))
+    query.add_argument("--output", default="output/exposure_windows.csv")
+    study = subparsers.add_parser("study", help="the study definition's medication variables")
+    study.add_argument("--index-dir", default=str(DEFAULT_INDEX_DIR))
+    study.add_argument("--output", default="output/medications.csv")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        from study_definition import study as study_definition
+
+        tables = {
+            "medications": read_events(args.medications),
+            "high_cost_drugs": read_events(args.high_cost_drugs),
+        }
+        events = drug_events(study_definition.covariate_definitions, tables)
+        build_exposure_index(events, args.index_dir)
+    elif args.command == "query":
+        index = ExposureIndex(args.index_dir)
+        start, end = args.between
+        windows = [
+            Window(f"{drug}_{args.suffix}", drug, start, end, args.returning)
+            for drug in args.drugs or index.drugs
+        ]
+        index.windows(windows).to_csv(args.output)
+    elif args.command == "study":
+        from study_definition import study as study_definition
+
+        index = ExposureIndex(args.index_dir)
+        index.windows(study_windows(study_definition.covariate_definitions)).to_csv(args.output)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from variables import dependencies, output_columns, subset_study
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = Path("output") / "variable_cache"
+
+# Arguments which don't change what a variable extracts from the database
+IGNORED_ARGUMENTS = ["hidden"]
+
+
+def canonical(value):
+    """
+    Converts a definition argument into something JSON-serialisable with a
+    stable ordering, so equal definitions always hash the same
+    """
+    if hasattr(value, "system"):
+        # Codelists: hash the system along with the full content
+        return {"system": value.system, "codes": [canonical(code) for code in value]}
+    if isinstance(value, dict):
+        return sorted([repr(key), canonical(item)] for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    return value
+
+
+def variable_hashes(covariate_definitions, source, include_expectations=False):
+    """
+    Returns a dictionary of variable name -> hash of everything which
+    determines its extracted values
+
+    That is the function and its arguments (including the content of any
+    codelists), the hashes of any variables it is computed from, and the
+    population definition, since a different population means different rows.
+    `source` identifies where the data comes from (a database, or dummy data
+    with a given size and seed) so results from different sources never mix.
+    """
+    graph = dependencies(covariate_definitions)
+    ignored = list(IGNORED_ARGUMENTS)
+    if not include_expectations:
+        ignored.append("return_expectations")
+    definition_hashes = {}
+
+    def definition_hash(name):
+        if name not in definition_hashes:
+            funcname, kwargs = covariate_definitions[name]
+            definition = {
+                "source": source,
+                "function": funcname,
+                "arguments": canonical({k: v for k, v in kwargs.items() if k not in ignored}),
+                "dependencies": sorted(definition_hash(other) for other in graph[name]),
+            }
+            encoded = json.dumps(definition, sort_keys=True, default=repr).encode()
+            definition_hashes[name] = hashlib.sha256(encoded).hexdigest()
+        return definition_hashes[name]
+
+    population = definition_hash("population")
+    return {
+        name: hashlib.sha256(f"{definition_hash(name)}:{population}".encode()).hexdigest()
+        for name in covariate_definitions
+    }
+
+
+class VariableCache:
+    """
+    Directory of extracted columns, one Parquet file per variable named after
+    the variable and its definition hash
+
+    Each file holds `patient_id` and the column's values exactly as they appear
+    in the CSV extract, sorted by `patient_id`.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        self.directory = Path(directory)
+
+    def path_for(self, name, definition_hash):
+        return self.directory / f"{name}-{definition_hash[:16]}.parquet"
+
+    def has(self, name, definition_hash):
+        return self.path_for(name, definition_hash).exists()
+
+    def read(self, name, definition_hash):
+        return pq.read_table(self.path_for(name, definition_hash))
+
+    def write(self, name, definition_hash, table):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Remove results for previous definitions of this variable (variable
+        # names can't contain "-", so this can't match any other variable)
+        for stale in self.directory.glob(f"{name}-*.parquet"):
+            stale.unlink()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        pq.write_table(table, tmp_path, compression="zstd")
+        os.replace(tmp_path, self.path_for(name, definition_hash))
+
+    def clear(self):
+        for path in self.directory.glob("*.parquet"):
+            path.unlink()
+
+
+def extract_to_csv(study, filename, expectations_population=None, seed=0):
+    """
+    Runs a (possibly subset) study definition, against the database or as dummy
+    data, writing the result to a CSV file
+    """
+    if expectations_population:
+        from dummy_data import DummyDataGenerator, write_chunks
+
+        generator = DummyDataGenerator(study, seed=seed)
+        write_chunks(generator.iter_chunks(expectations_population, 500_000), filename, study)
+    else:
+        study.assert_backend_is_configured()
+        study.backend.to_file(filename)
+
+
+def data_source(study, expectations_population=None, seed=0, snapshot=None):
+    """
+    Identifies where the extracted values come from, for `variable_hashes`
+
+    Nothing in a definition changes when the database is refreshed, so
+    results from the database are keyed on `snapshot`, which names the
+    version of the data (e.g. the date of its last refresh).
+    """
+    if expectations_population:
+        return f"expectations:{expectations_population}:{seed}"
+    if not snapshot:
+        raise ValueError("Extracting from the database needs a snapshot to key the cache on")
+    return f"database:{study.database_url or ''}:{snapshot}"
+
+
+def incremental_extract(study, output, cache, expectations_population=None, seed=0, snapshot=None):
+    """
+    Produces the extract for `study` at `output`, only extracting the
+    variables which aren't already in `cache` under their current definition
+    hash
+
+    Returns the names of the variables which were extracted.
+    """
+    definitions = study.covariate_definitions
+    source = data_source(study, expectations_population, seed, snapshot)
+    hashes = variable_hashes(
+        definitions, source, include_expectations=bool(expectations_population)
+    )
+    columns = output_columns(definitions)
+    missing = [name for name in columns if not cache.has(name, hashes[name])]
+
+    if missing:
+        logger.info(f"Extracting {len(missing)} of {len(columns)} variables: {', '.join(missing)}")
+        subset = subset_study(study, missing)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_output = Path(tmp_dir) / "subset.csv"
+            extract_to_csv(subset, tmp_output, expectations_population, seed)
+            extracted = pd.read_csv(tmp_output, dtype=str, keep_default_na=False)
+        extracted["patient_id"] = extracted["patient_id"].astype("int64")
+        extracted = extracted.sort_values("patient_id", kind="stable")
+        patient_ids = pa.array(extracted["patient_id"].values)
+        for name in missing:
+            table = pa.table({"patient_id": patient_ids, name: pa.array(extracted[name].values, pa.string())})
+            cache.write(name, hashes[name], table)
+    else:
+        logger.info(f"All {len(columns)} variables are up to date")
+
+    assemble(cache, hashes, columns, output)
+    return missing
+
+
+def assemble(cache, hashes, columns, output):
+    """
+    Reassembles the extract from cached columns
+
+    Every column was extracted for the same population (the population
+    definition is part of each hash), so after sorting by `patient_id` they
+    line up row for row.
+    """
+    data = {}
+    patient_ids = None
+    for name in columns:
+        table = cache.read(name, hashes[name])
+        ids = table.column("patient_id").to_numpy()
+        if patient_ids is None:
+            patient_ids = ids
+        elif not np.array_equal(ids, patient_ids):
+            raise RuntimeError(f"Cached column {name} has different patients to the rest of the extract")
+        data[name] = table.column(name).to_numpy(zero_copy_only=False)
+    df = pd.DataFrame(data)
+    df.insert(0, "patient_id", patient_ids)
+    df.to_csv(output, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract the cohort, reusing cached columns whose definitions haven't changed"
+    )
+    parser.add_argument("--output", default="output/input.csv")
+    parser.add_argument("--cache-dir", default=str(DEFAULT_CACHE_DIR))
+    parser.add_argument(
+        "--expectations-population",
+        type=int,
+        help="generate dummy data for this many patients instead of querying the database",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--snapshot",
+        help="version of the database being extracted from, e.g. the date of its last refresh "
+        "(required unless --expectations-population is given)",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="discard all cached columns first",
+    )
+    args = parser.parse_args()
+    if not args.expectations_population and not args.snapshot:
+        parser.error("--snapshot is required when extracting from the database")
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    from study_definition import study
+
+    cache = VariableCache(args.cache_dir)
+    if args.refresh:
+        cache.clear()
+    incremental_extract(study, args.output, cache, args.expectations_population, args.seed, args.snapshot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import argparse
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from codearrays import CodeArray, common_system, intern_codes
+
+# The cohortextractor functions used by `medication_counts_and_dates`, and the
+# name we give to the event table each one reads from
+MEDICATION_SOURCES = {
+    "with_these_medications": "medications",
+    "with_high_cost_drugs": "high_cost_drugs",
+}
+
+MEDICATION_VARIABLE = re.compile(r"^(?P<drug>.+)_(?P<window>\d+m_\d+m)$")
+
+MedicationVariable = namedtuple(
+    "MedicationVariable", ["name", "drug", "start", "end", "returning"]
+)
+MedicationPlan = namedtuple("MedicationPlan", ["code_to_drug", "codes", "variables"])
+
+
+def codelist_for_definition(funcname, kwargs):
+    if funcname == "with_high_cost_drugs":
+        return kwargs["drug_name_matches"]
+    return kwargs["codelist"]
+
+
+def build_medication_plans(covariate_definitions):
+    """
+    Collects the medication variables in a study definition into one plan per
+    source table
+
+    Each plan holds a single code -> drug mapping merged from every per-drug
+    codelist (a code may map to more than one drug) along with the
+    drug x window variables to emit. Variable names, periods and return types
+    are taken straight from the study definition so the output matches what
+    `medication_counts_and_dates` asks cohortextractor for.
+    """
+    mappings = {source: {} for source in MEDICATION_SOURCES.values()}
+    variables = {source: [] for source in MEDICATION_SOURCES.values()}
+    codelists = {source: [] for source in MEDICATION_SOURCES.values()}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        if funcname not in MEDICATION_SOURCES:
+            continue
+        match = MEDICATION_VARIABLE.match(name)
+        if not match:
+            continue
+        source = MEDICATION_SOURCES[funcname]
+        drug = match.group("drug")
+        codelist = codelist_for_definition(funcname, kwargs)
+        codelists[source].append(codelist)
+        for code in codelist:
+            mappings[source].setdefault(code, set()).add(drug)
+        start, end = kwargs["between"]
+        variables[source].append(
+            MedicationVariable(name, drug, start, end, kwargs["returning"])
+        )
+
+    plans = {}
+    for source, mapping in mappings.items():
+        if not variables[source]:
+            continue
+        code_to_drug = pd.DataFrame(
+            [(code, drug) for code, drugs in mapping.items() for drug in sorted(drugs)],
+            columns=["code", "drug"],
+        )
+        codes = CodeArray(mapping, system=common_system(codelists[source]))
+        plans[source] = MedicationPlan(code_to_drug, codes, variables[source])
+    return plans
+
+
+def window_mask(dates, start, end):
+    mask = np.ones(len(dates), dtype=bool)
+    if start is not None:
+        mask &= dates >= np.datetime64(start)
+    if end is not None:
+        mask &= dates <= np.datetime64(end)
+    return mask
+
+
+def match_drugs(plan, events, drug_lookup=None):
+    """
+    Returns the rows of `events` with a code in any of the plan's codelists,
+    with a `drug` column (and a row per drug for a code in several)
+
+    Matching rows are picked out with one sorted-array lookup, and only those
+    are joined against the merged code -> drug mapping. High cost drug events
+    can be matched through a `drug_lookup` instead (see
+    `match_drugs_by_lookup`).
+    """
+    if drug_lookup is not None:
+        return match_drugs_by_lookup(plan, events, drug_lookup)
+    events = intern_codes(events)
+    events = events[plan.codes.contains(events["code"])]
+    events = events.assign(code=events["code"].astype(object))
+    return events[["patient_id", "code", "date"]].merge(
+        plan.code_to_drug, on="code", how="inner"
+    )
+
+
+def match_drugs_by_lookup(plan, events, drug_lookup):
+    """
+    `match_drugs` for high cost drug names, joining each event to its clean
+    drug through a name -> drug lookup (see `druglists.read_lookup`)
+
+    Each distinct name is normalised and looked up once, so the cost doesn't
+    grow with the number of drugs, and names added to the lookup since the
+    study's codelists were made are matched too. The plan's drugs are the
+    study's variable prefixes (`methotrexate_hcd` for methotrexate); each is
+    tied to the clean drug its codelist's names look up to.
+    """
+    from druglists import normalise
+
+    events = intern_codes(events)
+    names = events["code"].cat.categories
+    clean_drugs = drug_lookup.reindex([normalise(str(name)) for name in names]).values
+    codes = events["code"].cat.codes.values
+    found = codes >= 0
+    found[found] = pd.notna(clean_drugs[codes[found]])
+    matched = events.loc[found, ["patient_id", "code", "date"]].assign(clean_drug=clean_drugs[codes[found]])
+    matched["code"] = matched["code"].astype(object)
+
+    codelist_names = plan.code_to_drug["code"].map(lambda name: normalise(str(name)))
+    study_drugs = plan.code_to_drug.assign(clean_drug=drug_lookup.reindex(codelist_names).values)
+    study_drugs = study_drugs.dropna(subset=["clean_drug"])[["clean_drug", "drug"]].drop_duplicates()
+    return matched.merge(study_drugs, on="clean_drug", how="inner")[["patient_id", "code", "date", "drug"]]
+
+
+def extract_medications(plan, events, patient_ids=None, drug_lookup=None):
+    """
+    Emits the whole drug x window matrix for one source table in a single pass
+
+    `events` has one row per prescription (or high cost drug issue) with
+    `patient_id`, `code` and `date` columns. It is matched once against the
+    merged code -> drug mapping, after which every window is just a boolean
+    column over the (much smaller) matched rows, summed in a single groupby.
+    Counts are returned for `number_of_matches_in_period` variables and 0/1
+    for `binary_flag` variables, with 0 for patients without a match.
+    """
+    matched = match_drugs(plan, events, drug_lookup)
+    dates = pd.to_datetime(matched["date"]).values
+
+    windows = {}
+    for variable in plan.variables:
+        key = (variable.start, variable.end)
+        if key not in windows:
+            windows[key] = f"window_{len(windows)}"
+            matched[windows[key]] = window_mask(dates, *key)
+
+    counts = matched.groupby(["patient_id", "drug"])[list(windows.values())].sum()
+
+    columns = {}
+    for variable in plan.variables:
+        column = counts[windows[(variable.start, variable.end)]]
+        try:
+            column = column.xs(variable.drug, level="drug")
+        except KeyError:
+            column = pd.Series([], dtype="int64", index=pd.Index([], name="patient_id"))
+        if variable.returning == "binary_flag":
+            column = (column > 0).astype("int64")
+        columns[variable.name] = column
+
+    result = pd.DataFrame(columns)
+    if patient_ids is not None:
+        result = result.reindex(pd.Index(patient_ids, name="patient_id"))
+    return result.fillna(0).astype("int64")
+
+
+def extract_all_medications(covariate_definitions, tables, patient_ids=None, drug_lookup=None):
+    """
+    Runs every medication plan in a study definition against its event table
+
+    `tables` maps the source names in `MEDICATION_SOURCES` to event dataframes.
+    A `drug_lookup` is used for the high cost drugs table.
+    """
+    plans = build_medication_plans(covariate_definitions)
+    results = [
+        extract_medications(plan, tables[source], patient_ids, drug_lookup if source == "high_cost_drugs" else None)
+        for source, plan in plans.items()
+    ]
+    result = pd.concat(results, axis=1).fillna(0).astype("int64")
+    # Keep the column order of the study definition
+    order = [name for name in covariate_definitions if name in result.columns]
+    return result[order]
+
+
+def read_events(path):
+    if str(path).endswith(".parquet"):
+        return intern_codes(pd.read_parquet(path))
+    return pd.read_csv(path, dtype={"code": "category"})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract all medication counts and flags from event-level tables"
+    )
+    parser.add_argument("--medications", required=True, help="prescribing events file")
+    parser.add_argument("--high-cost-drugs", required=True, help="high cost drug events file")
+    parser.add_argument("--output", default="output/medications.csv")
+    parser.add_argument(
+        "--drug-lookup",
+        help="match high cost drug names through this lookup, from druglists.py build",
+    )
+    args = parser.parse_args()
+
+    from study_definition import study
+
+    tables = {
+        "medications": read_events(args.medications),
+        "high_cost_drugs": read_events(args.high_cost_drugs),
+    }
+    drug_lookup = None
+    if args.drug_lookup:
+        from druglists import read_lookup
+
+        drug_lookup = read_lookup(args.drug_lookup)
+    result = extract_all_medications(study.covariate_definitions, tables, drug_lookup=drug_lookup)
+    result.to_csv(args.output)
+
+
+if __name__ == "__main__":
+    main()
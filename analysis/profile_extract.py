@@ -0,0 +1,269 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import resource
+import time
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPORT = Path("output") / "extract_profile.json"
+
+# cohortextractor's TPP backend labels each variable's final query and the
+# index it then builds on the variable's temporary table
+QUERY_FOR = re.compile(r"^\s*--\s*Query for (\w+)")
+INDEX_ON = re.compile(r"^\s*CREATE CLUSTERED INDEX \w+ ON #(\w+)")
+
+# Server-side statistics for the most recent run of a variable's query. This
+# needs VIEW SERVER STATE; without it these columns are left empty.
+SERVER_STATS_QUERY = """
+SELECT TOP 1 qs.last_logical_reads, qs.last_used_grant_kb
+FROM sys.dm_exec_query_stats qs
+CROSS APPLY sys.dm_exec_sql_text(qs.sql_handle) st
+WHERE st.text LIKE '%-- Query for {name}' + CHAR(10) + '%'
+ORDER BY qs.last_execution_time DESC
+"""
+
+# Variables which are evaluated as expressions in the final join rather than
+# by queries of their own
+JOIN_FUNCTIONS = ["categorised_as", "value_from", "aggregate_of", "fixed_value"]
+
+
+def variable_for_query(query):
+    match = QUERY_FOR.match(query) or INDEX_ON.match(query)
+    return match.group(1) if match else None
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def current_rss_kb():
+    """
+    The process's resident memory now, or None where /proc isn't available
+
+    Unlike the peak, this goes down as memory is freed, so the difference
+    across a variable is what that variable added.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def new_record(name, funcname):
+    return {
+        "name": name,
+        "function": funcname,
+        "wall_time": 0.0,
+        "rows_returned": None,
+        "logical_reads": None,
+        "memory_grant_kb": None,
+        "client_rss_delta_kb": None,
+        "query_hash": None,
+        "queries": [],
+    }
+
+
+class ExtractProfiler:
+    """
+    Records the cost of each variable while a StudyDefinition's backend runs
+
+    Replaces the backend's `execute_queries`, attributing each query to the
+    variable it belongs to: queries up to and including the `Query for <name>`
+    statement (codelist uploads, intermediate tables) and the index built on
+    `#<name>` afterwards. Once a variable's table exists, its rows are counted
+    and, where the server allows, the logical reads and memory grant of its
+    query are looked up, along with the change in the client's resident memory
+    since the previous variable finished.
+    """
+
+    def __init__(self, study):
+        self.study = study
+        self.backend = study.backend
+        self.records = {
+            name: new_record(name, funcname)
+            for name, (funcname, kwargs) in study.covariate_definitions.items()
+        }
+        self.pending = []
+        self.server_stats = True
+        self.rss_kb = None
+
+    def execute_queries(self, queries):
+        cursor = self.backend.get_db_connection().cursor()
+        for query in queries:
+            name = variable_for_query(query)
+            start = time.perf_counter()
+            cursor.execute(query)
+            elapsed = time.perf_counter() - start
+            if name not in self.records:
+                # Set-up for a variable whose own query comes later
+                self.pending.append((query, elapsed))
+                continue
+            record = self.records[name]
+            for pending_query, pending_elapsed in self.pending:
+                record["queries"].append(pending_query)
+                record["wall_time"] += pending_elapsed
+            self.pending = []
+            record["queries"].append(query)
+            record["wall_time"] += elapsed
+            if INDEX_ON.match(query):
+                self.finish_variable(cursor, record)
+        return cursor
+
+    def finish_variable(self, cursor, record):
+        name = record["name"]
+        cursor.execute(f"SELECT COUNT(*) FROM #{name}")
+        record["rows_returned"] = cursor.fetchone()[0]
+        rss_kb = current_rss_kb()
+        if rss_kb is not None and self.rss_kb is not None:
+            record["client_rss_delta_kb"] = rss_kb - self.rss_kb
+        self.rss_kb = rss_kb
+        record["query_hash"] = hashlib.sha256("\n".join(record["queries"]).encode()).hexdigest()
+        if self.server_stats:
+            try:
+                cursor.execute(SERVER_STATS_QUERY.format(name=name))
+                row = cursor.fetchone()
+            except Exception as e:
+                logger.warning(f"Server statistics unavailable: {e}")
+                self.server_stats = False
+            else:
+                if row:
+                    record["logical_reads"], record["memory_grant_kb"] = row
+
+    def run(self, output):
+        """
+        Runs the extract to `output`, returning the profile report
+        """
+        self.backend.execute_queries = self.execute_queries
+        self.rss_kb = current_rss_kb()
+        start = time.perf_counter()
+        try:
+            self.backend.to_file(output)
+        finally:
+            del self.backend.execute_queries
+        total = time.perf_counter() - start
+        variables = list(self.records.values())
+        for record in variables:
+            if record["function"] in JOIN_FUNCTIONS:
+                record["query_hash"] = definition_hash(self.study.covariate_definitions[record["name"]])
+        return {
+            "total_time": total,
+            # Everything not attributed to a variable: the final join of all the
+            # variables' tables, and downloading and writing the results
+            "join_and_download_time": total - sum(record["wall_time"] for record in variables),
+            "client_peak_rss_kb": peak_rss_kb(),
+            "variables": variables,
+        }
+
+
+def definition_hash(definition):
+    funcname, kwargs = definition
+    kwargs = {key: value for key, value in kwargs.items() if key != "return_expectations"}
+    return hashlib.sha256(repr((funcname, sorted(kwargs.items()))).encode()).hexdigest()
+
+
+def generated_queries(study):
+    """
+    The queries cohortextractor would run for each variable, without connecting
+    to a database
+    """
+    from cohortextractor.tpp_backend import TPPBackend
+
+    definitions = study.covariate_definitions
+    records = {name: new_record(name, funcname) for name, (funcname, kwargs) in definitions.items()}
+    pending = []
+    # Without a database the dm+d codelists can't be expanded with previous
+    # codes (as when generating dummy data), so those lists may be shorter
+    backend = TPPBackend("mssql://localhost/db", {}, dummy_data=True)
+    for query in backend.get_queries(definitions):
+        name = variable_for_query(query)
+        if name not in records:
+            pending.append(query)
+            continue
+        records[name]["queries"].extend(pending + [query])
+        pending = []
+    for name, record in records.items():
+        if record["queries"]:
+            record["query_hash"] = hashlib.sha256("\n".join(record["queries"]).encode()).hexdigest()
+        else:
+            record["query_hash"] = definition_hash(definitions[name])
+    return {"variables": list(records.values())}
+
+
+def format_summary(report, previous=None):
+    """
+    Variables sorted by wall time, with each one's share of the total and, if a
+    previous report is given, how its time and row count have changed and
+    whether its query has
+    """
+    previous_records = {record["name"]: record for record in (previous or {}).get("variables", [])}
+    total = report.get("total_time") or 0
+    lines = [f"{'variable':<40} {'function':<40} {'seconds':>9} {'share':>6} {'rows':>11}"]
+    if previous:
+        lines[0] += f" {'vs previous':>12}  change"
+    for record in sorted(report["variables"], key=lambda r: r["wall_time"], reverse=True):
+        share = f"{record['wall_time'] / total:.1%}" if total else ""
+        rows = "" if record["rows_returned"] is None else f"{record['rows_returned']:,}"
+        line = f"{record['name']:<40} {record['function']:<40} {record['wall_time']:>9.2f} {share:>6} {rows:>11}"
+        old = previous_records.get(record["name"])
+        if previous and old:
+            ratio = f"{record['wall_time'] / old['wall_time']:.2f}x" if old["wall_time"] else ""
+            if old["query_hash"] != record["query_hash"]:
+                change = "definition changed"
+            elif old["rows_returned"] != record["rows_returned"]:
+                change = "data changed"
+            else:
+                change = ""
+            line += f" {ratio:>12}  {change}"
+        lines.append(line)
+    if "join_and_download_time" in report:
+        lines.append(f"{'(final join and download)':<40} {'':<40} {report['join_and_download_time']:>9.2f}")
+        lines.append(f"{'(total)':<40} {'':<40} {total:>9.2f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the cohort extract recording the cost of each variable"
+    )
+    parser.add_argument("--output", default="output/input.csv")
+    parser.add_argument("--report", default=str(DEFAULT_REPORT))
+    parser.add_argument("--compare", help="previous report to compare against")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only record the queries each variable would run",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    from study_definition import study
+
+    if args.dry_run:
+        report = generated_queries(study)
+    else:
+        study.assert_backend_is_configured()
+        report = ExtractProfiler(study).run(args.output)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    summary = format_summary(report, previous)
+    with open(Path(args.report).with_suffix(".txt"), "w") as f:
+        f.write(summary + "\n")
+    print(summary)
+
+
+if __name__ == "__main__":
+    main()
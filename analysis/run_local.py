@@ -0,0 +1,451 @@
+import argparse
+import ast
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import yaml
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_DIR = Path("output") / "run_local"
+STATE_FILE = "state.json"
+
+# Local commands standing in for each action image. The run line's arguments
+# after the image are appended, except that `python:latest python ...` drops
+# its own `python`.
+RUNNERS = {
+    "python": [sys.executable],
+    "stata-mp": ["stata-mp", "-b", "do"],
+    "r": ["Rscript"],
+    "cohortextractor": ["cohortextractor"],
+}
+
+# Memory assumed for an action that has never run before, when there's no
+# peak from a previous run to go on
+DEFAULT_ACTION_MEMORY = 2 * 2 ** 30
+
+# Codelists the study definition reads
+CODELIST_DIRS = ["codelists", "crossimid-codelists"]
+
+R_SOURCE = re.compile(r"""\bsource\(\s*["']([^"']+)["']""")
+
+# How Stata reports an error in a log. In batch mode it still exits with 0.
+STATA_ERROR = re.compile(r"^r\((\d+)\);\s*$", re.MULTILINE)
+
+Action = namedtuple("Action", ["name", "image", "args", "runner", "command", "needs", "outputs", "script"])
+
+
+def load_project(path="project.yaml", runners=None):
+    """
+    Reads the actions in `project.yaml`, with the local command to run each
+    """
+    runners = dict(RUNNERS, **(runners or {}))
+    with open(path) as f:
+        project = yaml.safe_load(f)
+    population_size = (project.get("expectations") or {}).get("population_size")
+    actions = {}
+    for name, details in project["actions"].items():
+        image, *args = shlex.split(details["run"])
+        image = image.split(":")[0]
+        if image not in runners:
+            raise ValueError(f"No local runner for {image} (used by {name}); pass --runner {image}=COMMAND")
+        if image == "python" and args[:1] == ["python"]:
+            args = args[1:]
+        if image == "cohortextractor" and population_size and "--expectations-population" not in args:
+            args += ["--expectations-population", str(population_size)]
+        if image == "cohortextractor":
+            study = args[args.index("--study-definition") + 1] if "--study-definition" in args else "study_definition"
+            script = f"analysis/{study}.py"
+        else:
+            script = args[0]
+        outputs = [
+            pattern
+            for privacy_level in (details.get("outputs") or {}).values()
+            for pattern in privacy_level.values()
+        ]
+        actions[name] = Action(
+            name, image, args, runners[image], runners[image] + args, list(details.get("needs") or []), outputs, script
+        )
+    for action in actions.values():
+        unknown = set(action.needs) - set(actions)
+        if unknown:
+            raise ValueError(f"{action.name} needs unknown actions: {', '.join(sorted(unknown))}")
+    return actions
+
+
+def with_needs(actions, names):
+    """
+    Returns `names` plus every action they need, transitively, in the order
+    they appear in `project.yaml`
+    """
+    wanted = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in actions:
+            raise ValueError(f"Unknown action {name}")
+        if name not in wanted:
+            wanted.add(name)
+            pending.extend(actions[name].needs)
+    return [name for name in actions if name in wanted]
+
+
+def support_files(action):
+    """
+    The files an action's script reads besides its inputs: the local modules
+    a Python script imports (transitively), the files an R script `source`s,
+    the Stata ados, and the study definition's codelists
+    """
+    script = Path(action.script)
+    if action.image in ("python", "cohortextractor"):
+        files = []
+        pending = [script]
+        while pending:
+            path = pending.pop()
+            if path in files or not path.exists():
+                continue
+            files.append(path)
+            for node in ast.walk(ast.parse(path.read_text())):
+                if isinstance(node, ast.Import):
+                    modules = [alias.name for alias in node.names]
+                elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                    modules = [node.module]
+                else:
+                    continue
+                pending.extend(script.parent / f"{module.split('.')[0]}.py" for module in modules)
+        if action.image == "cohortextractor":
+            for directory in CODELIST_DIRS:
+                files.extend(sorted(Path(directory).glob("*.csv")))
+        return files[1:]
+    if action.image == "r":
+        return [Path(path) for path in R_SOURCE.findall(script.read_text())] if script.exists() else []
+    if action.image == "stata-mp":
+        return sorted(path for path in Path("analysis/extra_ados").rglob("*") if path.is_file())
+    return []
+
+
+def expand(patterns):
+    return sorted({Path(path) for pattern in patterns for path in glob.glob(pattern)})
+
+
+class FileHashes:
+    """
+    SHA-256 of files, remembered between runs against each file's size and
+    modification time so unchanged files aren't read again
+    """
+
+    def __init__(self, known=None):
+        self.known = dict(known or {})
+        self.lock = threading.Lock()
+
+    def __call__(self, path):
+        stat = path.stat()
+        key = str(path)
+        with self.lock:
+            size, mtime_ns, digest = self.known.get(key, (None, None, None))
+        if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            return digest
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2 ** 20), b""):
+                sha.update(block)
+        with self.lock:
+            self.known[key] = (stat.st_size, stat.st_mtime_ns, sha.hexdigest())
+        return sha.hexdigest()
+
+
+def action_key(action, actions, file_hash):
+    """
+    A hash of everything an action's result depends on: its command, its
+    script and the files the script reads, and the outputs of the actions it
+    needs
+
+    Returns None if the script or one of the needed outputs is missing.
+    """
+    script = Path(action.script)
+    inputs = expand(pattern for need in action.needs for pattern in actions[need].outputs)
+    if not script.exists() or any(not expand([pattern]) for need in action.needs for pattern in actions[need].outputs):
+        return None
+    contents = {
+        "command": [action.image] + action.args,
+        "files": {str(path): file_hash(path) for path in [script] + support_files(action) + inputs if path.exists()},
+    }
+    return hashlib.sha256(json.dumps(contents, sort_keys=True).encode()).hexdigest()
+
+
+def outputs_unchanged(action, record, file_hash):
+    paths = expand(action.outputs)
+    if not paths or any(not expand([pattern]) for pattern in action.outputs):
+        return False
+    return {str(path): file_hash(path) for path in paths} == record.get("outputs")
+
+
+def remove_outputs(action):
+    """
+    Deletes whatever an earlier run left at the action's output paths, so a
+    run which fails to write an output is caught rather than passing off the
+    old file as its own
+    """
+    for path in expand(action.outputs):
+        if path.is_file():
+            path.unlink()
+
+
+def stata_wrapper(action, work_dir):
+    """
+    Writes a do-file named after the action which runs the action's do-file
+    from the project directory, returning its directory
+
+    `stata-mp -b do` writes its log to `<do-file name>.log` in the working
+    directory, which every action running the same do-file would share.
+    Running the wrapper from its own directory gives each action its own
+    log. The do-files take the project directory from `c(pwd)`, so the
+    wrapper changes to it first.
+    """
+    directory = work_dir / action.name
+    directory.mkdir(parents=True, exist_ok=True)
+    arguments = " ".join(f'`"{arg}"\'' for arg in action.args)
+    (directory / f"{action.name}.do").write_text(f'cd `"{Path.cwd()}"\'\ndo {arguments}\n')
+    return directory
+
+
+def run_action(action, log_dir, work_dir):
+    """
+    Runs an action's command from the project directory, sending its output
+    to `<log_dir>/<name>.log`
+
+    Stata actions run through `stata_wrapper`, and their batch log is added
+    to the action's log afterwards. Returns the exit code, or for Stata the
+    first error code in its log, and the process's peak resident memory in
+    bytes.
+    """
+    log_dir.mkdir(parents=True, exist_ok=True)
+    command, cwd = action.command, None
+    if action.image == "stata-mp":
+        cwd = stata_wrapper(action, work_dir)
+        command = action.runner + [f"{action.name}.do"]
+    with open(log_dir / f"{action.name}.log", "w") as log:
+        try:
+            process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            log.write(f"{e}\n")
+            return 127, 0
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if cwd is not None and (cwd / f"{action.name}.log").exists():
+            stata_log = (cwd / f"{action.name}.log").read_text(errors="replace")
+            log.write(stata_log)
+            error = STATA_ERROR.search(stata_log)
+            if error and not process.returncode:
+                process.returncode = int(error.group(1))
+    # ru_maxrss is in kilobytes on Linux
+    return process.returncode, usage.ru_maxrss * 1024
+
+
+def load_state(state_dir):
+    path = Path(state_dir) / STATE_FILE
+    if not path.exists():
+        return {"actions": {}, "files": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state, state_dir):
+    path = Path(state_dir) / STATE_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+        f.write("\n")
+    os.replace(tmp_path, path)
+
+
+def new_result(name):
+    return {"name": name, "status": None, "seconds": None, "peak_rss_bytes": None}
+
+
+def run_pipeline(actions, names, cores, memory, state_dir=DEFAULT_STATE_DIR, force=()):
+    """
+    Runs the named actions and everything they need, starting each one as
+    soon as the actions it needs have succeeded and the budget allows
+
+    Each running action counts as one core, and as much memory as its peak on
+    its last run (or `DEFAULT_ACTION_MEMORY` if it has never run). An action
+    is skipped when its key (see `action_key`) matches its last successful
+    run and its outputs are still as that run left them. When an action
+    fails, the actions needing it are blocked but everything else carries on.
+
+    Returns a list of per-action results in `project.yaml` order.
+    """
+    state_dir = Path(state_dir)
+    state = load_state(state_dir)
+    file_hash = FileHashes(state["files"])
+    names = with_needs(actions, names)
+    results = {name: new_result(name) for name in names}
+    remaining = {name: set(actions[name].needs) for name in names}
+    running = {}
+    free = {"cores": cores, "memory": memory}
+
+    def estimate(name):
+        return state["actions"].get(name, {}).get("peak_rss_bytes") or DEFAULT_ACTION_MEMORY
+
+    def timed(action):
+        remove_outputs(action)
+        start = time.perf_counter()
+        returncode, peak = run_action(action, state_dir / "logs", state_dir / "work")
+        return returncode, peak, time.perf_counter() - start
+
+    def finish(name, status):
+        results[name]["status"] = status
+        for waiting_name, waiting in list(remaining.items()):
+            if waiting_name not in remaining or name not in waiting:
+                continue
+            if status in ("ran", "cached"):
+                waiting.discard(name)
+            else:
+                del remaining[waiting_name]
+                finish(waiting_name, "blocked")
+
+    def start_ready():
+        """
+        Starts whatever is ready and fits the budget, returning True if a
+        skipped action may have made another ready
+        """
+        skipped = False
+        for name in [name for name, waiting in remaining.items() if not waiting]:
+            action = actions[name]
+            key = action_key(action, actions, file_hash)
+            record = state["actions"].get(name, {})
+            if (
+                name not in force
+                and key is not None
+                and record.get("key") == key
+                and outputs_unchanged(action, record, file_hash)
+            ):
+                del remaining[name]
+                logger.info(f"{name}: unchanged, skipping")
+                finish(name, "cached")
+                skipped = True
+                continue
+            needed = min(estimate(name), memory)
+            if running and (free["cores"] < 1 or free["memory"] < needed):
+                continue
+            del remaining[name]
+            free["cores"] -= 1
+            free["memory"] -= needed
+            logger.info(f"{name}: running")
+            running[executor.submit(timed, action)] = (name, key, needed)
+        return skipped
+
+    with ThreadPoolExecutor(max(cores, 1)) as executor:
+        while remaining or running:
+            while start_ready():
+                pass
+            if not running:
+                if remaining:
+                    raise ValueError(f"Circular needs between {', '.join(sorted(remaining))}")
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, key, needed = running.pop(future)
+                free["cores"] += 1
+                free["memory"] += needed
+                returncode, peak, seconds = future.result()
+                action = actions[name]
+                results[name].update(seconds=round(seconds, 3), peak_rss_bytes=peak)
+                missing = [pattern for pattern in action.outputs if not expand([pattern])]
+                if returncode != 0 or missing:
+                    reason = f"exit code {returncode}" if returncode else f"missing outputs {', '.join(missing)}"
+                    logger.error(f"{name}: failed with {reason}; see {state_dir / 'logs' / (name + '.log')}")
+                    state["actions"].pop(name, None)
+                    finish(name, "failed")
+                else:
+                    logger.info(f"{name}: done in {seconds:.1f}s")
+                    state["actions"][name] = {
+                        "key": key,
+                        "outputs": {str(path): file_hash(path) for path in expand(action.outputs)},
+                        "seconds": round(seconds, 3),
+                        "peak_rss_bytes": peak,
+                    }
+                    finish(name, "ran")
+                state["files"] = file_hash.known
+                save_state(state, state_dir)
+    return [results[name] for name in names]
+
+
+def format_results(results):
+    lines = [f"{'action':<48} {'status':<8} {'seconds':>9} {'peak MB':>9}"]
+    for result in results:
+        seconds = "" if result["seconds"] is None else f"{result['seconds']:.1f}"
+        peak = "" if result["peak_rss_bytes"] is None else f"{result['peak_rss_bytes'] / 2 ** 20:.0f}"
+        lines.append(f"{result['name']:<48} {result['status']:<8} {seconds:>9} {peak:>9}")
+    ran = [result["seconds"] for result in results if result["status"] == "ran"]
+    counts = {status: sum(result["status"] == status for result in results) for status in ["ran", "cached", "failed", "blocked"]}
+    lines.append(", ".join(f"{count} {status}" for status, count in counts.items()) + f"; {sum(ran):.1f}s of action time")
+    return "\n".join(lines)
+
+
+# Not imported from sharded_dummy_data, which loads pandas: the kernel counts this
+# process's memory at the time an action starts towards the action's peak, so
+# this module stays small
+def parse_size(value):
+    units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+
+def parse_runner(value):
+    image, _, command = value.partition("=")
+    if not command:
+        raise argparse.ArgumentTypeError("expected IMAGE=COMMAND, e.g. stata-mp=/usr/local/stata/stata-mp -b do")
+    return image, shlex.split(command)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run project.yaml actions locally, in parallel, skipping any whose inputs haven't changed"
+    )
+    parser.add_argument("actions", nargs="*", help="actions to run (and what they need); defaults to all")
+    parser.add_argument("--project", default="project.yaml")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="actions to run at once")
+    parser.add_argument("--memory", type=parse_size, default="16G", help="memory budget, e.g. 16G")
+    parser.add_argument("--force", nargs="*", default=[], help="actions to run even if unchanged")
+    parser.add_argument("--runner", type=parse_runner, action="append", default=[], help="IMAGE=COMMAND")
+    parser.add_argument("--state-dir", default=str(DEFAULT_STATE_DIR))
+    parser.add_argument("--report", help="defaults to report.json in --state-dir")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    actions = load_project(args.project, dict(args.runner))
+    results = run_pipeline(
+        actions,
+        args.actions or list(actions),
+        args.cores,
+        args.memory,
+        state_dir=args.state_dir,
+        force=set(args.force),
+    )
+    with open(args.report or Path(args.state_dir) / "report.json", "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "actions": results}, f, indent=2)
+        f.write("\n")
+    print(format_results(results))
+    if any(result["status"] in ("failed", "blocked") for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
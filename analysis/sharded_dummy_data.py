@@ -0,0 +1,179 @@
+import argparse
+import importlib
+import logging
+import resource
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dummy_data import DummyDataGenerator, write_chunks
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARD_DIR = Path("output") / "shards"
+
+# A shard is a run of `chunks` of the generator's chunks, starting with
+# `first_chunk`, written to `output`
+Shard = namedtuple("Shard", ["index", "output", "first_chunk", "chunks"])
+
+
+def split_chunks(chunk_count, shards):
+    """
+    Splits the generator's chunk indexes into at most `shards` contiguous runs
+    of (nearly) equal length
+    """
+    return [chunks for chunks in np.array_split(np.arange(chunk_count), shards) if len(chunks)]
+
+
+def limit_memory(max_bytes):
+    """
+    Caps the address space of the current (worker) process, so a shard which
+    needs more than `max_bytes` fails with a MemoryError rather than pushing
+    the node into swap
+
+    Linux doesn't enforce a limit on resident memory, so this limits virtual
+    memory, which is always at least as large.
+    """
+    if max_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+
+
+def load_study(module):
+    return importlib.import_module(module).study
+
+
+def generate_shard(shard, study_module, population, chunksize=500_000, seed=0):
+    """
+    Generates one shard of dummy data to its own CSV file
+
+    A shard is a run of the generator's chunks, so the merged output is the
+    same as `dummy_data.py` with the same seed and chunk size.
+    """
+    study = load_study(study_module)
+    generator = DummyDataGenerator(study, seed=seed)
+    chunks = (
+        generator.generate_chunk(start + 1, min(chunksize, population - start), chunk_index)
+        for chunk_index in range(shard.first_chunk, shard.first_chunk + shard.chunks)
+        for start in [chunk_index * chunksize]
+    )
+    write_chunks(chunks, shard.output, study)
+    return shard.index
+
+
+def plan_shards(shard_dir, shards, population, chunksize=500_000):
+    """
+    Divides the generator's chunks into at most `shards` runs
+    """
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    chunk_count = -(-population // chunksize)
+    return [
+        Shard(index, shard_dir / f"shard_{index:04d}.csv", int(chunks[0]), len(chunks))
+        for index, chunks in enumerate(split_chunks(chunk_count, shards))
+    ]
+
+
+def iter_shard_outputs(shards):
+    """
+    Reads the shard outputs back in shard order, one at a time, each sorted by
+    `patient_id`
+
+    Each chunk, and so each shard, covers a contiguous range of patient ids,
+    in ascending order, so this yields the whole dataset sorted by
+    `patient_id`, whatever order the shards finished in.
+    """
+    columns = None
+    for shard in shards:
+        df = pd.read_csv(shard.output, dtype=str, keep_default_na=False)
+        if columns is None:
+            columns = list(df.columns)
+        elif list(df.columns) != columns:
+            raise RuntimeError(f"Shard {shard.index} has different columns to the other shards")
+        order = np.argsort(df["patient_id"].astype("int64").values, kind="stable")
+        yield df.iloc[order]
+
+
+def sharded_dummy_data(
+    study,
+    output,
+    shards,
+    workers,
+    population,
+    shard_dir=DEFAULT_SHARD_DIR,
+    study_module="study_definition",
+    max_worker_memory=None,
+    chunksize=500_000,
+    seed=0,
+):
+    """
+    Generates dummy data a shard at a time across a pool of worker processes,
+    then merges the shards into `output`
+
+    Each worker holds one shard at a time, so peak memory per worker depends
+    on the shard size rather than the population. The merge reads one shard
+    at a time too.
+    """
+    shard_dir = Path(shard_dir)
+    plan = plan_shards(shard_dir, shards, population, chunksize)
+    with ProcessPoolExecutor(workers, initializer=limit_memory, initargs=(max_worker_memory,)) as pool:
+        futures = [
+            pool.submit(generate_shard, shard, study_module, population, chunksize, seed)
+            for shard in plan
+        ]
+        for future, shard in zip(futures, plan):
+            try:
+                future.result()
+            except MemoryError:
+                raise MemoryError(
+                    f"Shard {shard.index} needed more than the worker memory limit; use more shards"
+                )
+            logger.info(f"Generated shard {shard.index + 1} of {len(plan)}")
+    write_chunks(iter_shard_outputs(plan), output, study)
+    for shard in plan:
+        shard.output.unlink()
+
+
+def parse_size(value):
+    units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate dummy data for the study definition in shards across a pool of workers"
+    )
+    parser.add_argument("--output", default="output/input.csv")
+    parser.add_argument("--shards", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--shard-dir", default=str(DEFAULT_SHARD_DIR))
+    parser.add_argument(
+        "--max-worker-memory",
+        type=parse_size,
+        help="memory limit for each worker, e.g. 8G",
+    )
+    parser.add_argument("--population", type=int, required=True, help="number of patients to generate")
+    parser.add_argument("--chunksize", type=int, default=500_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    sharded_dummy_data(
+        load_study("study_definition"),
+        args.output,
+        args.shards,
+        args.workers,
+        args.population,
+        shard_dir=args.shard_dir,
+        max_worker_memory=args.max_worker_memory,
+        chunksize=args.chunksize,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
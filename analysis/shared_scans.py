@@ -0,0 +1,294 @@
+import argparse
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from codearrays import CodeArray, intern_codes
+from diagnoses import format_dates
+
+
+# The cohortextractor functions whose variables can share a scan, and the name
+# we give to the event table each one reads from
+SCAN_SOURCES = {
+    "with_these_clinical_events": "clinical_events",
+    "with_these_codes_on_death_certificate": "ons_deaths",
+}
+
+# Clinical events coded in SNOMED CT are held in a separate table from those
+# coded in CTV3
+SNOMED_TABLES = {"clinical_events": "clinical_events_snomed"}
+
+SUPPORTED_RETURNING = {
+    "clinical_events": ["date", "numeric_value", "category", "binary_flag", "number_of_matches_in_period"],
+    "ons_deaths": ["binary_flag", "date_of_death"],
+}
+
+ScanVariable = namedtuple(
+    "ScanVariable",
+    [
+        "name",
+        "codes",
+        "code_array",
+        "between",
+        "returning",
+        "find_first",
+        "date_format",
+        "underlying_only",
+    ],
+)
+SharedScan = namedtuple("SharedScan", ["table", "codes", "system", "between", "variables"])
+
+
+def codes_of(codelist):
+    if codelist.has_categories:
+        return {code for code, _ in codelist}
+    return set(codelist)
+
+
+def scan_table(funcname, codelist):
+    table = SCAN_SOURCES[funcname]
+    if codelist.system == "snomed":
+        return SNOMED_TABLES.get(table, table)
+    return table
+
+
+def scan_variable(name, funcname, kwargs):
+    """
+    Returns a ScanVariable for a definition which can be computed from a shared
+    scan, or None for one which needs its own query
+    """
+    if funcname not in SCAN_SOURCES:
+        return None
+    if kwargs["returning"] not in SUPPORTED_RETURNING[SCAN_SOURCES[funcname]]:
+        return None
+    if kwargs.get("ignore_days_where_these_codes_occur") or kwargs.get("episode_defined_as"):
+        return None
+    codelist = kwargs["codelist"]
+    return ScanVariable(
+        name,
+        codes_of(codelist),
+        CodeArray.from_codelist(codelist),
+        tuple(kwargs["between"] or (None, None)),
+        kwargs["returning"],
+        bool(kwargs.get("find_first_match_in_period")),
+        kwargs.get("date_format"),
+        bool(kwargs.get("match_only_underlying_cause")),
+    )
+
+
+def period_union(periods):
+    starts = [start for start, _ in periods]
+    ends = [end for _, end in periods]
+    return (
+        None if None in starts else min(starts),
+        None if None in ends else max(ends),
+    )
+
+
+def plan_shared_scans(covariate_definitions):
+    """
+    Groups the variables which read the same table with overlapping codelists
+    into shared scans
+
+    Variables are joined into a group when they read the same table (SNOMED CT
+    and CTV3 clinical events are separate tables) and their codelists have any
+    code in common (so a codelist and a subset of it, like `ever_smoked` and
+    `most_recent_smoking_code`, share a scan). Each group scans once for the
+    union of its codes over the union of its periods, and every variable in it
+    is then derived from that result. Variables with no partner still get a
+    scan of their own, so the plan covers everything it can compute.
+    """
+    by_table = {}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        variable = scan_variable(name, funcname, kwargs)
+        if variable:
+            table = scan_table(funcname, kwargs["codelist"])
+            by_table.setdefault(table, []).append(variable)
+
+    order = {name: index for index, name in enumerate(covariate_definitions)}
+    scans = []
+    for table, variables in by_table.items():
+        groups = []
+        for variable in variables:
+            overlapping = [group for group in groups if group[0] & variable.codes]
+            merged = (set(variable.codes), [variable])
+            for group in overlapping:
+                groups.remove(group)
+                merged[0].update(group[0])
+                merged[1][:0] = group[1]
+            groups.append(merged)
+        for codes, members in groups:
+            members.sort(key=lambda v: order[v.name])
+            system = members[0].code_array.system
+            between = period_union([v.between for v in members])
+            scans.append(SharedScan(table, codes, system, between, members))
+    return scans
+
+
+def variables_by_table(scans):
+    """
+    Returns a dictionary of table name -> names of the variables the plan
+    reads from it
+    """
+    by_table = {}
+    for scan in scans:
+        by_table.setdefault(scan.table, []).extend(variable.name for variable in scan.variables)
+    return by_table
+
+
+def value_from_dates(covariate_definitions, names):
+    """
+    Finds the `include_date_of_match` columns of the given variables, as
+    a dictionary of column name -> (source variable, date format)
+    """
+    return {
+        name: (kwargs["source"], kwargs.get("date_format"))
+        for name, (funcname, kwargs) in covariate_definitions.items()
+        if funcname == "value_from" and kwargs["source"] in names and kwargs["returning"] == "date"
+    }
+
+
+def period_mask(dates, between):
+    start, end = between
+    mask = np.ones(len(dates), dtype=bool)
+    if start is not None:
+        mask &= dates >= np.datetime64(start)
+    if end is not None:
+        mask &= dates <= np.datetime64(end)
+    return mask
+
+
+def run_shared_scan(scan, events, date_columns=None):
+    """
+    Scans `events` once for every code and period in `scan`, then derives each
+    of its variables from the matching rows
+
+    `events` has `patient_id`, `code` and `date` columns, plus `numeric_value`
+    for clinical events and `underlying` (1 for the underlying cause) for
+    death certificates. `date_columns` maps `include_date_of_match` column
+    names to their source variable and date format. Codes are matched with
+    each variable's CodeArray, so no event code is hashed. Returns a dataframe
+    indexed by `patient_id` with a column per variable, holding what
+    cohortextractor would give patients with a match.
+    """
+    matched = events[CodeArray(scan.codes, system=scan.system).contains(events["code"])]
+    matched = matched.assign(date=pd.to_datetime(matched["date"]))
+    matched = matched[period_mask(matched["date"].values, scan.between)]
+    # Sort once so first and last matches are the first and last row per patient
+    matched = matched.sort_values(["patient_id", "date"], kind="stable")
+
+    columns = {}
+    picked = {}
+    for variable in scan.variables:
+        in_codelist = variable.code_array.contains(matched["code"])
+        rows = matched[in_codelist & period_mask(matched["date"].values, variable.between)]
+        if variable.underlying_only:
+            rows = rows[rows["underlying"] == 1]
+        if variable.returning == "binary_flag":
+            columns[variable.name] = pd.Series(1, index=pd.Index(rows["patient_id"].unique(), name="patient_id"))
+            continue
+        if variable.returning == "number_of_matches_in_period":
+            columns[variable.name] = rows.groupby("patient_id").size()
+            continue
+        keep = "first" if variable.find_first or variable.returning == "date_of_death" else "last"
+        match = rows.drop_duplicates("patient_id", keep=keep).set_index("patient_id")
+        picked[variable.name] = match
+        if variable.returning in ("date", "date_of_death"):
+            columns[variable.name] = format_dates(match["date"], variable.date_format)
+        elif variable.returning == "numeric_value":
+            columns[variable.name] = match["numeric_value"]
+        elif variable.returning == "category":
+            categories = variable.code_array.categories_for(match["code"])
+            columns[variable.name] = pd.Series(categories, index=match.index)
+
+    for name, (source, date_format) in (date_columns or {}).items():
+        if source in picked:
+            columns[name] = format_dates(picked[source]["date"], date_format)
+    return pd.DataFrame(columns)
+
+
+def evaluate_shared_scans(covariate_definitions, tables, patient_ids=None):
+    """
+    Computes every variable in the shared scan plan from event-level `tables`
+    (keyed by table name), filling in cohortextractor's values for patients
+    with no match
+    """
+    scans = plan_shared_scans(covariate_definitions)
+    by_table = variables_by_table(scans)
+    missing = sorted(set(by_table) - set(tables))
+    if missing:
+        names = [name for table in missing for name in by_table[table]]
+        raise ValueError(f"Events from {', '.join(missing)} are needed for {', '.join(names)}")
+    names = {variable.name for scan in scans for variable in scan.variables}
+    date_columns = value_from_dates(covariate_definitions, names)
+
+    results = []
+    for table in {scan.table for scan in scans}:
+        table_scans = [scan for scan in scans if scan.table == table]
+        events = intern_codes(tables[table])
+        # One pass over the table for the codes of all its scans
+        codes = CodeArray(set().union(*(scan.codes for scan in table_scans)), system=table_scans[0].system)
+        events = events[codes.contains(events["code"])]
+        for scan in table_scans:
+            results.append(run_shared_scan(scan, events, date_columns))
+    result = pd.concat(results, axis=1) if results else pd.DataFrame()
+    if patient_ids is not None:
+        result = result.reindex(pd.Index(patient_ids, name="patient_id"))
+
+    ordered = [name for name in covariate_definitions if name in names or name in date_columns]
+    result = result.reindex(columns=ordered)
+    for name in ordered:
+        funcname, kwargs = covariate_definitions[name]
+        returning = kwargs["returning"]
+        if returning in ("binary_flag", "number_of_matches_in_period"):
+            result[name] = result[name].fillna(0).astype("int64")
+        elif returning == "numeric_value":
+            result[name] = result[name].fillna(0.0)
+        elif returning == "category":
+            result[name] = result[name].fillna("")
+    result.index.name = "patient_id"
+    return result
+
+
+def describe_plan(scans):
+    lines = []
+    for scan in scans:
+        names = ", ".join(variable.name for variable in scan.variables)
+        lines.append(f"{scan.table} ({len(scan.codes)} codes, {scan.between[0]} to {scan.between[1]}): {names}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compute event-based variables, sharing one scan between variables with overlapping codelists"
+    )
+    parser.add_argument("--clinical-events", help="clinical events file")
+    parser.add_argument("--clinical-events-snomed", help="SNOMED CT coded clinical events file")
+    parser.add_argument("--ons-deaths", help="death certificate codes file")
+    parser.add_argument("--output", default="output/shared_scans.csv")
+    parser.add_argument("--plan-only", action="store_true", help="print the scan plan and exit")
+    args = parser.parse_args()
+
+    from medications import read_events
+    from study_definition import study
+
+    scans = plan_shared_scans(study.covariate_definitions)
+    if args.plan_only:
+        print(describe_plan(scans))
+        return
+    paths = {
+        "clinical_events": args.clinical_events,
+        "clinical_events_snomed": args.clinical_events_snomed,
+        "ons_deaths": args.ons_deaths,
+    }
+    for table, names in variables_by_table(scans).items():
+        if not paths[table]:
+            parser.error(f"--{table.replace('_', '-')} is needed for {', '.join(names)}")
+    tables = {table: read_events(path) for table, path in paths.items() if path}
+    result = evaluate_shared_scans(study.covariate_definitions, tables)
+    result.to_csv(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,34 @@
-from cohortextractor import StudyDefinition, patients, codelist, codelist_from_csv, filter_codes_by_category
+from cohortextractor import StudyDefinition, patients, filter_codes_by_category
 
-from codelists import *
+from codelists import (
+    load_codelist,
+    covid_identification,
+    ethnicity_codes,
+    clear_smoking_codes,
+    crohns_disease_codes,
+    ulcerative_colitis_codes,
+    inflammatory_bowel_disease_unclassified_codes,
+    ankylosing_spondylitis_codes,
+    psoriasis_codes,
+    hidradenitis_suppurativa_codes,
+    psoriatic_arthritis_codes,
+    rheumatoid_arthritis_codes,
+    chronic_cardiac_disease_codes,
+    diabetes_codes,
+    hypertension_codes,
+    chronic_respiratory_disease_codes,
+    copd_codes,
+    chronic_liver_disease_codes,
+    stroke_codes,
+    lung_cancer_codes,
+    haem_cancer_codes,
+    other_cancer_codes,
+    ckd_codes,
+    organ_transplant_codes,
+    hba1c_new_codes,
+    hba1c_old_codes,
+    creatinine_codes,
+)
 
 def first_diagnosis_in_period(dx_codelist):
     return patients.with_these_clinical_events(
@@ -66,14 +94,14 @@ def medication_counts_and_dates(var_name, med_codelist_file, high_cost, needs_6m
     else:
         med_codelist_file = "codelists/" + med_codelist_file
     if (high_cost):
-        med_codelist=codelist_from_csv(med_codelist_file + ".csv", system="high_cost_drugs", column="olddrugname")
+        med_codelist=load_codelist(med_codelist_file + ".csv", system="high_cost_drugs", column="olddrugname")
         with_med_func=patients.with_high_cost_drugs
     else:
         if ("medication" in med_codelist_file):
             column_name="snomed_id"
         else:
             column_name="dmd_id"
-        med_codelist=codelist_from_csv(med_codelist_file + ".csv", system="snomed", column=column_name)
+        med_codelist=load_codelist(med_codelist_file + ".csv", system="snomed", column=column_name)
         with_med_func=patients.with_these_medications
     
     med_functions=[
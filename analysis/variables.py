@@ -0,0 +1,89 @@
+import copy
+import re
+
+
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def output_columns(covariate_definitions):
+    """
+    Names of the variables which appear as columns in the extract
+    """
+    return [
+        name
+        for name, (funcname, kwargs) in covariate_definitions.items()
+        if name != "population" and not kwargs.get("hidden")
+    ]
+
+
+def strings_in(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from strings_in(item)
+    elif isinstance(value, (list, tuple)) and not hasattr(value, "system"):
+        for item in value:
+            yield from strings_in(item)
+
+
+def dependencies(covariate_definitions):
+    """
+    Returns a dictionary of variable name -> set of the variables it is
+    computed from
+
+    These are the sub-variables of `categorised_as` and `satisfying`
+    expressions, the source of `include_date_of_match` style columns and the
+    inputs to aggregates and date expressions. Codelists are skipped, since
+    codes can't be variable names.
+    """
+    names = set(covariate_definitions)
+    graph = {}
+    for name, (funcname, kwargs) in covariate_definitions.items():
+        used = set()
+        for key, value in kwargs.items():
+            if key == "return_expectations":
+                continue
+            for string in strings_in(value):
+                if key in ("source", "column_names"):
+                    used.add(string)
+                else:
+                    used.update(IDENTIFIER.findall(string))
+        graph[name] = (used & names) - {name}
+    return graph
+
+
+def with_dependencies(covariate_definitions, names):
+    """
+    Returns `names` plus everything they depend on, transitively, in the order
+    they appear in the study definition
+    """
+    graph = dependencies(covariate_definitions)
+    needed = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(graph[name])
+    return [name for name in covariate_definitions if name in needed]
+
+
+def subset_study(study, names):
+    """
+    Returns a copy of a StudyDefinition which only extracts the given variables
+    (and the population and anything else they depend on)
+    """
+    definitions = study.covariate_definitions
+    keep = with_dependencies(definitions, list(names) + ["population"])
+    subset = copy.copy(study)
+    subset.covariate_definitions = {name: definitions[name] for name in keep}
+    # Anything pulled in only as a dependency is extracted but not output
+    for name in keep:
+        if name not in names and name != "population":
+            funcname, kwargs = subset.covariate_definitions[name]
+            subset.covariate_definitions[name] = (funcname, dict(kwargs, hidden=True))
+    subset.pandas_csv_args = study.get_pandas_csv_args(subset.covariate_definitions)
+    if study.backend:
+        subset.backend = subset.create_backend()
+    return subset
@@ -0,0 +1,50 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+# The analysis scripts import each other as top-level modules, as they do
+# when run as `python analysis/<script>.py`
+sys.path.insert(0, str(REPO_ROOT / "analysis"))
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    """
+    Runs each test from the repository root, which the scripts' default paths
+    (codelists/, output/, ...) are relative to
+    """
+    monkeypatch.chdir(REPO_ROOT)
+    return REPO_ROOT
+
+
+def run_script(*args):
+    subprocess.run([sys.executable, *args], cwd=REPO_ROOT, check=True)
+
+
+@pytest.fixture(scope="session")
+def cohort_index(tmp_path_factory):
+    """
+    Builds the cohort index from dummy data generated from the study
+    definition's expectations, as the actions up to `index_cohorts` do, and
+    returns the directory holding each action's output
+    """
+    directory = tmp_path_factory.mktemp("pipeline")
+    run_script("analysis/dummy_data.py", "--population", "2000", "--output", str(directory / "input.csv"))
+    run_script(
+        "analysis/columnar.py", "convert",
+        "--input", str(directory / "input.csv"), "--output", str(directory / "input.parquet"),
+    )
+    run_script(
+        "analysis/derived_covariates.py",
+        "--input", str(directory / "input.parquet"), "--output", str(directory / "file_imid_all.dta"),
+    )
+    run_script(
+        "analysis/cohort_index.py", "build",
+        "--input", str(directory / "file_imid_all.dta"), "--output-dir", str(directory / "cohorts"),
+    )
+    return directory
@@ -0,0 +1,17 @@
+import pandas as pd
+
+from benchmark_extract import run_benchmark
+
+
+def test_chunks_give_the_same_extract(tmp_path):
+    from study_definition import study
+
+    whole = run_benchmark(study, tmp_path, 3000, chunksize=3000)
+    expected = pd.read_csv(tmp_path / "input.csv")
+    chunked = run_benchmark(study, tmp_path, 3000, chunksize=700)
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "input.csv"), expected)
+
+    assert chunked["extract_rows"] == whole["extract_rows"] == len(expected)
+    assert chunked["not_benchmarked"] == []
+    assert {"bmi", "bmi_date_measured", "smoking_status", "gp_consult_count"} <= set(expected.columns)
+    assert set(expected["smoking_status"]) <= {"S", "E", "N", "M"}
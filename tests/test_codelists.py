@@ -0,0 +1,28 @@
+import subprocess
+import sys
+
+
+def loaded_codelists(repo_root, statement):
+    """
+    The CSV codelists loaded after running `statement` in a fresh interpreter
+    """
+    code = f"import codelists\n{statement}\nprint(*[n for n in codelists.CSV_CODELISTS if n in vars(codelists)])"
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=repo_root,
+        env={"PYTHONPATH": str(repo_root / "analysis")},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.split()
+
+
+def test_star_import_loads_nothing(repo_root):
+    assert loaded_codelists(repo_root, "from codelists import *") == []
+
+
+def test_study_definition_loads_only_what_it_uses(repo_root):
+    loaded = loaded_codelists(repo_root, "import study_definition")
+    assert "ethnicity_codes" in loaded
+    assert "unclear_smoking_codes" not in loaded
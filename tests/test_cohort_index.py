@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from cohort_index import CohortIndex, export_cohort, read_analysis_dataset, row_runs
+from derived_covariates import write_cohort_files
+
+
+def test_row_runs():
+    starts, stops = row_runs(np.array([0, 1, 2, 5, 7, 8]))
+    assert starts.tolist() == [0, 5, 7]
+    assert stops.tolist() == [3, 6, 9]
+    starts, stops = row_runs(np.array([], dtype="int64"))
+    assert len(starts) == len(stops) == 0
+
+
+def test_cohort_rows(cohort_index):
+    index = CohortIndex(cohort_index / "cohorts")
+    df = read_analysis_dataset(cohort_index / "file_imid_all.dta")
+    for name in ["imid", "standil6"]:
+        expected = df[df[name].notna()].reset_index(drop=True)
+        pd.testing.assert_frame_equal(index.cohort(name), expected)
+
+
+def test_export_matches_create_cohorts(cohort_index, tmp_path):
+    index = CohortIndex(cohort_index / "cohorts")
+    write_cohort_files(read_analysis_dataset(cohort_index / "file_imid_all.dta"), tmp_path, cohorts=["standil6"])
+    export_cohort(index, "standil6", tmp_path / "exported.dta")
+
+    def read(filename):
+        return pd.read_stata(filename, convert_dates=False, convert_categoricals=False, convert_missing=True)
+
+    expected = read(tmp_path / "file_standil6.dta")
+    exported = read(tmp_path / "exported.dta")
+    pd.testing.assert_frame_equal(exported, expected)
+    # `.u` survives the round trip
+    assert exported["ethnicity"].map(repr).str.contains(r"\.u").any()
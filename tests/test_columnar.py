@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from columnar import csv_to_parquet, days_to_dates, read_cohort
+
+
+SCHEMA = {
+    "patient_id": {"type": "patient_id"},
+    "died_date_ons": {"type": "date", "date_format": "YYYY-MM-DD"},
+    "bmi_date_measured": {"type": "date", "date_format": "YYYY-MM"},
+}
+
+# Dates either side of what an int16 of days since 1970, or a nanosecond
+# timestamp, can hold
+DATES = ["1850-06-01", "2020-03-01", "2100-12-31", "9999-12-31", ""]
+
+
+@pytest.fixture(params=["csv", "parquet"])
+def extract(request, tmp_path):
+    csv = tmp_path / "input.csv"
+    pd.DataFrame({
+        "patient_id": range(len(DATES)),
+        "died_date_ons": DATES,
+        "bmi_date_measured": [date[:7] for date in DATES],
+    }).to_csv(csv, index=False)
+    if request.param == "csv":
+        return csv
+    parquet = tmp_path / "input.parquet"
+    csv_to_parquet(csv, parquet, SCHEMA)
+    return parquet
+
+
+def test_dates_outside_int16_range(extract):
+    cohort = read_cohort(extract, schema=SCHEMA)
+
+    expected = [
+        (np.datetime64(date, "D") - np.datetime64("1970-01-01", "D")).astype("int64") if date else pd.NA
+        for date in DATES
+    ]
+    assert cohort["died_date_ons"].dtype == "Int32"
+    assert cohort["died_date_ons"].tolist() == expected
+    # Month precision dates are the first of the month
+    assert cohort["bmi_date_measured"].tolist()[:4] == [
+        (np.datetime64(date[:7] + "-01", "D") - np.datetime64("1970-01-01", "D")).astype("int64")
+        for date in DATES[:4]
+    ]
+
+
+def test_days_to_dates():
+    cohort = pd.Series([0, 18322, pd.NA], dtype="Int32")
+    dates = days_to_dates(cohort)
+    assert dates.tolist()[:2] == [pd.Timestamp("1970-01-01"), pd.Timestamp("2020-03-01")]
+    assert pd.isna(dates.iloc[2])
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+from statsmodels.duration.hazard_regression import PHReg
+
+import cox_batch
+from conftest import run_script
+
+
+def test_runs_on_expectations_dataset(cohort_index):
+    output_dir = cohort_index / "summaries"
+    run_script(
+        "analysis/cox_batch.py", "--analyses", *cox_batch.ANALYSES,
+        "--index-dir", str(cohort_index / "cohorts"), "--output-dir", str(output_dir),
+    )
+
+    tasks = cox_batch.build_tasks(list(cox_batch.ANALYSES), cox_batch.COHORTS, cox_batch.ETHNICITIES, output_dir)
+    expected = {
+        cox_batch.ANALYSES[name].output.format(cohort=cohort, ethnicity=ethnicity) + ".dta"
+        for cohort, ethnicity, names, _ in tasks
+        for name in names
+    }
+    assert {path.name for path in output_dir.iterdir()} == expected
+    # The ethnic analyses only cover the disease cohorts
+    assert "cox_model_summary_bowel_ethnicity_u.dta" in expected
+    assert not any(name.startswith("cox_model_summary_standtnf_ethnicity") for name in expected)
+
+    summary = pd.read_stata(output_dir / "cox_model_summary_imid.dta")
+    analysis = cox_batch.ANALYSES["cox_models"]
+    # Every model is reported, fitted or not
+    assert len(summary) == len(analysis.models) * len(analysis.outcomes)
+    fitted = summary["hr"].notna()
+    assert fitted.any()
+    assert (summary.loc[fitted, "lc"] <= summary.loc[fitted, "hr"]).all()
+    assert (summary.loc[fitted, "hr"] <= summary.loc[fitted, "uc"]).all()
+
+
+def test_fit_cox_matches_statsmodels():
+    rng = np.random.default_rng(1)
+    n = 400
+    X = np.column_stack([rng.integers(0, 2, n), rng.normal(size=n), rng.integers(0, 2, n)]).astype("float64")
+    event_time = rng.exponential(1 / np.exp(0.5 * X[:, 0] + 0.3 * X[:, 1]))
+    censor_time = rng.uniform(0, 1.5, n)
+    failed = event_time <= censor_time
+    # Rounded, so there are ties for the Breslow approximation to handle
+    time = np.round(np.minimum(event_time, censor_time), 2) + 0.01
+
+    hr, lc, uc = cox_batch.fit_cox(time, failed, X)
+
+    # One group per patient gives statsmodels' robust variance, which stcox
+    # scales by n / (n - 1)
+    reference = PHReg(time, X, status=failed.astype("float64"), ties="breslow").fit(groups=np.arange(n))
+    se = reference.bse[0] * np.sqrt(n / (n - 1))
+    z = stats.norm.ppf(0.975)
+    assert hr == pytest.approx(np.exp(reference.params[0]), rel=1e-9)
+    assert lc == pytest.approx(np.exp(reference.params[0] - z * se), rel=1e-9)
+    assert uc == pytest.approx(np.exp(reference.params[0] + z * se), rel=1e-9)
+
+
+def test_fit_cox_rejects_models_without_failures():
+    time = np.linspace(0.1, 0.5, 10)
+    X = np.arange(10, dtype="float64")[:, None] % 2
+    with pytest.raises(ValueError):
+        cox_batch.fit_cox(time, np.zeros(10, dtype=bool), X)
+
+
+def test_fit_cox_rejects_infinite_hazard_ratios():
+    # Every failure is exposed, so the estimate runs off to infinity
+    time = np.linspace(0.1, 0.5, 10)
+    X = (np.arange(10) < 5).astype("float64")[:, None]
+    with pytest.raises(ValueError):
+        cox_batch.fit_cox(time, X[:, 0] == 1, X)
+
+
+@pytest.mark.parametrize("analysis_name, written", [("cox_spline", True), ("cox_spline_haemonc", False)])
+def test_failed_fits(analysis_name, written):
+    n = 20
+    df = pd.DataFrame({
+        "imid": np.arange(n) % 2,
+        "age1": np.arange(n, dtype="float64"),
+        "age2": np.arange(n, dtype="float64") ** 2,
+        "age3": np.arange(n, dtype="float64") ** 3,
+        "male": np.arange(n) % 3 == 0,
+        "haem_cancer": 0,
+        "organ_transplant": 0,
+        "ethnicity": 1,
+    })
+    for stop, failure in cox_batch.OUTCOMES.values():
+        df[stop] = np.nan
+        df[failure] = 0
+    analysis = cox_batch.ANALYSES[analysis_name]._replace(models=["agesex_spline"])
+
+    summary = cox_batch.run_analysis(df, analysis, "imid")
+
+    if written:
+        # Without `capture`, every model is reported with a missing estimate
+        assert len(summary) == len(analysis.outcomes)
+        assert summary["hr"].isna().all()
+    else:
+        assert summary.empty
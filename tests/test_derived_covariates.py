@@ -0,0 +1,74 @@
+import json
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cohort_index import read_analysis_dataset
+from columnar import read_cohort
+from derived_covariates import compare_datasets, derive_covariates, write_analysis_dataset
+
+
+@pytest.fixture(scope="module")
+def extract(cohort_index):
+    return read_cohort(cohort_index / "input.parquet")
+
+
+def missing_code(value):
+    return getattr(value, "string", None)
+
+
+def test_rows_are_in_stp_order(extract):
+    df = derive_covariates(extract)
+    stp = df["stp"].to_numpy("float64")
+    assert (np.diff(stp) >= 0).all()
+    # Within an STP, patients keep their order in the extract
+    position = pd.Series(np.arange(len(extract)), index=extract["patient_id"])
+    for _, patients in df.groupby("stp")["patient_id"]:
+        assert position[patients].is_monotonic_increasing
+
+
+def test_only_unknown_imd_is_u(extract, tmp_path):
+    extract = extract.copy()
+    extract["imd"] = extract["imd"].cat.add_categories(["-1"])
+    extract.loc[:99, "imd"] = "-1"
+    extract.loc[100:199, "imd"] = np.nan
+    df = derive_covariates(extract)
+    write_analysis_dataset(df, tmp_path / "file_imid_all.dta")
+
+    written = pd.read_stata(
+        tmp_path / "file_imid_all.dta", convert_dates=False, convert_categoricals=False, convert_missing=True
+    )
+    missing = written.set_index("patient_id")["imd"].map(missing_code)
+    unknown = extract["patient_id"][:100]
+    blank = extract["patient_id"][100:200]
+    kept = df["patient_id"]
+    assert (missing[unknown[unknown.isin(kept)]] == ".u").all()
+    assert (missing[blank[blank.isin(kept)]] == ".").all()
+    # Every other unknown column's missing values are all `.u`
+    assert not written["ethnicity"].map(missing_code).eq(".").any()
+
+
+def test_comparison_with_the_do_file(cohort_index, tmp_path):
+    stata = cohort_index / "file_imid_all.dta"
+    report = tmp_path / "comparison.json"
+    subprocess.run(
+        [
+            sys.executable, "analysis/derived_covariates.py",
+            "--input", str(cohort_index / "input.parquet"), "--output", str(tmp_path / "file_imid_all.dta"),
+            "--compare-with", str(stata), "--report", str(report),
+        ],
+        check=True,
+    )
+    assert json.loads(report.read_text()) == {
+        "only_in_stata": [], "only_in_python": [], "same_rows": True, "differing_columns": []
+    }
+
+    expected = read_analysis_dataset(stata)
+    changed = expected.copy()
+    changed["age"] = changed["age"] + 1
+    changed.attrs["unknown"] = dict(expected.attrs["unknown"], imd=~expected.attrs["unknown"]["imd"])
+    assert compare_datasets(expected, changed)["differing_columns"] == ["age", "imd"]
+    assert not compare_datasets(expected, changed.iloc[::-1])["same_rows"]
@@ -0,0 +1,49 @@
+import pandas as pd
+import pytest
+
+from diagnoses import codelists_by_table, first_diagnosis_codelists, first_diagnosis_dates_by_table
+
+
+@pytest.fixture(scope="module")
+def codelists():
+    from study_definition import study
+
+    return first_diagnosis_codelists(study.covariate_definitions)
+
+
+def test_codelists_by_table(codelists):
+    by_table = codelists_by_table(codelists[0])
+    assert set(by_table["clinical_events_snomed"]) == {"psoriatic_arthritis", "ankylosing_spondylitis"}
+    assert "rheumatoid_arthritis" in by_table["clinical_events"]
+
+
+def test_snomed_codelists_read_the_snomed_table(codelists):
+    codelists, between, date_format = codelists
+    snomed_code = sorted(codelists["psoriatic_arthritis"])[0]
+    ctv3_code = sorted(codelists["rheumatoid_arthritis"])[0]
+    tables = {
+        # A SNOMED CT code in the CTV3 table isn't a psoriatic arthritis
+        # diagnosis
+        "clinical_events": pd.DataFrame({
+            "patient_id": [1, 2],
+            "code": [ctv3_code, snomed_code],
+            "date": ["2019-05-01", "2015-01-01"],
+        }),
+        "clinical_events_snomed": pd.DataFrame({
+            "patient_id": [2, 3],
+            "code": [snomed_code, snomed_code],
+            "date": ["2017-02-03", "2016-01-01"],
+        }),
+    }
+
+    result = first_diagnosis_dates_by_table(tables, codelists, between, date_format)
+
+    assert list(result.columns) == list(codelists)
+    assert result["rheumatoid_arthritis"].to_dict() == {1: "2019-05", 2: None, 3: None}
+    assert result["psoriatic_arthritis"].to_dict() == {1: None, 2: "2017-02", 3: "2016-01"}
+
+
+def test_missing_table(codelists):
+    codelists, between, date_format = codelists
+    with pytest.raises(ValueError, match="clinical_events_snomed"):
+        first_diagnosis_dates_by_table({"clinical_events": pd.DataFrame(columns=["patient_id", "code", "date"])}, codelists)
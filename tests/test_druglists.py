@@ -0,0 +1,113 @@
+import re
+from pathlib import Path
+
+import pandas as pd
+
+from druglists import (
+    DEFAULT_CODELIST_DIR,
+    DEFAULT_EXCLUSIONS,
+    DEFAULT_MAPPING,
+    DrugNameMatcher,
+    ambiguous_names,
+    normalise,
+    read_names,
+)
+
+# Names that test the exclusions' word boundaries and the patterns' overlaps
+TRICKY_NAMES = [
+    "METHOTREXATE IV",
+    "methotrexate iv injection",
+    "methotrexate ivory",
+    "methotrexate intrathecal",
+    "methotrexate intravenous",
+    "rituximab r-chop",
+    "rituximab",
+    "adalimumab (humira)",
+    "infliximab/remsima",
+    "not a drug",
+    "",
+]
+
+
+def regex_loop(mapping, exclusions, names):
+    """
+    The mapping as `make_new_druglists_and_metadata.R` does it: each drug's
+    patterns joined into one regex, tried against every name, then its
+    exclusions
+    """
+    excluded = dict(zip(exclusions["new_clean_drug"], exclusions["exclude_regex"]))
+    rows = set()
+    for drug, patterns in mapping.groupby("new_clean_drug")["old_drug_name"]:
+        include = re.compile("|".join(patterns), re.IGNORECASE)
+        exclude = re.compile(excluded[drug], re.IGNORECASE) if isinstance(excluded.get(drug), str) else None
+        for name in names:
+            if include.search(name) and not (exclude and exclude.search(name)):
+                rows.add((name, drug))
+    return rows
+
+
+def matched(matcher, names):
+    return set(matcher.map_names(names)[["olddrugname", "drug"]].itertuples(index=False, name=None))
+
+
+def test_matches_the_regex_loop():
+    mapping = pd.read_csv(DEFAULT_MAPPING, dtype={"vtm": str})
+    exclusions = pd.read_csv(DEFAULT_EXCLUSIONS)
+    names = sorted(set(map(normalise, read_names(sorted(Path(DEFAULT_CODELIST_DIR).glob("crossimid-*-drug-names.csv"))) + TRICKY_NAMES)))
+
+    result = matched(DrugNameMatcher(mapping, exclusions), names)
+
+    assert result == regex_loop(mapping, exclusions, names)
+    # The `\biv\b` exclusion only applies to "iv" as a word
+    assert ("methotrexate iv", "methotrexate") not in result
+    assert ("methotrexate ivory", "methotrexate") in result
+
+
+def test_patterns_which_arent_plain_text_fall_back_to_re():
+    mapping = pd.DataFrame(
+        {
+            "old_drug_name": ["inf[l]iximab", "remsima", "^ritux", "\\bmab\\b"],
+            "vtm": ["1", "1", "2", "3"],
+            "new_clean_drug": ["infliximab", "infliximab", "rituximab", "mab"],
+        }
+    )
+    exclusions = pd.DataFrame({"exclude_regex": ["sc$|[0-9]+ ?mg", None], "new_clean_drug": ["infliximab", "rituximab"]})
+    names = [
+        "infliximab",
+        "infliximab sc",
+        "infliximab 100mg",
+        "remsima 100 mg",
+        "remsima",
+        "rituximab",
+        "iv rituximab",
+        "a mab",
+        "abmab",
+    ]
+
+    matcher = DrugNameMatcher(mapping, exclusions)
+
+    assert set(matcher.include_regexes) == {"infliximab", "rituximab"}
+    assert set(matcher.exclude_regexes) == {"infliximab"}
+    assert matched(matcher, names) == regex_loop(mapping, exclusions, names) == {
+        ("infliximab", "infliximab"),
+        ("remsima", "infliximab"),
+        ("rituximab", "rituximab"),
+        ("a mab", "mab"),
+    }
+
+
+def test_ambiguous_names():
+    mapping = pd.DataFrame(
+        {
+            "old_drug_name": ["ritux", "rituximab biosimilar", "humira"],
+            "vtm": ["1", "2", "3"],
+            "new_clean_drug": ["rituximab", "rituximab biosimilar", "adalimumab"],
+        }
+    )
+    mapped = DrugNameMatcher(mapping).map_names(["Rituximab Biosimilar", "rituximab", "humira", "rituximab biosimilar"])
+
+    assert ambiguous_names(mapped) == ["rituximab biosimilar"]
+    assert sorted(mapped.loc[mapped["olddrugname"] == "rituximab biosimilar", "drug"]) == [
+        "rituximab",
+        "rituximab biosimilar",
+    ]
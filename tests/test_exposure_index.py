@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from exposure_index import EPOCH, ExposureIndex, build_exposure_index
+
+
+def days(*dates):
+    return [int((np.datetime64(date, "D") - EPOCH).astype("int64")) for date in dates]
+
+
+@pytest.fixture
+def index(tmp_path):
+    events = pd.DataFrame({
+        "drug": ["adalimumab", "adalimumab", "etanercept", "etanercept", "etanercept"],
+        "patient_id": [1, 2, 3, 3, 3],
+        "day": days("1900-01-01", "2019-05-01", "2019-01-01", "2019-06-01", "2020-01-01"),
+    })
+    build_exposure_index(events, tmp_path)
+    return ExposureIndex(tmp_path)
+
+
+def test_window_starting_before_epoch(index):
+    counts = index.query("adalimumab", "1850-01-01", "2020-01-01")
+    assert counts.to_dict() == {1: 1, 2: 1}
+    assert index.query("etanercept", "1850-01-01", "2019-12-31").to_dict() == {3: 2}
+
+
+def test_window_ending_before_epoch(index):
+    assert index.query("adalimumab", "1800-01-01", "1899-12-31").empty
+    assert index.query("etanercept", None, "1899-12-31").empty
+
+
+def test_window_ending_after_encoding(index):
+    assert index.query("etanercept", "2019-06-01", "9999-12-31").to_dict() == {3: 2}
+
+
+def test_issue_before_epoch_is_rejected(tmp_path):
+    events = pd.DataFrame({"drug": ["adalimumab"], "patient_id": [1], "day": days("1899-12-31")})
+    with pytest.raises(ValueError, match="before 1900-01-01"):
+        build_exposure_index(events, tmp_path)
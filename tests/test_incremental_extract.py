@@ -0,0 +1,38 @@
+import subprocess
+import sys
+
+import pytest
+
+from incremental_extract import data_source, variable_hashes
+
+
+@pytest.fixture(scope="module")
+def study():
+    from study_definition import study
+
+    return study
+
+
+def test_snapshot_is_part_of_every_hash(study):
+    before = variable_hashes(study.covariate_definitions, data_source(study, snapshot="2026-09-01"))
+    after = variable_hashes(study.covariate_definitions, data_source(study, snapshot="2026-10-01"))
+    assert before == variable_hashes(study.covariate_definitions, data_source(study, snapshot="2026-09-01"))
+    assert all(before[name] != after[name] for name in before)
+
+
+def test_database_extract_needs_snapshot(study):
+    with pytest.raises(ValueError, match="snapshot"):
+        data_source(study)
+    # Dummy data is keyed on its size and seed instead
+    assert data_source(study, expectations_population=1000) == "expectations:1000:0"
+
+
+def test_main_needs_snapshot(repo_root):
+    result = subprocess.run(
+        [sys.executable, "analysis/incremental_extract.py", "--output", "unused.csv"],
+        cwd=repo_root,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 2
+    assert "--snapshot is required" in result.stderr
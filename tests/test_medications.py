@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+from druglists import read_lookup
+from medications import build_medication_plans, extract_medications
+
+
+def test_drug_lookup_matches_the_codelists():
+    from study_definition import study
+
+    plan = build_medication_plans(study.covariate_definitions)["high_cost_drugs"]
+    rng = np.random.default_rng(0)
+    # Names from the study's codelists, as they appear in them, and names
+    # which match nothing
+    names = np.array(sorted(set(plan.code_to_drug["code"])) + ["not a drug", "placebo"], dtype=object)
+    rows = 20_000
+    events = pd.DataFrame(
+        {
+            "patient_id": rng.integers(1, 2_000, rows),
+            "code": names[rng.integers(0, len(names), rows)],
+            "date": np.datetime_as_string(
+                np.datetime64("2019-06-01") + rng.integers(0, 400, rows).astype("timedelta64[D]")
+            ),
+        }
+    )
+    patient_ids = np.arange(1, 2_000)
+
+    by_codelist = extract_medications(plan, events, patient_ids)
+    by_lookup = extract_medications(plan, events, patient_ids, drug_lookup=read_lookup())
+
+    pd.testing.assert_frame_equal(by_lookup, by_codelist)
+    # Every high cost drug variable is exercised
+    assert (by_codelist > 0).any().all()
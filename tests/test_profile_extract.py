@@ -0,0 +1,62 @@
+import pytest
+
+from profile_extract import ExtractProfiler, current_rss_kb
+
+# Enough memory to stand out from the noise of the rest of the process
+ALLOCATED_KB = 64 * 1024
+
+
+class FakeCursor:
+    def __init__(self, kept):
+        self.kept = kept
+
+    def execute(self, query):
+        if query.startswith("-- Query for big"):
+            # A variable that leaves the client holding memory ...
+            self.kept.append(b"\x01" * (ALLOCATED_KB * 1024))
+        elif query.startswith("-- Query for freed"):
+            # ... and one that frees it
+            self.kept.clear()
+
+    def fetchone(self):
+        return (1,)
+
+
+class FakeBackend:
+    def __init__(self, names):
+        self.kept = []
+        self.queries = []
+        for name in names:
+            self.queries += [f"-- Query for {name}\nSELECT 1", f"CREATE CLUSTERED INDEX ix ON #{name} (patient_id)"]
+
+    def get_db_connection(self):
+        return self
+
+    def cursor(self):
+        return FakeCursor(self.kept)
+
+    def to_file(self, output):
+        self.execute_queries(self.queries)
+
+
+class FakeStudy:
+    def __init__(self, names):
+        self.covariate_definitions = {name: ("with_these_clinical_events", {}) for name in names}
+        self.backend = FakeBackend(names)
+
+
+@pytest.mark.skipif(current_rss_kb() is None, reason="needs /proc")
+def test_rss_is_measured_per_variable(tmp_path):
+    names = ["small", "big", "after", "freed"]
+    profiler = ExtractProfiler(FakeStudy(names))
+    # Keep the server statistics query from running against the fake cursor
+    profiler.server_stats = False
+    report = profiler.run(tmp_path / "input.csv")
+    delta = {record["name"]: record["client_rss_delta_kb"] for record in report["variables"]}
+
+    assert delta["big"] >= ALLOCATED_KB * 0.9
+    # The variables after it aren't charged for memory they didn't use, as
+    # they would be with the peak
+    assert abs(delta["after"]) < ALLOCATED_KB * 0.1
+    assert delta["freed"] <= -ALLOCATED_KB * 0.9
+    assert report["client_peak_rss_kb"] >= ALLOCATED_KB
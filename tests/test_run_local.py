@@ -0,0 +1,199 @@
+import sys
+import textwrap
+
+import pytest
+import yaml
+
+import run_local
+
+
+# Stands in for `stata-mp -b do`: runs the wrapper do-file's `cd` and `do`
+# lines, where each line of the do-file is either `error` or `write <path>`,
+# with `$1` in the path replaced by the first argument, and logs to
+# <do-file name>.log in the working directory as batch mode does
+FAKE_STATA = '''
+import os
+import re
+import sys
+
+wrapper = sys.argv[-1]
+log = open(os.path.abspath(wrapper[:-3] + ".log"), "w")
+for line in open(wrapper):
+    words = re.findall(r'`"(.*?)"\\'', line)
+    if line.startswith("cd "):
+        os.chdir(words[0])
+    elif line.startswith("do "):
+        script, *args = words
+        for command in open(script).read().split("\\n"):
+            log.write(f". {command}\\n")
+            if command == "error":
+                log.write("r(601);\\n")
+                sys.exit(0)
+            if command.startswith("write "):
+                with open(command.split()[1].replace("$1", args[0] if args else ""), "w") as f:
+                    f.write(" ".join(args))
+log.write(f"args: {' '.join(args)}\\n")
+'''
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "analysis").mkdir()
+    (tmp_path / "output").mkdir()
+    (tmp_path / "fake_stata.py").write_text(FAKE_STATA)
+
+    def write(actions, files):
+        for name, contents in files.items():
+            (tmp_path / name).write_text(textwrap.dedent(contents))
+        with open(tmp_path / "project.yaml", "w") as f:
+            yaml.safe_dump({"version": "3.0", "actions": actions}, f)
+        return run_local.load_project(
+            runners={"stata-mp": [sys.executable, str(tmp_path / "fake_stata.py")]}
+        )
+
+    return write
+
+
+def statuses(results):
+    return {result["name"]: result["status"] for result in results}
+
+
+def test_stale_outputs_are_not_accepted(project, tmp_path):
+    actions = project(
+        {"make": {"run": "python:latest python analysis/make.py", "outputs": {"moderately_sensitive": {"out": "output/out.txt"}}}},
+        {"analysis/make.py": "print('writes nothing')\n"},
+    )
+    (tmp_path / "output" / "out.txt").write_text("from an earlier run")
+
+    results = run_local.run_pipeline(actions, ["make"], cores=1, memory=2 ** 30, state_dir=tmp_path / "state")
+
+    assert statuses(results) == {"make": "failed"}
+    assert not (tmp_path / "output" / "out.txt").exists()
+
+
+def test_stata_errors_fail_the_action(project, tmp_path):
+    actions = project(
+        {
+            "models": {"run": "stata-mp:latest analysis/models.do imid", "outputs": {"moderately_sensitive": {"out": "output/out.txt"}}},
+            "export": {"run": "stata-mp:latest analysis/export.do", "needs": ["models"], "outputs": {"moderately_sensitive": {"csv": "output/out.csv"}}},
+        },
+        {
+            "analysis/models.do": "write output/out.txt\nerror",
+            "analysis/export.do": "write output/out.csv",
+        },
+    )
+
+    results = run_local.run_pipeline(actions, ["export"], cores=1, memory=2 ** 30, state_dir=tmp_path / "state")
+
+    assert statuses(results) == {"models": "failed", "export": "blocked"}
+    assert "r(601);" in (tmp_path / "state" / "logs" / "models.log").read_text()
+
+
+def test_stata_actions_get_their_own_logs(project, tmp_path):
+    actions = project(
+        {
+            f"models_{cohort}": {
+                "run": f"stata-mp:latest analysis/models.do {cohort}",
+                "outputs": {"moderately_sensitive": {"out": f"output/{cohort}.txt"}},
+            }
+            for cohort in ["imid", "joint"]
+        },
+        {"analysis/models.do": "write output/$1.txt"},
+    )
+
+    results = run_local.run_pipeline(actions, list(actions), cores=2, memory=2 ** 30, state_dir=tmp_path / "state")
+
+    assert statuses(results) == {"models_imid": "ran", "models_joint": "ran"}
+    for cohort in ["imid", "joint"]:
+        assert f"args: {cohort}" in (tmp_path / "state" / "logs" / f"models_{cohort}.log").read_text()
+    # Nothing is written to the project directory by Stata itself
+    assert not list(tmp_path.glob("*.log"))
+
+
+def pipeline(project):
+    # `make` writes what `settings.py` says; `use` copies it
+    return project(
+        {
+            "make": {"run": "python:latest python analysis/make.py", "outputs": {"moderately_sensitive": {"out": "output/made.txt"}}},
+            "use": {"run": "python:latest python analysis/use.py", "needs": ["make"], "outputs": {"moderately_sensitive": {"out": "output/used.txt"}}},
+        },
+        {
+            "analysis/settings.py": "VALUE = 1\n",
+            "analysis/make.py": """
+                from settings import VALUE
+                open("output/made.txt", "w").write(str(VALUE))
+            """,
+            "analysis/use.py": """
+                open("output/used.txt", "w").write(open("output/made.txt").read())
+            """,
+        },
+    )
+
+
+def test_unchanged_actions_are_cached(project, tmp_path):
+    actions = pipeline(project)
+    state_dir = tmp_path / "state"
+
+    first = run_local.run_pipeline(actions, ["use"], cores=2, memory=2 ** 30, state_dir=state_dir)
+    second = run_local.run_pipeline(actions, ["use"], cores=2, memory=2 ** 30, state_dir=state_dir)
+
+    assert statuses(first) == {"make": "ran", "use": "ran"}
+    assert statuses(second) == {"make": "cached", "use": "cached"}
+    assert (tmp_path / "output" / "used.txt").read_text() == "1"
+
+
+def test_changes_rerun_the_actions_they_affect(project, tmp_path):
+    actions = pipeline(project)
+    state_dir = tmp_path / "state"
+    run_local.run_pipeline(actions, ["use"], cores=2, memory=2 ** 30, state_dir=state_dir)
+
+    # A module the script imports changes its output, so what needs it runs too
+    (tmp_path / "analysis" / "settings.py").write_text("VALUE = 20\n")
+    results = run_local.run_pipeline(actions, ["use"], cores=2, memory=2 ** 30, state_dir=state_dir)
+    assert statuses(results) == {"make": "ran", "use": "ran"}
+    assert (tmp_path / "output" / "used.txt").read_text() == "20"
+
+    # A needed output changed since `use` last ran: `make` is run again to
+    # restore it, and `use` is cached as its input is as it was
+    (tmp_path / "output" / "made.txt").write_text("edited")
+    results = run_local.run_pipeline(actions, ["use"], cores=2, memory=2 ** 30, state_dir=state_dir)
+    assert statuses(results) == {"make": "ran", "use": "cached"}
+    assert (tmp_path / "output" / "made.txt").read_text() == "20"
+
+    # An action's own output changed
+    (tmp_path / "output" / "used.txt").write_text("edited")
+    results = run_local.run_pipeline(actions, ["use"], cores=2, memory=2 ** 30, state_dir=state_dir)
+    assert statuses(results) == {"make": "cached", "use": "ran"}
+    assert (tmp_path / "output" / "used.txt").read_text() == "20"
+
+
+def test_no_more_than_cores_actions_run_at_once(project, tmp_path):
+    names = [f"sleep_{i}" for i in range(6)]
+    actions = project(
+        {
+            name: {"run": f"python:latest python analysis/sleep.py {name}", "outputs": {"moderately_sensitive": {"out": f"output/{name}.txt"}}}
+            for name in names
+        },
+        {
+            "analysis/sleep.py": """
+                import sys
+                import time
+
+                start = time.monotonic()
+                time.sleep(0.5)
+                open(f"output/{sys.argv[1]}.txt", "w").write(f"{start} {time.monotonic()}")
+            """,
+        },
+    )
+
+    results = run_local.run_pipeline(actions, names, cores=2, memory=2 ** 40, state_dir=tmp_path / "state")
+
+    assert set(statuses(results).values()) == {"ran"}
+    intervals = [tuple(map(float, (tmp_path / "output" / f"{name}.txt").read_text().split())) for name in names]
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    running = most = 0
+    for _, change in events:
+        running += change
+        most = max(most, running)
+    assert most == 2
@@ -0,0 +1,15 @@
+from conftest import run_script
+
+
+def test_matches_dummy_data(tmp_path):
+    run_script(
+        "analysis/dummy_data.py", "--population", "2500", "--chunksize", "1000",
+        "--output", str(tmp_path / "dummy.csv"),
+    )
+    run_script(
+        "analysis/sharded_dummy_data.py", "--population", "2500", "--chunksize", "1000",
+        "--shards", "3", "--workers", "2",
+        "--shard-dir", str(tmp_path / "shards"), "--output", str(tmp_path / "sharded.csv"),
+    )
+    assert (tmp_path / "sharded.csv").read_bytes() == (tmp_path / "dummy.csv").read_bytes()
+    assert not list((tmp_path / "shards").iterdir())
@@ -0,0 +1,41 @@
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+from shared_scans import evaluate_shared_scans, plan_shared_scans, variables_by_table
+
+
+@pytest.fixture(scope="module")
+def covariate_definitions():
+    from study_definition import study
+
+    return study.covariate_definitions
+
+
+def test_variables_by_table(covariate_definitions):
+    by_table = variables_by_table(plan_shared_scans(covariate_definitions))
+    assert set(by_table) == {"clinical_events", "clinical_events_snomed", "ons_deaths"}
+    assert "psoriatic_arthritis" in by_table["clinical_events_snomed"]
+
+
+def test_missing_table_is_an_error(covariate_definitions):
+    events = pd.DataFrame({"patient_id": [1], "code": ["XaPbt"], "date": ["2019-01-01"], "numeric_value": [40.0]})
+    tables = {"clinical_events": events, "ons_deaths": events}
+    with pytest.raises(ValueError, match="clinical_events_snomed are needed for .*psoriatic_arthritis"):
+        evaluate_shared_scans(covariate_definitions, tables)
+
+
+def test_main_needs_every_table(repo_root):
+    result = subprocess.run(
+        [
+            sys.executable, "analysis/shared_scans.py",
+            "--clinical-events", "unused.csv", "--clinical-events-snomed", "unused.csv",
+        ],
+        cwd=repo_root,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 2
+    assert "--ons-deaths is needed for died_ons_covid_flag_any" in result.stderr